@@ -32,6 +32,15 @@ class TrackRequestAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at', 'transaction_id')
 
 
+@admin.register(ArchivedTrackRequest)
+class ArchivedTrackRequestAdmin(admin.ModelAdmin):
+    list_display = ('track', 'venue', 'user_fee', 'status', 'created_at', 'archived_at')
+    list_filter = ('archived_at',)
+    search_fields = ('payment_token',)
+    raw_id_fields = ('track', 'venue')
+    readonly_fields = ('created_at', 'archived_at')
+
+
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('venue', 'amount', 'transaction_type', 'created_at')
@@ -0,0 +1,222 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from itertools import chain
+
+from django.db import IntegrityError, connection, transaction as db_transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import (
+    ArchivedTrackRequest, GenreDailyStats, Track, TrackDailyStats, TrackRequest, Venue, VenueDailyStats
+)
+
+COUNTERS = {
+    'created': 'requests',
+    'paid': 'paid',
+    'accepted': 'accepted',
+    'rejected': 'rejected',
+}
+METRICS = ('requests', 'paid', 'accepted', 'rejected', 'revenue')
+KEYS = {
+    VenueDailyStats: ('venue_id', 'day'),
+    TrackDailyStats: ('venue_id', 'day', 'track_id'),
+    GenreDailyStats: ('venue_id', 'day', 'genre_id'),
+}
+
+
+def _increment(model, lookup, counter, count, revenue):
+    values = {counter: F(counter) + count}
+    if revenue:
+        values['revenue'] = F('revenue') + revenue
+    if model.objects.filter(**lookup).update(**values):
+        return
+    try:
+        with db_transaction.atomic():
+            model.objects.create(**lookup, **{counter: count, 'revenue': revenue})
+    except IntegrityError:
+        # Строку за этот день успел создать параллельный запрос
+        model.objects.filter(**lookup).update(**values)
+
+
+def _upsert(model, key_columns, counter, deltas):
+    # Один INSERT ... ON CONFLICT на таблицу независимо от того, есть ли уже строки за день
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    columns = ', '.join(quote(name) for name in (*key_columns, *METRICS))
+    keys = ', '.join(quote(name) for name in key_columns)
+    row = '(' + ', '.join(['%s'] * (len(key_columns) + len(METRICS))) + ')'
+    params = []
+    for key, (count, revenue) in sorted(deltas.items()):
+        counters = [count if name == counter else 0 for name in METRICS[:-1]]
+        params.extend([*key, *counters, revenue])
+    updates = ', '.join(f'{name} = {table}.{name} + excluded.{name}' for name in map(quote, (counter, 'revenue')))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ({columns}) VALUES {", ".join([row] * len(deltas))} '
+            f'ON CONFLICT ({keys}) DO UPDATE SET {updates}',
+            params
+        )
+
+
+def _genre_ids(track_requests):
+    # Жанр текущий, как в rebuild; незагруженные треки читаются одним запросом, а не по одному
+    loaded = {
+        track_request.track_id: track_request.track.genre_id
+        for track_request in track_requests if TrackRequest.track.is_cached(track_request)
+    }
+    missing = {track_request.track_id for track_request in track_requests} - loaded.keys()
+    if missing:
+        loaded.update(Track.objects.filter(pk__in=missing).values_list('id', 'genre_id'))
+    return loaded
+
+
+def record_events(track_requests, event):
+    """Обновляет дневные счетчики заведения, трека и жанра.
+
+    Вызывается в той же транзакции, что и изменение запроса, поэтому при
+    откате счетчики тоже откатываются. День берется по дате создания запроса,
+    так же как при пересчете в rebuild.
+    """
+    counter = COUNTERS[event]
+    genre_ids = _genre_ids(track_requests)
+    deltas = {model: defaultdict(lambda: [0, 0]) for model in KEYS}
+    for track_request in track_requests:
+        day = timezone.localdate(track_request.created_at)
+        revenue = track_request.user_fee if event == 'paid' else 0
+        keys = {
+            VenueDailyStats: (track_request.venue_id, day),
+            TrackDailyStats: (track_request.venue_id, day, track_request.track_id),
+            GenreDailyStats: (track_request.venue_id, day, genre_ids[track_request.track_id]),
+        }
+        for model, key in keys.items():
+            delta = deltas[model][key]
+            delta[0] += 1
+            delta[1] += revenue
+
+    for model, model_deltas in deltas.items():
+        if not model_deltas:
+            continue
+        if connection.vendor in ('sqlite', 'postgresql'):
+            _upsert(model, KEYS[model], counter, model_deltas)
+            continue
+        for key, (count, revenue) in model_deltas.items():
+            _increment(model, dict(zip(KEYS[model], key)), counter, count, revenue)
+
+
+def record_event(track_request, event):
+    record_events([track_request], event)
+
+
+def _start_of(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _daily_rows(requests, date_from, date_to):
+    # Границы по created_at, а не по дню, чтобы работал индекс (venue, created_at)
+    if date_from is not None:
+        requests = requests.filter(created_at__gte=_start_of(date_from))
+    if date_to is not None:
+        requests = requests.filter(created_at__lt=_start_of(date_to + timedelta(days=1)))
+    return requests.annotate(day=TruncDate('created_at')).order_by().values(
+        'day', 'track_id', 'track__genre_id'
+    ).annotate(
+        requests=Count('id'),
+        paid=Count('id', filter=Q(is_paid=True)),
+        accepted=Count('id', filter=Q(status='accepted')),
+        rejected=Count('id', filter=Q(status='rejected')),
+        revenue=Coalesce(Sum('user_fee', filter=Q(is_paid=True)), 0)
+    )
+
+
+def rebuild(venue_id, date_from=None, date_to=None):
+    """Пересчитывает счетчики заведения по TrackRequest и архиву за дни [date_from, date_to]."""
+    rows = chain(
+        _daily_rows(TrackRequest.objects.filter(venue_id=venue_id), date_from, date_to),
+        _daily_rows(ArchivedTrackRequest.objects.filter(venue_id=venue_id), date_from, date_to),
+    )
+
+    venue_totals = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+    track_totals = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+    genre_totals = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+    with db_transaction.atomic():
+        for row in rows:
+            for totals in (
+                venue_totals[row['day']],
+                track_totals[(row['day'], row['track_id'])],
+                genre_totals[(row['day'], row['track__genre_id'])],
+            ):
+                for name in METRICS:
+                    totals[name] += row[name]
+
+        for model in (VenueDailyStats, TrackDailyStats, GenreDailyStats):
+            stale = model.objects.filter(venue_id=venue_id)
+            if date_from is not None:
+                stale = stale.filter(day__gte=date_from)
+            if date_to is not None:
+                stale = stale.filter(day__lte=date_to)
+            stale.delete()
+
+        VenueDailyStats.objects.bulk_create(
+            VenueDailyStats(venue_id=venue_id, day=day, **metrics) for day, metrics in venue_totals.items()
+        )
+        TrackDailyStats.objects.bulk_create(
+            (
+                TrackDailyStats(venue_id=venue_id, day=day, track_id=track_id, **metrics)
+                for (day, track_id), metrics in track_totals.items()
+            ),
+            batch_size=1000
+        )
+        GenreDailyStats.objects.bulk_create(
+            GenreDailyStats(venue_id=venue_id, day=day, genre_id=genre_id, **metrics)
+            for (day, genre_id), metrics in genre_totals.items()
+        )
+    return len(venue_totals)
+
+
+def rebuild_all(venue_ids=None, date_from=None, date_to=None):
+    venues = Venue.objects.order_by('id').values_list('id', flat=True)
+    if venue_ids:
+        venues = venues.filter(id__in=venue_ids)
+    for venue_id in venues.iterator():
+        yield venue_id, rebuild(venue_id, date_from, date_to)
+
+
+def _totals(rows):
+    totals = dict.fromkeys(METRICS, 0)
+    for row in rows:
+        for name in METRICS:
+            totals[name] += row[name]
+    decided = totals['accepted'] + totals['rejected']
+    totals['acceptance_rate'] = round(totals['accepted'] / decided, 4) if decided else None
+    return totals
+
+
+def _sums():
+    return {name: Sum(name) for name in METRICS}
+
+
+def venue_report(venue_id, date_from, date_to, limit=10):
+    # Читаются только строки за выбранный период, объем истории на время ответа не влияет
+    period = {'venue_id': venue_id, 'day__gte': date_from, 'day__lte': date_to}
+    daily = list(
+        VenueDailyStats.objects.filter(**period).order_by('day').values('day', *METRICS)
+    )
+    top_tracks = list(
+        TrackDailyStats.objects.filter(**period).values(
+            'track_id', title=F('track__title'), artist=F('track__artist')
+        ).annotate(**_sums()).order_by('-revenue', '-accepted', 'track_id')[:limit]
+    )
+    top_genres = list(
+        GenreDailyStats.objects.filter(**period).values(
+            'genre_id', name=F('genre__name')
+        ).annotate(**_sums()).order_by('-revenue', '-accepted', 'genre_id')[:limit]
+    )
+    return {
+        'date_from': date_from,
+        'date_to': date_to,
+        'totals': _totals(daily),
+        'daily': daily,
+        'top_tracks': top_tracks,
+        'top_genres': top_genres,
+    }
@@ -0,0 +1,138 @@
+import io
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import Http404
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import exception_handler
+
+from . import outbox, views
+from .authentication import VenueJWTAuthentication
+from .caching import catalog_key, catalog_response
+from .idempotency import idempotent
+from .serializers import TrackRequestSerializer
+from .throttling import TokenBucketThrottle
+
+
+def parse(request):
+    """Тело запроса как у парсеров DRF по умолчанию: JSON или форма."""
+    if request.content_type == 'application/json':
+        return JSONParser().parse(io.BytesIO(request.body))
+    return request.POST
+
+
+class AsyncAPIView(View):
+    """Асинхронное представление для ASGI с ответами и ошибками в формате DRF.
+
+    Аутентификация, лимиты и работа с базой выполняются в потоке через
+    sync_to_async, а ожидание ЮKassa - в цикле событий, не занимая поток.
+    Обработчики возвращают Response DRF, он рендерится в JSON.
+    """
+
+    rate_limit_scope = None
+    admission_pool = None
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        # Как у APIView: доступ по токену, CSRF не нужен
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            await self.initial(request)
+            response = await super().dispatch(request, *args, **kwargs)
+        except (exceptions.APIException, Http404) as exc:
+            response = self.handle_exception(request, exc)
+        return self.finalize_response(request, response)
+
+    async def initial(self, request):
+        request.user = await self.authenticate(request)
+        if self.rate_limit_scope:
+            throttle = TokenBucketThrottle()
+            if not await sync_to_async(throttle.allow_request)(request, self):
+                raise exceptions.Throttled(throttle.wait())
+
+    @staticmethod
+    async def authenticate(request):
+        # AuthenticationMiddleware подставляет пользователя сессии, а он загружается из базы синхронно
+        result = await sync_to_async(VenueJWTAuthentication().authenticate)(request)
+        return result[0] if result else AnonymousUser()
+
+    def handle_exception(self, request, exc):
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            exc.auth_header = VenueJWTAuthentication().authenticate_header(request)
+        return exception_handler(exc, {'view': self, 'request': request})
+
+    def finalize_response(self, request, response):
+        if isinstance(response, Response) and not getattr(response, 'accepted_renderer', None):
+            response.accepted_renderer = JSONRenderer()
+            response.accepted_media_type = JSONRenderer.media_type
+            response.renderer_context = {'view': self, 'request': request, 'response': response}
+        return response
+
+
+class VenueTrackListView(AsyncAPIView):
+    rate_limit_scope = 'catalog'
+    admission_pool = 'guest'
+    # Промах кеша и добавление трека владельцем обслуживает DRF-представление; лимит уже проверен
+    sync_view = staticmethod(views.VenueTrackListView.as_view(throttle_classes=[]))
+
+    async def get(self, request, venue_id):
+        entry = await sync_to_async(self.cached)(request, venue_id)
+        if entry is None:
+            return await sync_to_async(self.sync_view)(request, venue_id=venue_id)
+        return catalog_response(request, *entry)
+
+    async def post(self, request, venue_id):
+        return await sync_to_async(self.sync_view)(request, venue_id=venue_id)
+
+    @staticmethod
+    def cached(request, venue_id):
+        return cache.get(catalog_key(request, venue_id, 'tracks'))
+
+
+class TrackRequestCreateView(AsyncAPIView):
+    rate_limit_scope = 'track_request'
+    admission_pool = 'guest'
+
+    @idempotent
+    async def post(self, request, venue_id):
+        return await sync_to_async(self.create)(request, venue_id)
+
+    @staticmethod
+    def create(request, venue_id):
+        serializer = TrackRequestSerializer(data=parse(request), context={'request': request, 'venue_id': venue_id})
+        serializer.is_valid(raise_exception=True)
+        views.create_track_request(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class PaymentCreateView(AsyncAPIView):
+    @idempotent
+    async def post(self, request, payment_token):
+        call = await sync_to_async(views.enqueue_payment)(request, payment_token)
+        # Как в views.PaymentCreateView, но пока ЮKassa отвечает, поток свободен
+        if call.status != 'done':
+            claimed = await sync_to_async(outbox.claim)(call)
+            if claimed is not None:
+                await outbox.adispatch(claimed)
+                call = claimed
+        return views.payment_response(call)
+
+
+class PaymentWebhookView(AsyncAPIView):
+    kind = 'payment'
+
+    async def post(self, request):
+        return await sync_to_async(views.enqueue_webhook)(self.kind, parse(request))
+
+
+class WithdrawalWebhookView(PaymentWebhookView):
+    kind = 'payout'
@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .models import Venue
+
+
+def _state_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def get_user_state(user_id):
+    """Флаги пользователя для проверки токена, кешируются на AUTH_USER_STATE_TIMEOUT секунд.
+
+    Удаленный пользователь кешируется как пустой словарь, чтобы токены
+    удаленных аккаунтов тоже не ходили в базу.
+    """
+    key = _state_key(user_id)
+    state = cache.get(key)
+    if state is not None:
+        return state
+
+    row = User.objects.filter(pk=user_id).values(
+        'is_active', 'is_staff', 'is_superuser', 'password', 'venue__id'
+    ).first()
+    state = {}
+    if row is not None:
+        state = {
+            'is_active': row['is_active'],
+            'is_staff': row['is_staff'],
+            'is_superuser': row['is_superuser'],
+            'venue_id': row['venue__id'],
+        }
+        if api_settings.CHECK_REVOKE_TOKEN:
+            state['password_hash'] = get_md5_hash_password(row['password'])
+    cache.set(key, state, getattr(settings, 'AUTH_USER_STATE_TIMEOUT', 60))
+    return state
+
+
+def invalidate_user_state(user_id):
+    cache.delete(_state_key(user_id))
+
+
+class VenuePrincipal(TokenUser):
+    """Пользователь запроса без обращения к базе: id и заведение из токена,
+    флаги доступа из кеша get_user_state."""
+
+    def __init__(self, token, state):
+        super().__init__(token)
+        self.state = state
+
+    @cached_property
+    def venue_id(self):
+        return self.token.get('venue_id', self.state.get('venue_id'))
+
+    @cached_property
+    def is_staff(self):
+        return self.state['is_staff']
+
+    @cached_property
+    def is_superuser(self):
+        return self.state['is_superuser']
+
+
+class VenueJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication без загрузки User на каждый запрос.
+
+    Проверки simplejwt (удаленный и неактивный пользователь, смена пароля при
+    CHECK_REVOKE_TOKEN) выполняются по кешу, поэтому блокировка пользователя
+    действует не позже чем через AUTH_USER_STATE_TIMEOUT секунд, а в процессе,
+    где пользователь изменен, и при общем кеше - сразу.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        state = get_user_state(user_id)
+        if not state:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        if api_settings.CHECK_USER_IS_ACTIVE and not state['is_active']:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and (
+            validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != state.get('password_hash')
+        ):
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+        return VenuePrincipal(validated_token, state)
+
+
+def get_venue_id(user):
+    """Заведение пользователя запроса: у VenuePrincipal без запроса, у обычного User - из базы."""
+    if isinstance(user, VenuePrincipal):
+        return user.venue_id
+    if not user.is_authenticated:
+        return None
+    return Venue.objects.filter(user_id=user.pk).values_list('pk', flat=True).first()
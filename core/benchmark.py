@@ -0,0 +1,500 @@
+import logging
+import random
+import socket
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from wsgiref.simple_server import WSGIRequestHandler
+
+import requests
+from django.contrib.auth.hashers import make_password
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIServer, get_internal_wsgi_application
+from django.db import DatabaseError, connection
+
+from . import analytics, projections
+from .models import Genre, Track, TrackRequest, Venue
+from .serializers import CustomTokenObtainPairSerializer
+from .services import percentile
+from .webhooks import mark_paid, process_batch
+
+USERNAME_PREFIX = 'bench_'
+STATUSES = ('pending', 'accepted', 'rejected')
+
+
+def seed(venues=10, tracks_per_venue=200, history_per_venue=5000, rng=None):
+    """Создает заведения, каталог и историю запросов пачками, минуя сигналы и QR-коды."""
+    rng = rng or random.Random(0)
+    password = make_password(None)
+    users = User.objects.bulk_create(
+        User(username=f'{USERNAME_PREFIX}{index}', password=password) for index in range(venues)
+    )
+    venue_objects = Venue.objects.bulk_create(
+        Venue(user=user, name=f'Bench venue {index}', city='Bench', phone='+70000000000')
+        for index, user in enumerate(users)
+    )
+    genres = Genre.objects.bulk_create(Genre(name=f'Bench genre {index}') for index in range(10))
+
+    for venue in venue_objects:
+        Track.objects.bulk_create(
+            Track(
+                venue=venue,
+                genre=rng.choice(genres),
+                title=f'Track {index}',
+                artist=f'Artist {index % 50}',
+                icon='https://example.com/icon.png',
+                price=rng.choice((100, 150, 200, 300))
+            )
+            for index in range(tracks_per_venue)
+        )
+        tracks = list(Track.objects.filter(venue=venue))
+        history = []
+        for _ in range(history_per_venue):
+            track = rng.choice(tracks)
+            request_status = rng.choice(STATUSES)
+            track_request = TrackRequest(
+                track=track,
+                venue=venue,
+                user_fee=track.price,
+                status=request_status,
+                is_paid=request_status == 'accepted' or rng.random() < 0.5
+            )
+            # bulk_create не вызывает save(), снимок трека заполняется здесь
+            track_request.snapshot_track()
+            history.append(track_request)
+        TrackRequest.objects.bulk_create(history, batch_size=1000)
+        analytics.rebuild(venue.id)
+    return venue_objects
+
+
+@contextmanager
+def test_database(keepdb=False):
+    """Отдельная база для прогона, как у manage.py test; рабочие данные не затрагиваются."""
+    if connection.vendor == 'sqlite':
+        # Файл вместо базы в памяти: иначе потоки упираются в блокировки shared cache
+        connection.settings_dict['TEST']['NAME'] = str(Path(tempfile.gettempdir()) / 'benchmark.sqlite3')
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+
+def unlimited_rate_limits():
+    # Все гости бенчмарка ходят с 127.0.0.1: лимиты остаются в пути запроса, но не срабатывают
+    return {
+        scope: {name: (10 ** 9, 10.0 ** 9) for name in buckets}
+        for scope, buckets in getattr(settings, 'RATE_LIMITS', {}).items()
+    }
+
+
+def bench_venues():
+    return list(
+        Venue.objects.filter(user__username__startswith=USERNAME_PREFIX).select_related('user').order_by('id')
+    )
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, operation, elapsed, ok):
+        with self.lock:
+            self.samples[operation].append(elapsed)
+            if not ok:
+                self.errors[operation] += 1
+
+    def call(self, operation, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = method(url, timeout=30, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        self.add(operation, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    def measure(self, operation, func, *args):
+        started = time.perf_counter()
+        try:
+            func(*args)
+            ok = True
+        except DatabaseError:
+            # "database is locked" и подобные ошибки считаются отказами, как 5xx в HTTP-прогоне
+            ok = False
+        self.add(operation, time.perf_counter() - started, ok)
+
+    def report(self, duration):
+        result = {}
+        with self.lock:
+            for operation, samples in sorted(self.samples.items()):
+                ordered = sorted(samples)
+                result[operation] = {
+                    'requests': len(ordered),
+                    'errors': self.errors[operation],
+                    'rps': round(len(ordered) / duration, 2),
+                    'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+                    'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+                    'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+                    'max_ms': round(ordered[-1] * 1000, 2),
+                }
+        return result
+
+
+def guest_flow(session, base_url, venue, owner_headers, recorder, rng):
+    # Гость: каталог -> запрос трека -> платеж -> уведомление ЮKassa
+    response = recorder.call('list_tracks', session.get, f'{base_url}/api/venue/{venue.id}/tracks/')
+    if response is None or not response.json():
+        return
+    track = rng.choice(response.json())
+
+    response = recorder.call(
+        'create_request',
+        session.post,
+        f'{base_url}/api/venue/{venue.id}/request/',
+        json={'track': track['id'], 'user_fee': track['price']}
+    )
+    if response is None:
+        return
+
+    # PaymentCreateView берет заведение из request.user, поэтому платеж создается с токеном владельца
+    response = recorder.call(
+        'create_payment',
+        session.post,
+        f"{base_url}/api/payment/{response.json()['payment_token']}/",
+        headers=owner_headers
+    )
+    if response is None:
+        return
+
+    payment_id = response.json()['confirmation_url'].rstrip('/').rsplit('/', 1)[-1]
+    recorder.call(
+        'payment_webhook',
+        session.post,
+        f'{base_url}/api/payment-webhook/',
+        json={'event': 'payment.succeeded', 'object': {'id': payment_id}}
+    )
+
+
+def dj_flow(session, base_url, owner_headers, recorder, rng):
+    # DJ: очередь оплаченных запросов -> принять или отклонить первый
+    response = recorder.call(
+        'list_requests',
+        session.get,
+        f'{base_url}/api/requests/?status=pending&is_paid=true',
+        headers=owner_headers
+    )
+    if response is None or not response.json()['results']:
+        return
+    track_request = response.json()['results'][0]
+    recorder.call(
+        'update_request',
+        session.patch,
+        f"{base_url}/api/requests/{track_request['id']}/",
+        json={'status': 'accepted' if rng.random() < 0.8 else 'rejected'},
+        headers=owner_headers
+    )
+
+
+def owner_headers(venue):
+    token = CustomTokenObtainPairSerializer.get_token(venue.user).access_token
+    return {'Authorization': f'Bearer {token}'}
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class InFlight:
+    """Считает запросы, которые сервер обрабатывает одновременно: пик и среднее по времени."""
+
+    def __init__(self):
+        self.current = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.peak = self.current
+            self.total = 0.0
+            self.started = self.changed = time.monotonic()
+
+    def change(self, delta):
+        with self.lock:
+            now = time.monotonic()
+            self.total += self.current * (now - self.changed)
+            self.changed = now
+            self.current += delta
+            self.peak = max(self.peak, self.current)
+
+    def wsgi(self, application):
+        def wrapper(environ, start_response):
+            self.change(1)
+            try:
+                return application(environ, start_response)
+            finally:
+                self.change(-1)
+        return wrapper
+
+    def asgi(self, application):
+        async def wrapper(scope, receive, send):
+            self.change(1)
+            try:
+                await application(scope, receive, send)
+            finally:
+                self.change(-1)
+        return wrapper
+
+    def report(self):
+        self.change(0)
+        with self.lock:
+            return {'peak': self.peak, 'average': round(self.total / (self.changed - self.started), 2)}
+
+
+class PooledWSGIServer(WSGIServer):
+    """WSGI-сервер с фиксированным числом потоков, как воркер gunicorn --threads.
+
+    Запросы сверх threads ждут свободный поток. Сервер не наследует
+    ThreadingMixIn, поэтому Django закрывает соединение после ответа и
+    keep-alive не держит поток.
+    """
+
+    # Очередь соединений как у gunicorn и uvicorn; у socketserver по умолчанию 5
+    request_queue_size = 2048
+
+    def __init__(self, *args, threads, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='bench-wsgi')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+@contextmanager
+def quiet_requests():
+    # Ошибки 5xx попадают в отчет, трассировки в консоли только мешают
+    request_logger = logging.getLogger('django.request')
+    level = request_logger.level
+    request_logger.setLevel(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        request_logger.setLevel(level)
+
+
+@contextmanager
+def live_server(threads=None, in_flight=None):
+    """WSGI-сервер в процессе; threads - потоков на процесс, по умолчанию поток на соединение."""
+    if threads:
+        server = PooledWSGIServer(('127.0.0.1', 0), QuietRequestHandler, threads=threads)
+    else:
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler, allow_reuse_address=False)
+    application = get_internal_wsgi_application()
+    server.set_app(in_flight.wsgi(application) if in_flight else application)
+    thread = threading.Thread(target=server.serve_forever, name='bench-server', daemon=True)
+    with quiet_requests():
+        thread.start()
+        try:
+            host, port = server.server_address[:2]
+            yield f'http://{host}:{port}'
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+@contextmanager
+def live_asgi_server(in_flight=None):
+    """ASGI-сервер uvicorn в процессе, один цикл событий - как один воркер server.asgi.
+
+    Маршруты берутся из ROOT_URLCONF, для асинхронных представлений его
+    нужно переключить на server.urls_asgi.
+    """
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    application = get_asgi_application()
+    if in_flight:
+        application = in_flight.asgi(application)
+    server = uvicorn.Server(uvicorn.Config(application, lifespan='off', log_level='warning'))
+    thread = threading.Thread(target=server.run, kwargs={'sockets': [sock]}, name='bench-asgi', daemon=True)
+    with quiet_requests():
+        thread.start()
+        try:
+            while not server.started:
+                if not thread.is_alive():
+                    raise RuntimeError('ASGI-сервер не запустился')
+                time.sleep(0.01)
+            host, port = sock.getsockname()[:2]
+            yield f'http://{host}:{port}'
+        finally:
+            server.should_exit = True
+            thread.join()
+            sock.close()
+
+
+def _webhook_worker(stop, processed):
+    try:
+        while not stop.is_set():
+            results = process_batch(batch_size=100, concurrency=1)
+            processed.extend(results)
+            if not results:
+                stop.wait(0.05)
+    finally:
+        connection.close()
+
+
+def run(base_url, venues, guests=8, djs=2, duration=20.0, seed_value=0, in_flight=None):
+    """Гоняет гостевой и DJ-сценарии в потоках duration секунд и возвращает отчет.
+
+    in_flight (InFlight сервера) попадает в отчет за время нагрузки, без дообработки webhook'ов.
+    """
+    recorder = Recorder()
+    headers = {venue.id: owner_headers(venue) for venue in venues}
+    deadline = time.monotonic() + duration
+    stop = threading.Event()
+    processed = []
+
+    def guest(index):
+        rng = random.Random(seed_value * 1000 + index)
+        with requests.Session() as session:
+            while time.monotonic() < deadline:
+                venue = rng.choice(venues)
+                guest_flow(session, base_url, venue, headers[venue.id], recorder, rng)
+
+    def dj(index):
+        # У каждого DJ свое заведение, чтобы они не принимали одни и те же запросы
+        rng = random.Random(seed_value * 1000 + 500 + index)
+        venue = venues[index % len(venues)]
+        with requests.Session() as session:
+            while time.monotonic() < deadline:
+                dj_flow(session, base_url, headers[venue.id], recorder, rng)
+
+    threads = [threading.Thread(target=guest, args=(index,)) for index in range(guests)]
+    threads += [threading.Thread(target=dj, args=(index,)) for index in range(djs)]
+    worker = threading.Thread(target=_webhook_worker, args=(stop, processed), daemon=True)
+
+    started = time.monotonic()
+    if in_flight:
+        in_flight.reset()
+    worker.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    server = in_flight.report() if in_flight else None
+    stop.set()
+    worker.join()
+
+    report = {
+        'config': {'guests': guests, 'djs': djs, 'duration': duration, 'venues': len(venues)},
+        'operations': recorder.report(elapsed),
+        'webhooks': {'processed': processed.count(True), 'failed': processed.count(False)},
+    }
+    if server:
+        report['in_flight'] = server
+    return report
+
+
+def _pay_request(track_id, price):
+    # То же, что создание запроса гостем и webhook об оплате, без HTTP и ЮKassa
+    track_request = TrackRequest.objects.create(track_id=track_id, user_fee=price)
+    mark_paid(track_request.payment_token, f'bench-{track_request.id}')
+
+
+def _read_queue(venue_id):
+    list(
+        TrackRequest.objects.filter(venue_id=venue_id, status='pending', is_paid=True)
+        .values(*projections.TRACK_REQUEST_FIELDS)[:50]
+    )
+
+
+def run_writes(venues, writers=8, readers=4, duration=10.0, seed_value=0):
+    """Параллельная запись оплат и чтение очереди DJ через ORM, без HTTP-слоя.
+
+    Каждый поток работает со своим соединением, как воркеры gunicorn, поэтому
+    отчет показывает, как профиль базы переносит конкурирующие транзакции.
+    """
+    recorder = Recorder()
+    catalog = {
+        venue.id: list(Track.objects.filter(venue=venue).values_list('id', 'price'))
+        for venue in venues
+    }
+    deadline = time.monotonic() + duration
+
+    def writer(index):
+        rng = random.Random(seed_value * 1000 + index)
+        try:
+            while time.monotonic() < deadline:
+                track_id, price = rng.choice(catalog[rng.choice(venues).id])
+                recorder.measure('pay_request', _pay_request, track_id, price)
+        finally:
+            connection.close()
+
+    def reader(index):
+        rng = random.Random(seed_value * 1000 + 500 + index)
+        try:
+            while time.monotonic() < deadline:
+                recorder.measure('read_queue', _read_queue, rng.choice(venues).id)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=writer, args=(index,)) for index in range(writers)]
+    threads += [threading.Thread(target=reader, args=(index,)) for index in range(readers)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'config': {'writers': writers, 'readers': readers, 'duration': duration, 'vendor': connection.vendor},
+        'operations': recorder.report(time.monotonic() - started),
+    }
+
+
+def compare(report, baseline, tolerance=0.2, noise_ms=5.0):
+    """Возвращает список регрессий относительно сохраненного отчета.
+
+    Регрессией считается рост p99 больше чем на tolerance (и больше noise_ms)
+    или падение пропускной способности больше чем на tolerance.
+    """
+    regressions = []
+    for operation, base in baseline.get('operations', {}).items():
+        current = report['operations'].get(operation)
+        if current is None:
+            regressions.append(f'{operation}: нет данных')
+            continue
+        p99_limit = base['p99_ms'] * (1 + tolerance)
+        if current['p99_ms'] > p99_limit and current['p99_ms'] - base['p99_ms'] > noise_ms:
+            regressions.append(f"{operation}: p99 {current['p99_ms']} мс > {base['p99_ms']} мс")
+        if current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{operation}: {current['rps']} rps < {base['rps']} rps")
+        base_error_rate = base['errors'] / base['requests'] if base['requests'] else 0
+        error_rate = current['errors'] / current['requests'] if current['requests'] else 0
+        if error_rate > base_error_rate + tolerance / 10:
+            regressions.append(f'{operation}: доля ошибок {error_rate:.1%} > {base_error_rate:.1%}')
+    return regressions
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+GENRES_VERSION_KEY = 'catalog:genres:version'
+
+
+def _version_key(venue_id):
+    return f'catalog:{venue_id}:version'
+
+
+def get_version(key):
+    # Начальное значение - время, чтобы после вытеснения ключа версия не повторилась
+    return cache.get_or_set(key, time.time_ns, None)
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def catalog_version(venue_id):
+    return f'{get_version(_version_key(venue_id))}.{get_version(GENRES_VERSION_KEY)}'
+
+
+def bump_catalog_version(venue_id):
+    bump_version(_version_key(venue_id))
+
+
+def bump_genres_version():
+    bump_version(GENRES_VERSION_KEY)
+
+
+class ReferenceCache:
+    """Справочная таблица целиком в памяти процесса.
+
+    Содержимое привязано к версии в общем кеше: сигналы поднимают версию, и
+    каждый процесс перечитывает таблицу при следующем обращении. Строка,
+    которой нет в памяти, ищется в базе, поэтому строки, созданные в обход
+    сигналов, тоже находятся.
+    """
+
+    def __init__(self, model_label, version_key):
+        self.model_label = model_label
+        self.version_key = version_key
+        self._lock = threading.Lock()
+        self._version = None
+        self._objects = {}
+
+    @property
+    def model(self):
+        from django.apps import apps
+        return apps.get_model(self.model_label)
+
+    def _load(self):
+        # Версия читается до таблицы: изменение во время чтения даст новую версию и перечитывание
+        version = get_version(self.version_key)
+        if version == self._version:
+            return self._objects
+        objects = {obj.pk: obj for obj in self.model.objects.order_by('pk')}
+        with self._lock:
+            self._objects, self._version = objects, version
+        return objects
+
+    def all(self):
+        return list(self._load().values())
+
+    def snapshot(self):
+        """Таблица по pk с одним чтением версии из общего кеша: для обхода многих строк подряд."""
+        return self._load()
+
+    def get(self, pk):
+        if pk is None:
+            return None
+        obj = self._load().get(pk)
+        if obj is None:
+            obj = self.model.objects.filter(pk=pk).first()
+            if obj is not None:
+                self.invalidate()
+        return obj
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+
+genres = ReferenceCache('core.Genre', GENRES_VERSION_KEY)
+
+
+def make_etag(data):
+    body = json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode()
+    return f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+def get_or_build(key, build):
+    """Берет запись из кеша, при промахе перестраивает ее только в одном воркере.
+
+    Остальные воркеры ждут, пока запись появится, и перестраивают ее сами,
+    только если владелец блокировки не успел за CATALOG_CACHE_LOCK_TIMEOUT.
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        return entry
+
+    timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 600)
+    lock_timeout = getattr(settings, 'CATALOG_CACHE_LOCK_TIMEOUT', 5)
+    lock_key = f'{key}:lock'
+    if not cache.add(lock_key, 1, lock_timeout):
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry
+
+    try:
+        data = build()
+        entry = (make_etag(data), data)
+        cache.set(key, entry, timeout)
+    finally:
+        cache.delete(lock_key)
+    return entry
+
+
+def catalog_key(request, venue_id, name):
+    query = hashlib.sha1(request.META.get('QUERY_STRING', '').encode()).hexdigest()
+    return f'catalog:{venue_id}:{catalog_version(venue_id)}:{name}:{query}'
+
+
+def catalog_response(request, etag, data):
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(data, headers=headers)
+
+
+def cached_catalog_response(request, venue_id, name, build):
+    return catalog_response(request, *get_or_build(catalog_key(request, venue_id, name), build))
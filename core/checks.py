@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """Кеш по умолчанию должен быть общим для всех воркеров.
+
+    Кеш процесса не виден другим воркерам: версии каталога и жанров в них
+    устаревают, а блокировка cache.add не мешает перестраивать каталог в каждом.
+    """
+    # DEBUG задается строкой из окружения, как и в server/settings.py
+    if str(settings.DEBUG).lower() == 'true' or settings.CACHES['default']['BACKEND'] not in LOCAL_BACKENDS:
+        return []
+    return [Error(
+        'Кеш по умолчанию локален для процесса.',
+        hint='Задайте CACHE_BACKEND: Redis, Memcached или django.core.cache.backends.db.DatabaseCache '
+             '(python manage.py createcachetable).',
+        id='core.E001',
+    )]
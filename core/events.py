@@ -0,0 +1,211 @@
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction as db_transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBroker:
+    """Рассылка событий внутри одного процесса.
+
+    Используется в тестах и при запуске с одним воркером. Слушатели
+    вызываются синхронно из потока, опубликовавшего событие.
+    """
+
+    history_size = 100
+
+    def __init__(self):
+        self._listeners = defaultdict(dict)
+        self._history = defaultdict(lambda: deque(maxlen=self.history_size))
+        self._ids = itertools.count(1)
+        self._tokens = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def publish(self, venue_id, event, payload):
+        message = {'id': next(self._ids), 'event': event, 'data': payload}
+        self.dispatch(venue_id, message)
+        return message
+
+    def dispatch(self, venue_id, message):
+        with self._lock:
+            self._history[venue_id].append(message)
+            listeners = list(self._listeners.get(venue_id, {}).values())
+        for callback in listeners:
+            callback(message)
+
+    def add_listener(self, venue_id, callback):
+        with self._lock:
+            token = next(self._tokens)
+            self._listeners[venue_id][token] = callback
+        return venue_id, token
+
+    def remove_listener(self, handle):
+        venue_id, token = handle
+        with self._lock:
+            self._listeners[venue_id].pop(token, None)
+            if not self._listeners[venue_id]:
+                del self._listeners[venue_id]
+
+    def replay(self, venue_id, after_id):
+        with self._lock:
+            return [m for m in self._history.get(venue_id, ()) if m['id'] > after_id]
+
+
+class DatabaseBroker(LocalBroker):
+    """Рассылка событий между процессами через таблицу VenueEvent.
+
+    Каждый процесс держит один фоновый поток, который забирает новые
+    события одним запросом по первичному ключу и раздает их локальным
+    подписчикам, поэтому нагрузка на БД не зависит от числа подключений.
+
+    id выдается при вставке, а виден после коммита: событие более медленной
+    транзакции может появиться позже события с большим id. Поэтому опрос
+    перечитывает id, выданные за последние EVENTS_POLL_LOOKBACK секунд,
+    а уже разосланные события отбрасывает по id.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._poller = None
+        self._last_id = None
+        self._floor = None
+        self._marks = deque()
+        self._seen = set()
+        self._last_prune = 0
+
+    def publish(self, venue_id, event, payload):
+        from .models import VenueEvent
+
+        venue_event = VenueEvent.objects.create(venue_id=venue_id, event=event, payload=payload)
+        return {'id': venue_event.id, 'event': event, 'data': payload}
+
+    def add_listener(self, venue_id, callback):
+        handle = super().add_listener(venue_id, callback)
+        self._ensure_poller()
+        return handle
+
+    def replay(self, venue_id, after_id):
+        from .models import VenueEvent
+
+        events = VenueEvent.objects.filter(venue_id=venue_id, id__gt=after_id).order_by('id')
+        return [
+            {'id': e.id, 'event': e.event, 'data': e.payload}
+            for e in events[:self.history_size]
+        ]
+
+    def poll(self):
+        from .models import VenueEvent
+
+        if self._last_id is None:
+            self._last_id = VenueEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            self._floor = self._last_id
+
+        # id не больше floor выданы раньше чем lookback секунд назад, их транзакции уже завершились
+        now = time.monotonic()
+        lookback = getattr(settings, 'EVENTS_POLL_LOOKBACK', 5.0)
+        while self._marks and self._marks[0][0] <= now - lookback:
+            self._floor = self._marks.popleft()[1]
+        self._seen = {event_id for event_id in self._seen if event_id > self._floor}
+
+        events = VenueEvent.objects.filter(id__gt=self._floor).order_by('id').values(
+            'id', 'venue_id', 'event', 'payload'
+        )
+        for e in events.iterator():
+            if e['id'] in self._seen:
+                continue
+            self._seen.add(e['id'])
+            self._last_id = max(self._last_id, e['id'])
+            if e['venue_id'] in self._listeners:
+                self.dispatch(e['venue_id'], {'id': e['id'], 'event': e['event'], 'data': e['payload']})
+        self._marks.append((now, self._last_id))
+        self._prune()
+
+    def _prune(self):
+        from .models import VenueEvent
+
+        if time.monotonic() - self._last_prune < 60:
+            return
+        self._last_prune = time.monotonic()
+        retention = getattr(settings, 'EVENTS_RETENTION', timedelta(hours=6))
+        VenueEvent.objects.filter(created_at__lt=timezone.now() - retention).delete()
+
+    def _ensure_poller(self):
+        with self._lock:
+            if self._poller is not None and self._poller.is_alive():
+                return
+            self._poller = threading.Thread(target=self._run, name='venue-events', daemon=True)
+            self._poller.start()
+
+    def _run(self):
+        interval = getattr(settings, 'EVENTS_POLL_INTERVAL', 1.0)
+        while True:
+            close_old_connections()
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Не удалось получить события заведений')
+            time.sleep(interval)
+
+
+_brokers = {}
+
+
+def get_broker():
+    path = getattr(settings, 'EVENTS_BROKER', 'core.events.DatabaseBroker')
+    if path not in _brokers:
+        _brokers[path] = import_string(path)()
+    return _brokers[path]
+
+
+def publish_request_event(track_request, event):
+    from .serializers import TrackRequestSerializer
+
+    venue_id = track_request.venue_id
+    payload = json.loads(json.dumps(TrackRequestSerializer(track_request).data, cls=DjangoJSONEncoder))
+    db_transaction.on_commit(lambda: get_broker().publish(venue_id, event, payload))
+
+
+def format_sse(message):
+    data = json.dumps(message['data'], ensure_ascii=False, cls=DjangoJSONEncoder)
+    return f"id: {message['id']}\nevent: {message['event']}\ndata: {data}\n\n"
+
+
+async def event_stream(venue_id, last_event_id=0):
+    broker = get_broker()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    handle = broker.add_listener(
+        venue_id, lambda message: loop.call_soon_threadsafe(queue.put_nowait, message)
+    )
+    heartbeat = getattr(settings, 'EVENTS_HEARTBEAT', 15)
+    try:
+        yield 'retry: 3000\n\n'
+        replayed = set()
+        for message in await sync_to_async(broker.replay)(venue_id, last_event_id):
+            replayed.add(message['id'])
+            yield format_sse(message)
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield ': ping\n\n'
+                continue
+            # Живое событие может повторять отданное из истории; меньший id,
+            # закоммиченный позже, не значит повтор
+            if message['id'] in replayed:
+                continue
+            yield format_sse(message)
+    finally:
+        broker.remove_listener(handle)
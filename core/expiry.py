@@ -0,0 +1,83 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from .models import ArchivedTrackRequest, TrackRequest
+
+ARCHIVED_FIELDS = (
+    'id', 'track_id', 'venue_id', 'user_fee', 'status', 'is_paid', 'created_at',
+    'transaction_id', 'payment_token', 'payment_id',
+    'track_title', 'track_artist', 'track_icon', 'track_genre_id', 'track_genre_name', 'min_fee',
+)
+
+
+def expire_batch(cutoff, batch_size):
+    """Помечает expired до batch_size неоплаченных pending-запросов, созданных раньше cutoff.
+
+    Один короткий UPDATE по первичному ключу. Условие повторяется в UPDATE,
+    поэтому запрос, оплаченный между выборкой и обновлением, не истекает.
+    """
+    ids = list(
+        TrackRequest.objects.filter(status='pending', is_paid=False, created_at__lt=cutoff)
+        .order_by('created_at').values_list('id', flat=True)[:batch_size]
+    )
+    if not ids:
+        return 0
+    return TrackRequest.objects.filter(pk__in=ids, status='pending', is_paid=False).update(status='expired')
+
+
+def archive_batch(cutoff, batch_size):
+    """Переносит до batch_size истекших запросов, созданных раньше cutoff, в ArchivedTrackRequest."""
+    with db_transaction.atomic():
+        rows = list(
+            TrackRequest.objects.select_for_update().filter(status='expired', created_at__lt=cutoff)
+            .order_by('created_at').values(*ARCHIVED_FIELDS)[:batch_size]
+        )
+        if not rows:
+            return 0
+        ArchivedTrackRequest.objects.bulk_create(
+            [ArchivedTrackRequest(**row) for row in rows], ignore_conflicts=True
+        )
+        TrackRequest.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+    return len(rows)
+
+
+def restore(payment_token):
+    """Возвращает запрос из архива в TrackRequest со статусом pending.
+
+    Нужен для оплаты, подтвержденной уже после архивации: деньги списаны,
+    и запрос должен попасть в очередь DJ. Вызывается внутри транзакции.
+    """
+    archived = ArchivedTrackRequest.objects.select_for_update().filter(payment_token=payment_token).values(
+        *ARCHIVED_FIELDS
+    ).first()
+    if archived is None:
+        raise TrackRequest.DoesNotExist
+    ArchivedTrackRequest.objects.filter(pk=archived['id']).delete()
+    TrackRequest.objects.create(**{**archived, 'status': 'pending'})
+    # auto_now_add перезаписывает created_at при создании
+    TrackRequest.objects.filter(pk=archived['id']).update(created_at=archived['created_at'])
+    return TrackRequest.objects.select_for_update().get(pk=archived['id'])
+
+
+def run(batch_size=1000, pause=0.0, now=None):
+    """Истекает и архивирует запросы пакетами; между пакетами пауза, чтобы не держать запись."""
+    now = now or timezone.now()
+    ttl = getattr(settings, 'TRACK_REQUEST_TTL', timedelta(hours=2))
+    archive_after = getattr(settings, 'TRACK_REQUEST_ARCHIVE_AFTER', timedelta(days=1))
+    totals = {'expired': 0, 'archived': 0}
+    for name, step, cutoff in (
+        ('expired', expire_batch, now - ttl),
+        ('archived', archive_batch, now - ttl - archive_after),
+    ):
+        while True:
+            count = step(cutoff, batch_size)
+            totals[name] += count
+            if count < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+    return totals
@@ -0,0 +1,125 @@
+import csv
+import json
+
+from asgiref.sync import sync_to_async
+from django.db.models import DateField, DateTimeField
+from rest_framework.renderers import BaseRenderer
+
+from .models import Transaction, WithdrawalRequest
+
+CHUNK_SIZE = 2000
+
+EXPORTS = {
+    'transactions': (
+        Transaction,
+        ['id', 'venue_id', 'amount', 'transaction_type', 'track_request_id', 'created_at'],
+    ),
+    # Токен карты в выгрузку не попадает
+    'withdrawals': (
+        WithdrawalRequest,
+        ['id', 'venue_id', 'amount', 'fee', 'status', 'yookassa_payout_id', 'created_at'],
+    ),
+}
+
+
+class CSVRenderer(BaseRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Используется только для ошибок, сама выгрузка отдается потоком
+        return json.dumps(data, ensure_ascii=False).encode()
+
+
+class NDJSONRenderer(CSVRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+RENDERERS = {renderer.format: renderer for renderer in (CSVRenderer, NDJSONRenderer)}
+
+
+def export_queryset(kind, venue_ids=None, date_from=None, date_to=None):
+    model, fields = EXPORTS[kind]
+    queryset = model.objects.all()
+    if venue_ids is not None:
+        queryset = queryset.filter(venue_id__in=venue_ids)
+    if date_from is not None:
+        queryset = queryset.filter(created_at__gte=date_from)
+    if date_to is not None:
+        queryset = queryset.filter(created_at__lt=date_to)
+    # Порядок по id совпадает с порядком записи и идет по индексу (venue, id)
+    return queryset.order_by('id').values_list(*fields)
+
+
+def _plain_rows(model, fields, rows):
+    # Даты переводятся в ISO 8601, остальные значения уже годятся для CSV и JSON
+    positions = [
+        index for index, name in enumerate(fields)
+        if isinstance(model._meta.get_field(name), (DateField, DateTimeField))
+    ]
+    for row in rows:
+        row = list(row)
+        for index in positions:
+            if row[index] is not None:
+                row[index] = row[index].isoformat()
+        yield row
+
+
+class _Line:
+    def write(self, value):
+        return value
+
+
+def _batched(lines):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= CHUNK_SIZE:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def iter_csv(fields, rows):
+    writer = csv.writer(_Line())
+    yield writer.writerow(fields)
+    yield from _batched(map(writer.writerow, rows))
+
+
+def iter_ndjson(fields, rows):
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    yield from _batched(encode(dict(zip(fields, row))) + '\n' for row in rows)
+
+
+def stream_export(kind, fmt, **filters):
+    """Отдает выгрузку кусками строк.
+
+    Строки читаются через iterator(): на PostgreSQL это серверный курсор,
+    поэтому память не зависит от размера выгрузки. Запрос выполняется только
+    при первом обращении к генератору, так что заголовки ответа уходят сразу.
+    """
+    model, fields = EXPORTS[kind]
+    rows = _plain_rows(model, fields, export_queryset(kind, **filters).iterator(chunk_size=CHUNK_SIZE))
+    if fmt == 'csv':
+        return iter_csv(fields, rows)
+    return iter_ndjson(fields, rows)
+
+
+async def astream(chunks):
+    """Асинхронная обертка над stream_export для ASGI.
+
+    Синхронный итератор Django под ASGI собирает в список целиком, поэтому
+    куски читаются по одному через sync_to_async: курсор и соединение
+    остаются в одном потоке, а первый кусок уходит клиенту сразу.
+    """
+    take = sync_to_async(next)
+    done = object()
+    try:
+        while (chunk := await take(chunks, done)) is not done:
+            yield chunk
+    finally:
+        # Клиент мог оборвать загрузку: серверный курсор закрывается в том же потоке
+        await sync_to_async(chunks.close)()
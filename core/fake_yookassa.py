@@ -0,0 +1,147 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.utils import timezone
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение по таймауту - для имитации медленного провайдера это норма
+        pass
+
+
+class FakeYooKassa:
+    """Локальная замена API ЮKassa для нагрузочных тестов без сети.
+
+    Платежи и выплаты хранятся в памяти. Созданный платеж при следующем
+    запросе статуса считается оплаченным, если включен auto_succeed.
+    latency, error_rate и accepted_rate (доля ответов 202 - запрос еще
+    обрабатывается) позволяют имитировать деградацию провайдера.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, auto_succeed=True, accepted_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.accepted_rate = accepted_rate
+        self.auto_succeed = auto_succeed
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.server = QuietHTTPServer((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-yookassa', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def create(self, kind, body):
+        object_id = f'{kind[:-1]}_{uuid.uuid4().hex}'
+        obj = {
+            'id': object_id,
+            'status': 'pending',
+            'amount': body.get('amount', {}),
+            'description': body.get('description', ''),
+            'metadata': body.get('metadata', {}),
+            'created_at': timezone.now().isoformat(),
+            'test': True,
+        }
+        if kind == 'payments':
+            obj['paid'] = False
+            obj['confirmation'] = {
+                'type': 'redirect',
+                'confirmation_url': f'{self.url}/checkout/{object_id}',
+            }
+        with self.lock:
+            self.objects[object_id] = obj
+        return obj
+
+    def find(self, object_id):
+        with self.lock:
+            obj = self.objects.get(object_id)
+            if obj is not None and self.auto_succeed and obj['status'] == 'pending':
+                obj['status'] = 'succeeded'
+                if 'paid' in obj:
+                    obj['paid'] = True
+            return obj
+
+    def set_status(self, object_id, status):
+        with self.lock:
+            self.objects[object_id]['status'] = status
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, code, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _simulate(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.error_rate and random.random() < fake.error_rate:
+                    self._reply(500, {'type': 'error', 'code': 'internal_server_error'})
+                    return False
+                if fake.accepted_rate and random.random() < fake.accepted_rate:
+                    self._reply(202, {'type': 'processing', 'retry_after': 100})
+                    return False
+                return True
+
+            def _route(self):
+                parts = self.path.split('?')[0].strip('/').split('/')
+                if parts and parts[0] == 'v3':
+                    parts = parts[1:]
+                return parts
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if not self._simulate():
+                    return
+                parts = self._route()
+                if len(parts) == 1 and parts[0] in ('payments', 'payouts'):
+                    self._reply(200, fake.create(parts[0], body))
+                else:
+                    self._reply(404, {'type': 'error', 'code': 'not_found'})
+
+            def do_GET(self):
+                if not self._simulate():
+                    return
+                parts = self._route()
+                obj = fake.find(parts[1]) if len(parts) == 2 and parts[0] in ('payments', 'payouts') else None
+                if obj is None:
+                    self._reply(404, {'type': 'error', 'code': 'not_found'})
+                else:
+                    self._reply(200, obj)
+
+        return Handler
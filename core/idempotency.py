@@ -0,0 +1,206 @@
+import functools
+import hashlib
+import inspect
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction as db_transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+PRUNE_INTERVAL = 60
+PRUNE_BATCH = 1000
+
+_last_prune = 0.0
+
+
+class _Taken(Exception):
+    pass
+
+
+def _sha256(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _owner(request):
+    # Гости без токена различаются только ключом: IP на мобильной сети между повторами меняется
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return 'guest'
+
+
+def _lookup(digest):
+    return IdempotencyKey.objects.filter(digest=digest, expires_at__gt=timezone.now()).first()
+
+
+def _lease():
+    return timezone.now() + getattr(settings, 'IDEMPOTENCY_KEY_LEASE', timedelta(minutes=1))
+
+
+def _replay(record, fingerprint):
+    # Занятая, но еще не записанная строка может быть и незакоммиченной, тогда ее не видно
+    if record is not None and record.fingerprint != fingerprint:
+        return Response(
+            {"detail": "Ключ идемпотентности уже использован с другим запросом"},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    if record is None or record.status_code is None:
+        return Response(
+            {"detail": "Запрос с этим ключом еще выполняется"},
+            status=status.HTTP_409_CONFLICT
+        )
+    return Response(record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+
+def _claim(digest, fingerprint):
+    IdempotencyKey.objects.filter(digest=digest, expires_at__lte=timezone.now()).delete()
+    try:
+        with db_transaction.atomic():
+            return IdempotencyKey.objects.create(
+                digest=digest,
+                fingerprint=fingerprint,
+                expires_at=timezone.now() + getattr(settings, 'IDEMPOTENCY_KEY_TTL', timedelta(hours=24)),
+                locked_until=_lease()
+            )
+    except IntegrityError:
+        raise _Taken
+
+
+def _take_over(record, fingerprint):
+    """Забирает ключ, чей запрос не записал ответ до конца аренды: скорее всего, процесс упал.
+
+    None - ключ еще занят или его уже забрал другой повтор.
+    """
+    if record.status_code is not None or record.fingerprint != fingerprint:
+        return None
+    now = timezone.now()
+    if record.locked_until is not None and record.locked_until > now:
+        return None
+    locked_until = _lease()
+    taken = IdempotencyKey.objects.filter(
+        pk=record.pk, status_code__isnull=True, locked_until=record.locked_until
+    ).update(locked_until=locked_until)
+    if not taken:
+        return None
+    record.locked_until = locked_until
+    return record
+
+
+def begin(request):
+    """Занимает Idempotency-Key запроса до вызова обработчика.
+
+    Возвращает (record, response): response - готовый ответ (повтор, 409,
+    422 или 400), который нужно вернуть вместо вызова обработчика. Без
+    заголовка оба значения None.
+    """
+    key = request.headers.get(HEADER)
+    if not key:
+        return None, None
+    if len(key) > MAX_KEY_LENGTH:
+        return None, Response(
+            {"detail": f"{HEADER} длиннее {MAX_KEY_LENGTH} символов"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    digest = _sha256(request.method, request.path, _owner(request), key)
+    fingerprint = _sha256(request.body)
+    record = _lookup(digest)
+    if record is not None:
+        taken = _take_over(record, fingerprint)
+        if taken is not None:
+            return taken, None
+        return None, _replay(record, fingerprint)
+    try:
+        return _claim(digest, fingerprint), None
+    except _Taken:
+        return None, _replay(_lookup(digest), fingerprint)
+
+
+def _owned(record):
+    # Запрос, у которого ключ забрали по истечении аренды, свой результат не записывает
+    return IdempotencyKey.objects.filter(pk=record.pk, locked_until=record.locked_until)
+
+
+def finish(record, response):
+    if record is None:
+        return
+    if status.is_success(response.status_code):
+        _owned(record).update(status_code=response.status_code, response=response.data, locked_until=None)
+    else:
+        _owned(record).delete()
+    _prune()
+
+
+def abandon(record):
+    if record is not None:
+        _owned(record).delete()
+
+
+def run(request, handler):
+    """Выполняет handler не больше одного раза на Idempotency-Key.
+
+    Ключ занимается отдельной короткой записью до вызова handler, а ответ
+    сохраняется после: handler сам управляет своими транзакциями и не держит
+    их открытыми ради ключа. Параллельный повтор, пока ключ занят, получает
+    409. Сохраняются только успешные ответы, после ошибки ключ освобождается.
+    Если процесс упал до записи ответа, повтор после IDEMPOTENCY_KEY_LEASE
+    выполняет handler заново.
+    """
+    record, response = begin(request)
+    if response is not None:
+        return response
+    try:
+        response = handler()
+    except BaseException:
+        abandon(record)
+        raise
+    finish(record, response)
+    return response
+
+
+async def arun(request, handler):
+    """run для асинхронного handler: ключ занимается и сохраняется в потоке."""
+    record, response = await sync_to_async(begin)(request)
+    if response is not None:
+        return response
+    try:
+        response = await handler()
+    except BaseException:
+        await sync_to_async(abandon)(record)
+        raise
+    await sync_to_async(finish)(record, response)
+    return response
+
+
+def _prune():
+    global _last_prune
+    if time.monotonic() - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = time.monotonic()
+    ids = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).values_list('id', flat=True)[:PRUNE_BATCH]
+    IdempotencyKey.objects.filter(pk__in=list(ids)).delete()
+
+
+def idempotent(method):
+    """Декоратор POST-обработчика представления: повтор с тем же Idempotency-Key получает сохраненный ответ."""
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(self, request, *args, **kwargs):
+            return await arun(request, lambda: method(self, request, *args, **kwargs))
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        return run(request, lambda: method(self, request, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,218 @@
+import csv
+import io
+import json
+import re
+from itertools import islice
+
+from django.db import connection, transaction as db_transaction
+from rest_framework import serializers
+
+from .caching import bump_catalog_version, bump_genres_version, genres
+from .models import Genre, Track
+from .serializers import TrackImportRowSerializer
+
+FORMATS = ('csv', 'json', 'ndjson')
+MAX_REPORTED_ERRORS = 1000
+_WHITESPACE = re.compile(r'[\s,]*')
+
+
+def detect_format(filename, default='csv'):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if extension == 'jsonl':
+        return 'ndjson'
+    return extension if extension in FORMATS else default
+
+
+def iter_json_array(text_stream, read_size=65536):
+    # Читает массив JSON по частям, не загружая файл в память целиком
+    decoder = json.JSONDecoder()
+    buffer, position, eof = '', 0, False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = text_stream.read(read_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    while True:
+        position = _WHITESPACE.match(buffer, position).end()
+        if position < len(buffer) or eof:
+            break
+        fill()
+    if buffer[position:position + 1] != '[':
+        raise ValueError('Ожидается массив JSON')
+    position += 1
+
+    while True:
+        position = _WHITESPACE.match(buffer, position).end()
+        if position >= len(buffer):
+            if eof:
+                raise ValueError('Массив JSON не закрыт')
+            fill()
+            continue
+        if buffer[position] == ']':
+            return
+        try:
+            obj, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise ValueError('Некорректный JSON')
+            fill()
+            continue
+        if end == len(buffer) and not eof:
+            # Число на границе прочитанного куска могло оборваться
+            fill()
+            continue
+        position = end
+        yield obj
+
+
+def iter_ndjson(text_stream):
+    for line in text_stream:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield None
+
+
+def iter_rows(binary_stream, fmt):
+    text_stream = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        # Пустые ячейки CSV считаются отсутствующими полями
+        return (
+            {key: value for key, value in row.items() if key and value not in ('', None)}
+            for row in csv.DictReader(text_stream)
+        )
+    if fmt == 'ndjson':
+        return iter_ndjson(text_stream)
+    return iter_json_array(text_stream)
+
+
+class TrackImporter:
+    def __init__(self, venue, dry_run=False, chunk_size=1000):
+        self.venue = venue
+        self.dry_run = dry_run
+        self.chunk_size = chunk_size
+        # Один экземпляр на весь импорт: поля сериализатора не строятся заново для каждой строки
+        self.row_serializer = TrackImportRowSerializer()
+        self.genres_by_name = {}
+        self.genre_ids = set()
+        self.report = {
+            'dry_run': dry_run,
+            'rows': 0,
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'failed': 0,
+            'genres_created': [],
+            'errors': [],
+        }
+
+    def run(self, rows):
+        for genre in genres.all():
+            self.genres_by_name.setdefault(genre.name, genre.pk)
+            self.genre_ids.add(genre.pk)
+
+        rows = iter(rows)
+        number = 0
+        with db_transaction.atomic():
+            while True:
+                chunk = list(islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                self.import_chunk(enumerate(chunk, start=number + 1))
+                number += len(chunk)
+            if self.dry_run:
+                db_transaction.set_rollback(True)
+
+        self.report['rows'] = number
+        if not self.dry_run and (self.report['created'] or self.report['updated']):
+            bump_catalog_version(self.venue.pk)
+        return self.report
+
+    def error(self, number, errors):
+        self.report['failed'] += 1
+        if len(self.report['errors']) < MAX_REPORTED_ERRORS:
+            self.report['errors'].append({'row': number, 'errors': errors})
+
+    def import_chunk(self, numbered_rows):
+        valid = {}
+        for number, row in numbered_rows:
+            if not isinstance(row, dict):
+                self.error(number, {'non_field_errors': ['Строка должна быть объектом']})
+                continue
+            try:
+                data = self.row_serializer.run_validation(row)
+            except serializers.ValidationError as exc:
+                self.error(number, exc.detail)
+                continue
+            if 'genre_id' in data and data['genre_id'] not in self.genre_ids:
+                self.error(number, {'genre_id': ['Жанр не найден']})
+                continue
+            # Повтор трека в файле перезаписывает предыдущую строку
+            valid[(data['title'], data['artist'])] = data
+
+        if not valid:
+            return
+        self.resolve_genres(valid.values())
+
+        existing = {
+            (track.title, track.artist): track
+            for track in Track.objects.filter(
+                venue=self.venue, title__in={title for title, _ in valid}
+            )
+        }
+        to_create, to_update = [], []
+        for key, data in valid.items():
+            genre_id = data.get('genre_id') or self.genres_by_name[data['genre']]
+            track = existing.get(key)
+            if track is None:
+                to_create.append(Track(
+                    venue=self.venue,
+                    genre_id=genre_id,
+                    title=data['title'],
+                    artist=data['artist'],
+                    icon=data['icon'],
+                    price=data['price']
+                ))
+            elif (track.genre_id, track.icon, track.price) != (genre_id, data['icon'], data['price']):
+                to_update.append((genre_id, data['icon'], data['price'], track.pk))
+            else:
+                self.report['unchanged'] += 1
+
+        Track.objects.bulk_create(to_create)
+        if to_update:
+            # executemany заметно быстрее, чем CASE WHEN из bulk_update
+            table = Track._meta.db_table
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f'UPDATE {table} SET genre_id = %s, icon = %s, price = %s WHERE id = %s',
+                    to_update
+                )
+        self.report['created'] += len(to_create)
+        self.report['updated'] += len(to_update)
+
+    def resolve_genres(self, rows):
+        missing = {
+            data['genre'] for data in rows
+            if not data.get('genre_id') and data['genre'] not in self.genres_by_name
+        }
+        if not missing:
+            return
+        created = Genre.objects.bulk_create([Genre(name=name) for name in sorted(missing)])
+        # bulk_create не шлет сигналы, версию кеша жанров поднимаем сами
+        bump_genres_version()
+        db_transaction.on_commit(bump_genres_version)
+        if created and created[0].pk is None:
+            created = Genre.objects.filter(name__in=missing)
+        for genre in created:
+            self.genres_by_name[genre.name] = genre.pk
+            self.genre_ids.add(genre.pk)
+        self.report['genres_created'].extend(sorted(missing))
+
+
+def import_tracks(venue, binary_stream, fmt='csv', dry_run=False, chunk_size=1000):
+    return TrackImporter(venue, dry_run=dry_run, chunk_size=chunk_size).run(iter_rows(binary_stream, fmt))
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+
+from django.db import transaction as db_transaction
+from django.db.models import IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import BalanceCheckpoint, Transaction, Venue
+
+SETTLE_BATCH_SIZE = 1000
+
+
+def _unsettled_sum():
+    return Coalesce(
+        Subquery(
+            Transaction.objects.filter(
+                venue_id=OuterRef('venue_id'), settled=False
+            ).order_by().values('venue_id').annotate(total=Sum('amount')).values('total')[:1],
+            output_field=IntegerField()
+        ),
+        Value(0)
+    )
+
+
+def _get_checkpoint(venue_id):
+    # Без снимка баланс считается по всему журналу: Venue.balance мог уже включать
+    # часть транзакций, и сложение с ними учло бы их дважды
+    checkpoint, _ = BalanceCheckpoint.objects.get_or_create(venue_id=venue_id)
+    return checkpoint
+
+
+def get_balance(venue_id):
+    row = BalanceCheckpoint.objects.filter(venue_id=venue_id).annotate(
+        unsettled=_unsettled_sum()
+    ).values_list('balance', 'unsettled').first()
+    if row is None:
+        _get_checkpoint(venue_id)
+        return get_balance(venue_id)
+    return row[0] + row[1]
+
+
+def get_balances(venue_ids):
+    return {
+        venue_id: balance + unsettled
+        for venue_id, balance, unsettled in BalanceCheckpoint.objects.filter(
+            venue_id__in=venue_ids
+        ).annotate(unsettled=_unsettled_sum()).values_list('venue_id', 'balance', 'unsettled')
+    }
+
+
+@contextmanager
+def locked_balance(venue_id):
+    """Блокирует списания заведения и возвращает актуальный баланс.
+
+    Пополнения пишутся в журнал без блокировок и могут только увеличить
+    баланс, поэтому проверка на перерасход остается верной, если все
+    списания идут внутри этого блока.
+
+    Сумма журнала считается отдельным запросом уже после блокировки: в
+    READ COMMITTED подзапрос в том же SELECT ... FOR UPDATE видел бы снимок
+    до ожидания блокировки и не учел бы списание, закоммиченное за это время.
+    """
+    locked = BalanceCheckpoint.objects.select_for_update()
+    with db_transaction.atomic():
+        try:
+            checkpoint = locked.get(venue_id=venue_id)
+        except BalanceCheckpoint.DoesNotExist:
+            _get_checkpoint(venue_id)
+            checkpoint = locked.get(venue_id=venue_id)
+        unsettled = Transaction.objects.filter(
+            venue_id=venue_id, settled=False
+        ).aggregate(total=Sum('amount'))['total'] or 0
+        yield checkpoint.balance + unsettled
+
+
+def record(venue_id, amount, transaction_type, track_request=None):
+    return Transaction.objects.create(
+        venue_id=venue_id,
+        amount=amount,
+        transaction_type=transaction_type,
+        track_request=track_request
+    )
+
+
+def record_deposits(track_requests):
+    return Transaction.objects.bulk_create([
+        Transaction(
+            venue_id=track_request.venue_id,
+            amount=track_request.user_fee,
+            transaction_type='deposit',
+            track_request=track_request
+        )
+        for track_request in track_requests
+    ])
+
+
+def record_refunds(withdrawals):
+    return Transaction.objects.bulk_create([
+        Transaction(venue_id=withdrawal.venue_id, amount=withdrawal.amount, transaction_type='refund')
+        for withdrawal in withdrawals
+    ])
+
+
+def advance_checkpoint(venue_id):
+    """Сворачивает в контрольную точку все закоммиченные и еще не учтенные транзакции.
+
+    Учтенные строки помечаются settled по id, прочитанным под блокировкой точки:
+    строка, закоммиченная позже, останется неучтенной до следующего запуска,
+    а не выпадет из баланса, как при границе по id или времени.
+    """
+    with db_transaction.atomic():
+        _get_checkpoint(venue_id)
+        checkpoint = BalanceCheckpoint.objects.select_for_update().get(venue_id=venue_id)
+        pending = Transaction.objects.filter(venue_id=venue_id, settled=False).order_by('id')
+        delta = 0
+        while batch := list(pending.values_list('id', 'amount')[:SETTLE_BATCH_SIZE]):
+            Transaction.objects.filter(pk__in=[pk for pk, _ in batch]).update(settled=True)
+            delta += sum(amount for _, amount in batch)
+        if delta:
+            checkpoint.balance += delta
+            checkpoint.save(update_fields=['balance', 'updated_at'])
+            Venue.objects.filter(pk=venue_id).update(balance=checkpoint.balance)
+        return checkpoint
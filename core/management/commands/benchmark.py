@@ -0,0 +1,105 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from core import benchmark
+from core.fake_yookassa import FakeYooKassa
+from core.services import breaker, stats
+
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / 'benchmarks' / 'baseline.json'
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный прогон гостевого и DJ-сценариев на отдельной базе с локальной ЮKassa'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--venues', type=int, default=10)
+        parser.add_argument('--tracks', type=int, default=200, help='Треков на заведение')
+        parser.add_argument('--history', type=int, default=5000, help='Исторических запросов на заведение')
+        parser.add_argument('--guests', type=int, default=8, help='Параллельных гостей')
+        parser.add_argument('--djs', type=int, default=2, help='Параллельных DJ')
+        parser.add_argument('--duration', type=float, default=20.0, help='Длительность прогона (сек.)')
+        parser.add_argument('--provider-latency', type=float, default=0.05, help='Задержка ответа ЮKassa (сек.)')
+        parser.add_argument(
+            '--server', choices=['wsgi', 'asgi'], default='wsgi',
+            help='wsgi - server.wsgi, asgi - server.asgi с асинхронными представлениями (uvicorn)'
+        )
+        parser.add_argument(
+            '--threads', type=int, default=0,
+            help='Потоков WSGI-сервера на процесс, как gunicorn --threads; 0 - поток на соединение'
+        )
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help='Отчет для сравнения')
+        parser.add_argument('--save-baseline', action='store_true', help='Сохранить отчет как новый эталон')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Допустимое ухудшение (доля)')
+        parser.add_argument('--output', help='Записать отчет в JSON-файл')
+        parser.add_argument('--keepdb', action='store_true', help='Не удалять базу прогона')
+
+    def handle(self, *args, **options):
+        with benchmark.test_database(options['keepdb']):
+            report = self.run_benchmark(options)
+
+        self.print_report(report)
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+        baseline_path = Path(options['baseline'])
+        if options['save_baseline']:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(report, indent=2, ensure_ascii=False) + '\n')
+            self.stdout.write(f'Эталон сохранен: {baseline_path}')
+        elif baseline_path.exists():
+            regressions = benchmark.compare(report, json.loads(baseline_path.read_text()), options['tolerance'])
+            if regressions:
+                raise CommandError('Регрессия относительно эталона:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS(f'Регрессий относительно {baseline_path} нет'))
+        else:
+            self.stdout.write(f'Эталон {baseline_path} не найден, сохраните его флагом --save-baseline')
+
+    def run_benchmark(self, options):
+        venues = benchmark.bench_venues()
+        if not venues:
+            self.stdout.write('Заполнение базы...')
+            benchmark.seed(options['venues'], options['tracks'], options['history'])
+            venues = benchmark.bench_venues()
+
+        stats.reset()
+        breaker.reset()
+        in_flight = benchmark.InFlight()
+        if options['server'] == 'asgi':
+            server, urlconf = benchmark.live_asgi_server(in_flight), 'server.urls_asgi'
+        else:
+            server, urlconf = benchmark.live_server(options['threads'], in_flight), settings.ROOT_URLCONF
+        # Лимиты и admission control остаются в пути запроса, но не срабатывают
+        with FakeYooKassa(latency=options['provider_latency']) as fake, \
+                override_settings(
+                    YOOKASSA_API_URL=fake.url,
+                    RATE_LIMITS=benchmark.unlimited_rate_limits(),
+                    ADMISSION_LIMITS_PER_WORKER={},
+                    ROOT_URLCONF=urlconf
+                ), \
+                server as base_url:
+            self.stdout.write(f"Прогон {options['duration']} сек. на {base_url} ({options['server']})...")
+            report = benchmark.run(
+                base_url, venues, options['guests'], options['djs'], options['duration'], in_flight=in_flight
+            )
+        report['config'].update(server=options['server'], threads=options['threads'])
+        report['yookassa'] = stats.snapshot()
+        return report
+
+    def print_report(self, report):
+        self.stdout.write(f"{'операция':<16}{'запросов':>10}{'ошибок':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+        for operation, row in report['operations'].items():
+            self.stdout.write(
+                f"{operation:<16}{row['requests']:>10}{row['errors']:>8}{row['rps']:>9}"
+                f"{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}"
+            )
+        in_flight = report.get('in_flight')
+        if in_flight:
+            self.stdout.write(
+                f"Одновременно в обработке сервером: в среднем {in_flight['average']}, пик {in_flight['peak']}"
+            )
+        webhooks = report['webhooks']
+        self.stdout.write(f"Уведомлений обработано: {webhooks['processed']}, с ошибкой: {webhooks['failed']}")
@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import benchmark
+from server.databases import PROFILES
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает конкурентную запись оплат и чтение очереди на разных профилях базы (DB_PROFILE)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles', nargs='+', choices=PROFILES, default=['sqlite', 'sqlite-wal'],
+            help='Профили для сравнения; postgresql берет параметры из DB_* переменных окружения'
+        )
+        parser.add_argument('--current', action='store_true', help='Прогнать только текущий профиль и вывести JSON')
+        parser.add_argument('--venues', type=int, default=5)
+        parser.add_argument('--tracks', type=int, default=50, help='Треков на заведение')
+        parser.add_argument('--history', type=int, default=2000, help='Исторических запросов на заведение')
+        parser.add_argument('--writers', type=int, default=8, help='Параллельных потоков записи')
+        parser.add_argument('--readers', type=int, default=4, help='Параллельных потоков чтения')
+        parser.add_argument('--duration', type=float, default=10.0, help='Длительность прогона (сек.)')
+        parser.add_argument('--output', help='Записать отчет в JSON-файл')
+
+    def handle(self, *args, **options):
+        if options['current']:
+            self.stdout.write(json.dumps(self.run_current(options)))
+            return
+
+        # DATABASES читается при старте, поэтому каждый профиль идет в отдельном процессе
+        reports = {profile: self.run_profile(profile, options) for profile in options['profiles']}
+        self.print_report(reports)
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(reports, indent=2, ensure_ascii=False))
+
+    @staticmethod
+    def run_current(options):
+        with benchmark.test_database():
+            venues = benchmark.seed(options['venues'], options['tracks'], options['history'])
+            return benchmark.run_writes(venues, options['writers'], options['readers'], options['duration'])
+
+    def run_profile(self, profile, options):
+        self.stdout.write(f"Профиль {profile}: {options['duration']} сек....")
+        command = [sys.executable, str(Path(settings.BASE_DIR) / 'manage.py'), 'benchmark_db', '--current']
+        for name in ('venues', 'tracks', 'history', 'writers', 'readers', 'duration'):
+            command += [f'--{name}', str(options[name])]
+        result = subprocess.run(
+            command, env={**os.environ, 'DB_PROFILE': profile}, capture_output=True, text=True
+        )
+        if result.returncode:
+            raise CommandError(f'Профиль {profile} завершился с ошибкой:\n{result.stderr}')
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def print_report(self, reports):
+        self.stdout.write(
+            f"{'профиль':<12}{'операция':<13}{'запросов':>10}{'ошибок':>8}{'успешных/с':>12}"
+            f"{'p50':>9}{'p99':>9}{'max':>9}"
+        )
+        for profile, report in reports.items():
+            for operation, row in report['operations'].items():
+                # rps учитывает и отказы, для сравнения профилей важны только успешные операции
+                ok_rps = round(row['rps'] * (row['requests'] - row['errors']) / row['requests'], 2)
+                self.stdout.write(
+                    f"{profile:<12}{operation:<13}{row['requests']:>10}{row['errors']:>8}{ok_rps:>12}"
+                    f"{row['p50_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}"
+                )
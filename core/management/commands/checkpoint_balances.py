@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.ledger import advance_checkpoint
+from core.models import BalanceCheckpoint
+
+
+class Command(BaseCommand):
+    help = 'Сворачивает журнал транзакций в контрольные точки балансов заведений'
+
+    def handle(self, *args, **options):
+        count = 0
+        for venue_id in BalanceCheckpoint.objects.values_list('venue_id', flat=True).iterator():
+            advance_checkpoint(venue_id)
+            count += 1
+        self.stdout.write(f'Обновлено контрольных точек: {count}')
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.outbox import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Выполняет исходящие вызовы ЮKassa из очереди ProviderCall'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--sleep', type=float, default=1.0, help='Пауза, когда очередь пуста (сек.)')
+        parser.add_argument('--once', action='store_true', help='Обработать очередь и завершиться')
+
+    def handle(self, *args, **options):
+        while True:
+            results = process_batch(options['batch_size'])
+            if results:
+                self.stdout.write(
+                    f'Выполнено: {results.count(True)}, с ошибкой: {results.count(False)}'
+                )
+            elif options['once']:
+                return
+            else:
+                time.sleep(options['sleep'])
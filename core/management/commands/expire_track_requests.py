@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.expiry import run
+
+
+class Command(BaseCommand):
+    help = 'Истекает неоплаченные запросы старше TRACK_REQUEST_TTL и переносит их в архив'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Строк в одной транзакции')
+        parser.add_argument('--pause', type=float, default=0.1, help='Пауза между пакетами (сек.)')
+
+    def handle(self, *args, **options):
+        totals = run(options['batch_size'], options['pause'])
+        self.stdout.write(f"Истекло запросов: {totals['expired']}, перенесено в архив: {totals['archived']}")
@@ -0,0 +1,44 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from core.exports import EXPORTS, RENDERERS, stream_export
+
+
+def parse_moment(value):
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f'Некорректная дата: {value}')
+        moment = datetime.combine(day, time.min)
+    return moment if timezone.is_aware(moment) else timezone.make_aware(moment)
+
+
+class Command(BaseCommand):
+    help = 'Выгружает транзакции или выводы средств в CSV/NDJSON без загрузки в память'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=sorted(RENDERERS), default='csv')
+        parser.add_argument('--venue', type=int, action='append', help='Можно указать несколько раз')
+        parser.add_argument('--from', dest='date_from', type=parse_moment, help='Включительно')
+        parser.add_argument('--to', dest='date_to', type=parse_moment, help='Не включительно')
+        parser.add_argument('--output', help='Файл, по умолчанию stdout')
+
+    def handle(self, *args, **options):
+        chunks = stream_export(
+            options['kind'],
+            options['format'],
+            venue_ids=options['venue'],
+            date_from=options['date_from'],
+            date_to=options['date_to']
+        )
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
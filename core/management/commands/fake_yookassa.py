@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from core.fake_yookassa import FakeYooKassa
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальную замену API ЮKassa (YOOKASSA_API_URL=http://host:port)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа (сек.)')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 500 (0..1)')
+
+    def handle(self, *args, **options):
+        fake = FakeYooKassa(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency'],
+            error_rate=options['error_rate']
+        )
+        self.stdout.write(f'Fake YooKassa: {fake.url}')
+        try:
+            fake.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fake.server.server_close()
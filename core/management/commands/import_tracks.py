@@ -0,0 +1,34 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.imports import FORMATS, detect_format, import_tracks
+from core.models import Venue
+
+
+class Command(BaseCommand):
+    help = 'Импортирует каталог треков заведения из CSV, JSON или NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('venue_id', type=int)
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS)
+        parser.add_argument('--dry-run', action='store_true', help='Проверить файл без записи в базу')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        try:
+            venue = Venue.objects.get(pk=options['venue_id'])
+        except Venue.DoesNotExist:
+            raise CommandError('Заведение не найдено')
+
+        fmt = options['format'] or detect_format(options['path'])
+        with open(options['path'], 'rb') as stream:
+            try:
+                report = import_tracks(
+                    venue, stream, fmt=fmt, dry_run=options['dry_run'], chunk_size=options['chunk_size']
+                )
+            except ValueError as exc:
+                raise CommandError(f'Не удалось прочитать файл: {exc}')
+
+        self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from core.analytics import rebuild_all
+
+
+def parse_day(value):
+    day = parse_date(value)
+    if day is None:
+        raise CommandError(f'Некорректная дата: {value}')
+    return day
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает дневную аналитику заведений по истории запросов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('venue_ids', nargs='*', type=int, help='Только указанные заведения')
+        parser.add_argument('--from', dest='date_from', type=parse_day, help='Первый день, включительно')
+        parser.add_argument('--to', dest='date_to', type=parse_day, help='Последний день, включительно')
+
+    def handle(self, *args, **options):
+        venues = days = 0
+        for _, rebuilt_days in rebuild_all(options['venue_ids'], options['date_from'], options['date_to']):
+            venues += 1
+            days += rebuilt_days
+        self.stdout.write(f'Пересчитано заведений: {venues}, дней с запросами: {days}')
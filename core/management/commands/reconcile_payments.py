@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.reconciliation import run
+
+LABELS = {'payouts': 'Выплаты', 'payments': 'Платежи'}
+
+
+class Command(BaseCommand):
+    help = 'Сверяет с ЮKassa выплаты в processing и неоплаченные запросы с созданным платежом'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Записей в одной транзакции')
+        parser.add_argument('--concurrency', type=int, help='Параллельных запросов к ЮKassa')
+        parser.add_argument('--interval', type=float, help='Повторять сверку каждые N секунд')
+
+    def handle(self, *args, **options):
+        while True:
+            report = run(options['batch_size'], options['concurrency'])
+            for kind, summary in report.items():
+                self.stdout.write(
+                    f"{LABELS[kind]}: проверено {summary['checked']}, оплачено/выплачено {summary['succeeded']}, "
+                    f"отменено {summary['canceled']}, без изменений {summary['unchanged']}, ошибок {summary['errors']}"
+                )
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
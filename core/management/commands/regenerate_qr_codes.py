@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.models import Venue
+from core.qr import generate_venue_codes
+
+
+def _generate(venue_id):
+    try:
+        return generate_venue_codes(venue_id)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Перерисовывает QR-коды заведений, например после смены домена в settings.QR'
+
+    def add_arguments(self, parser):
+        parser.add_argument('venue_ids', nargs='*', type=int, help='Только указанные заведения')
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        venues = Venue.objects.order_by('id')
+        if options['venue_ids']:
+            venues = venues.filter(id__in=options['venue_ids'])
+        venue_ids = list(venues.values_list('id', flat=True))
+
+        failed = 0
+        if options['workers'] <= 1:
+            for venue_id in venue_ids:
+                failed += not self.generate(generate_venue_codes, venue_id)
+        else:
+            # Отрисовка занимает миллисекунды, основное время уходит на запись в хранилище
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(self.generate, _generate, venue_id) for venue_id in venue_ids]
+                failed = sum(not future.result() for future in as_completed(futures))
+
+        self.stdout.write(f'Перерисовано QR-кодов: {len(venue_ids) - failed}, ошибок: {failed}')
+
+    def generate(self, generate, venue_id):
+        try:
+            generate(venue_id)
+        except Exception as exc:
+            self.stderr.write(f'Заведение {venue_id}: {exc}')
+            return False
+        return True
@@ -0,0 +1,166 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.http import JsonResponse
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+    @contextmanager
+    def track(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+
+# Счетчик текущего ASGI-запроса. Под ASGI запросы к базе идут через соединения потоков
+# sync_to_async, а не потока цикла событий, поэтому обертка стоит на каждом соединении
+# (см. signals.count_asgi_queries) и находит счетчик в контексте, который sync_to_async копирует
+_current_counter = contextvars.ContextVar('query_counter', default=None)
+
+
+def _count_current(execute, sql, params, many, context):
+    counter = _current_counter.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    return counter(execute, sql, params, many, context)
+
+
+def install_counter(connection):
+    # В начало списка: execute_wrapper() снимает свою обертку с конца
+    if _count_current not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _count_current)
+
+
+class QueryCountMiddleware:
+    """Считает запросы к базе и время в базе для каждого HTTP-запроса.
+
+    При QUERY_COUNT_HEADERS результат отдается в заголовках X-DB-Query-Count,
+    X-DB-Time-Ms и Server-Timing. Запросы сверх QUERY_COUNT_WARNING пишутся
+    в лог. Потоковые ответы учитываются только до начала отдачи тела.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = QueryCounter()
+        with counter.track():
+            response = self.get_response(request)
+        self.report(request, response, counter)
+        return response
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        token = _current_counter.set(counter)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_counter.reset(token)
+        self.report(request, response, counter)
+        return response
+
+    def report(self, request, response, counter):
+        duration_ms = round(counter.duration * 1000, 2)
+        warning = getattr(settings, 'QUERY_COUNT_WARNING', 50)
+        if warning and counter.count > warning:
+            logger.warning(
+                '%s %s: %s запросов к базе за %s мс', request.method, request.path, counter.count, duration_ms
+            )
+        if getattr(settings, 'QUERY_COUNT_HEADERS', False):
+            response['X-DB-Query-Count'] = str(counter.count)
+            response['X-DB-Time-Ms'] = str(duration_ms)
+            response['Server-Timing'] = f'db;dur={duration_ms};desc="{counter.count} queries"'
+
+
+class AdmissionControlMiddleware:
+    """Ограничивает число одновременно обрабатываемых запросов одного пула.
+
+    View попадает в пул атрибутом admission_pool, размеры пулов на один воркер
+    задаются в ADMISSION_LIMITS_PER_WORKER: счетчик живет в памяти процесса. Когда пул занят, запрос сразу получает 503
+    с Retry-After, а не ждет в очереди: гостевой трафик не может занять все
+    потоки воркера, и запросы DJ и webhook'и обслуживаются дальше.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.semaphores = {}
+        self.lock = threading.Lock()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        try:
+            return self.get_response(request)
+        finally:
+            self.release(request)
+
+    async def __acall__(self, request):
+        try:
+            return await self.get_response(request)
+        finally:
+            self.release(request)
+
+    def semaphore(self, pool):
+        limit = getattr(settings, 'ADMISSION_LIMITS_PER_WORKER', {}).get(pool)
+        if not limit:
+            return None
+        with self.lock:
+            if (pool, limit) not in self.semaphores:
+                self.semaphores[(pool, limit)] = threading.BoundedSemaphore(limit)
+            return self.semaphores[(pool, limit)]
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        pool = getattr(getattr(view_func, 'view_class', None), 'admission_pool', None)
+        semaphore = self.semaphore(pool) if pool else None
+        if semaphore is None:
+            return None
+        if not semaphore.acquire(blocking=False):
+            logger.warning('%s %s: пул %s занят, запрос отклонен', request.method, request.path, pool)
+            response = JsonResponse(
+                {"detail": "Сервис перегружен, повторите запрос позже"},
+                status=503
+            )
+            response['Retry-After'] = '1'
+            return response
+        request._admission_semaphore = semaphore
+        return None
+
+    @staticmethod
+    def release(request):
+        semaphore = getattr(request, '_admission_semaphore', None)
+        if semaphore is not None:
+            del request._admission_semaphore
+            semaphore.release()
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VenueEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.CharField(choices=[('created', 'Создан'), ('paid', 'Оплачен'), ('accepted', 'Принят'), ('rejected', 'Отклонен')], max_length=20)),
+                ('payload', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('venue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='core.venue')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['venue', 'id'], name='core_venuee_venue_i_1e253f_idx')],
+            },
+        ),
+    ]
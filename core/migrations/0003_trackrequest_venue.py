@@ -0,0 +1,28 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_venue(apps, schema_editor):
+    TrackRequest = apps.get_model('core', 'TrackRequest')
+    Track = apps.get_model('core', 'Track')
+    TrackRequest.objects.filter(venue__isnull=True).update(
+        venue_id=models.Subquery(
+            Track.objects.filter(pk=models.OuterRef('track_id')).values('venue_id')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_venueevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackrequest',
+            name='venue',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='track_requests', to='core.venue'),
+        ),
+        migrations.RunPython(fill_venue, migrations.RunPython.noop),
+    ]
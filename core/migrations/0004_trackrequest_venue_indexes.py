@@ -0,0 +1,25 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_trackrequest_venue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trackrequest',
+            name='venue',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='track_requests', to='core.venue'),
+        ),
+        migrations.AddIndex(
+            model_name='trackrequest',
+            index=models.Index(fields=['venue', '-created_at', 'id'], name='trackrequest_venue_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trackrequest',
+            index=models.Index(fields=['venue', 'status', 'is_paid', '-created_at', 'id'], name='trackrequest_venue_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS core_track_fts USING fts5(
+        title, artist,
+        content='core_track', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_track_fts_ai AFTER INSERT ON core_track BEGIN
+        INSERT INTO core_track_fts(rowid, title, artist) VALUES (new.id, new.title, new.artist);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_track_fts_ad AFTER DELETE ON core_track BEGIN
+        INSERT INTO core_track_fts(core_track_fts, rowid, title, artist)
+        VALUES ('delete', old.id, old.title, old.artist);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_track_fts_au AFTER UPDATE OF title, artist ON core_track BEGIN
+        INSERT INTO core_track_fts(core_track_fts, rowid, title, artist)
+        VALUES ('delete', old.id, old.title, old.artist);
+        INSERT INTO core_track_fts(rowid, title, artist) VALUES (new.id, new.title, new.artist);
+    END
+    """,
+    "INSERT INTO core_track_fts(core_track_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS core_track_fts_au",
+    "DROP TRIGGER IF EXISTS core_track_fts_ad",
+    "DROP TRIGGER IF EXISTS core_track_fts_ai",
+    "DROP TABLE IF EXISTS core_track_fts",
+]
+
+# Индексы по выражению обновляются самой PostgreSQL, триггеры не нужны
+POSTGRESQL_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    CREATE INDEX IF NOT EXISTS core_track_search_tsv ON core_track
+    USING GIN (to_tsvector('simple', title || ' ' || artist))
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS core_track_search_trgm ON core_track
+    USING GIN ((title || ' ' || artist) gin_trgm_ops)
+    """,
+]
+
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS core_track_search_trgm",
+    "DROP INDEX IF EXISTS core_track_search_tsv",
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_trackrequest_venue_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD}),
+        ),
+    ]
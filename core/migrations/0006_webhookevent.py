@@ -0,0 +1,36 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:47
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_track_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('payment', 'Платеж'), ('payout', 'Выплата')], max_length=10)),
+                ('object_id', models.CharField(max_length=100)),
+                ('event', models.CharField(blank=True, max_length=50)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('processing', 'В обработке'), ('done', 'Обработано'), ('failed', 'Ошибка')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('locked_by', models.CharField(blank=True, max_length=40)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='webhookevent_queue_idx')],
+                'constraints': [models.UniqueConstraint(fields=('kind', 'object_id'), name='webhookevent_unique_object')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_checkpoints(apps, schema_editor):
+    # Текущий Venue.balance уже учитывает все существующие транзакции
+    Venue = apps.get_model('core', 'Venue')
+    Transaction = apps.get_model('core', 'Transaction')
+    BalanceCheckpoint = apps.get_model('core', 'BalanceCheckpoint')
+    last_id = Transaction.objects.aggregate(last_id=models.Max('id'))['last_id'] or 0
+    BalanceCheckpoint.objects.bulk_create([
+        BalanceCheckpoint(venue_id=venue_id, balance=balance, last_transaction_id=last_id)
+        for venue_id, balance in Venue.objects.values_list('id', 'balance').iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.IntegerField(default=0)),
+                ('last_transaction_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='transaction_type',
+            field=models.CharField(choices=[('deposit', 'Пополнение'), ('withdrawal', 'Списание'), ('refund', 'Возврат')], max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['venue', 'id'], name='transaction_venue_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='balancecheckpoint',
+            name='venue',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='balance_checkpoint', to='core.venue'),
+        ),
+        migrations.RunPython(create_checkpoints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_ledger_balances'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='withdrawalrequest',
+            index=models.Index(fields=['venue', 'id'], name='withdrawal_venue_id_idx'),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_withdrawal_venue_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenreDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('paid', models.PositiveIntegerField(default=0)),
+                ('accepted', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('revenue', models.BigIntegerField(default=0)),
+                ('genre', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.genre')),
+                ('venue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.venue')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('venue', 'day', 'genre'), name='genredailystats_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TrackDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('paid', models.PositiveIntegerField(default=0)),
+                ('accepted', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('revenue', models.BigIntegerField(default=0)),
+                ('track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.track')),
+                ('venue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.venue')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('venue', 'day', 'track'), name='trackdailystats_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='VenueDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('paid', models.PositiveIntegerField(default=0)),
+                ('accepted', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('revenue', models.BigIntegerField(default=0)),
+                ('venue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.venue')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('venue', 'day'), name='venuedailystats_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_analytics_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedTrackRequest',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('user_fee', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('accepted', 'Принят'), ('rejected', 'Отклонен'), ('expired', 'Истек')], max_length=10)),
+                ('is_paid', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField()),
+                ('transaction_id', models.CharField(blank=True, max_length=100)),
+                ('payment_token', models.UUIDField(unique=True)),
+                ('payment_id', models.CharField(blank=True, max_length=100)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='trackrequest',
+            name='trackrequest_venue_queue_idx',
+        ),
+        migrations.AlterField(
+            model_name='trackrequest',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Ожидает'), ('accepted', 'Принят'), ('rejected', 'Отклонен'), ('expired', 'Истек')], default='pending', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='trackrequest',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['venue', '-created_at', 'id'], name='trackrequest_venue_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trackrequest',
+            index=models.Index(condition=models.Q(('is_paid', False), ('status', 'pending')), fields=['created_at'], name='trackrequest_unpaid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trackrequest',
+            index=models.Index(condition=models.Q(('status', 'expired')), fields=['created_at'], name='trackrequest_expired_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedtrackrequest',
+            name='track',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.track'),
+        ),
+        migrations.AddField(
+            model_name='archivedtrackrequest',
+            name='venue',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.venue'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtrackrequest',
+            index=models.Index(fields=['venue', 'created_at'], name='archivedrequest_venue_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_provider_call_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trackrequest',
+            index=models.Index(condition=models.Q(('is_paid', False), ('payment_id__gt', '')), fields=['status', 'created_at'], name='trackrequest_awaiting_pay_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='withdrawalrequest',
+            index=models.Index(fields=['status', 'created_at'], name='withdrawal_status_created_idx'),
+        ),
+    ]
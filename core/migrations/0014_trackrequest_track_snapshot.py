@@ -0,0 +1,94 @@
+# Generated by Django 5.2.1 on 2026-10-18 07:24
+
+from django.db import migrations, models
+from django.db.models.functions import Least
+
+
+def fill_track_snapshot(apps, schema_editor):
+    Track = apps.get_model('core', 'Track')
+
+    def track_value(field):
+        return models.Subquery(Track.objects.filter(pk=models.OuterRef('track_id')).values(field)[:1])
+
+    for model_name in ('TrackRequest', 'ArchivedTrackRequest'):
+        model = apps.get_model('core', model_name)
+        # Цена на момент запроса не сохранилась; user_fee был не меньше нее, поэтому берется минимум
+        model.objects.filter(track_title='').update(
+            track_title=track_value('title'),
+            track_artist=track_value('artist'),
+            track_icon=track_value('icon'),
+            track_genre_id=track_value('genre_id'),
+            track_genre_name=track_value('genre__name'),
+            min_fee=Least(track_value('price'), models.F('user_fee')),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_reconciliation_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedtrackrequest',
+            name='min_fee',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='archivedtrackrequest',
+            name='track_artist',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='archivedtrackrequest',
+            name='track_genre_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedtrackrequest',
+            name='track_genre_name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='archivedtrackrequest',
+            name='track_icon',
+            field=models.CharField(blank=True, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='archivedtrackrequest',
+            name='track_title',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='trackrequest',
+            name='min_fee',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='trackrequest',
+            name='track_artist',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='trackrequest',
+            name='track_genre_id',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='trackrequest',
+            name='track_genre_name',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='trackrequest',
+            name='track_icon',
+            field=models.CharField(blank=True, editable=False, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='trackrequest',
+            name='track_title',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.RunPython(fill_track_snapshot, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 07:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_trackrequest_track_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='locked_until',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.1 on 2026-10-18 09:10
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def settle_checkpointed(apps, schema_editor):
+    # Транзакции до прежней границы last_transaction_id уже вошли в контрольную точку
+    Transaction = apps.get_model('core', 'Transaction')
+    BalanceCheckpoint = apps.get_model('core', 'BalanceCheckpoint')
+    boundary = BalanceCheckpoint.objects.filter(venue_id=OuterRef('venue_id')).values('last_transaction_id')[:1]
+    Transaction.objects.filter(id__lte=Subquery(boundary)).update(settled=True)
+
+
+def restore_boundary(apps, schema_editor):
+    Transaction = apps.get_model('core', 'Transaction')
+    BalanceCheckpoint = apps.get_model('core', 'BalanceCheckpoint')
+    last_settled = Transaction.objects.filter(
+        venue_id=OuterRef('venue_id'), settled=True
+    ).order_by('-id').values('id')[:1]
+    BalanceCheckpoint.objects.update(last_transaction_id=Coalesce(Subquery(last_settled), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_idempotency_key_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='settled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(settle_checkpointed, restore_boundary),
+        migrations.RemoveField(
+            model_name='balancecheckpoint',
+            name='last_transaction_id',
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(
+                condition=models.Q(('settled', False)), fields=['venue'], name='transaction_unsettled_idx'
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.1 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_transaction_settled'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='archivedtrackrequest',
+            index=models.Index(condition=models.Q(('payment_id__gt', '')), fields=['created_at'], name='archivedrequest_payment_idx'),
+        ),
+    ]
@@ -1,11 +1,12 @@
 import uuid
 from django.db import models
 from django.contrib.auth.models import User
-from io import BytesIO
-from django.core.files import File
-import qrcode
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
+from django.utils import timezone
+
+from .caching import genres
 
 
 class Venue(models.Model):
@@ -13,7 +14,9 @@ class Venue(models.Model):
     name = models.CharField(max_length=100)
     city = models.CharField(max_length=50)
     phone = models.CharField(max_length=20)
+    # Заполняется после коммита регистрации, см. core.qr.schedule_generation
     qr_code = models.ImageField(upload_to='qr_codes/', blank=True)
+    # Снимок баланса на момент последнего checkpoint_balances, актуальный баланс - core.ledger.get_balance
     balance = models.IntegerField(default=0)
 
     objects = models.Manager()
@@ -21,18 +24,6 @@ class Venue(models.Model):
     def __str__(self):
         return f"{self.name} ({self.city})"
 
-    def save(self, *args, **kwargs):
-        is_new = self.pk is None
-        super().save(*args, **kwargs)
-        
-        if is_new and not self.qr_code:
-            url = f"{settings.QR}/venue/{self.id}/request"
-            qr_img = qrcode.make(url)
-            buffer = BytesIO()
-            qr_img.save(buffer, format='PNG')
-            self.qr_code.save(f'qr_{self.id}.png', File(buffer), save=False)
-            super().save(update_fields=['qr_code'])
-
 
 class Genre(models.Model):
     name = models.CharField(max_length=100)
@@ -65,8 +56,10 @@ class TrackRequest(models.Model):
         ('pending', 'Ожидает'),
         ('accepted', 'Принят'),
         ('rejected', 'Отклонен'),
+        ('expired', 'Истек'),
     ]
     track = models.ForeignKey(Track, on_delete=models.CASCADE)
+    venue = models.ForeignKey(Venue, on_delete=models.CASCADE, related_name='track_requests', editable=False)
     user_fee = models.PositiveIntegerField()
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     is_paid = models.BooleanField(default=False)
@@ -74,26 +67,169 @@ class TrackRequest(models.Model):
     transaction_id = models.CharField(max_length=100, blank=True)
     payment_token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     payment_id = models.CharField(max_length=100, blank=True)
+    # Снимок трека на момент запроса: очередь DJ читается без JOIN, а цена не меняется вслед за треком
+    track_title = models.CharField(max_length=100, blank=True, editable=False)
+    track_artist = models.CharField(max_length=100, blank=True, editable=False)
+    track_icon = models.CharField(max_length=1000, blank=True, editable=False)
+    track_genre_id = models.IntegerField(null=True, editable=False)
+    track_genre_name = models.CharField(max_length=100, blank=True, editable=False)
+    min_fee = models.PositiveIntegerField(default=0, editable=False)
 
     objects = models.Manager()
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['venue', '-created_at', 'id'], name='trackrequest_venue_created_idx'),
+            # Очередь DJ: в частичные индексы попадают только живые строки, а не вся история
+            models.Index(
+                fields=['venue', '-created_at', 'id'],
+                condition=models.Q(status='pending'),
+                name='trackrequest_venue_pending_idx'
+            ),
+            # Для expire_track_requests: неоплаченные и уже истекшие запросы по возрасту
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(status='pending', is_paid=False),
+                name='trackrequest_unpaid_idx'
+            ),
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(status='expired'),
+                name='trackrequest_expired_idx'
+            ),
+            # Для reconcile_payments: платеж создан, но оплата еще не подтверждена
+            models.Index(
+                fields=['status', 'created_at'],
+                condition=models.Q(is_paid=False, payment_id__gt=''),
+                name='trackrequest_awaiting_pay_idx'
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        # venue дублируется из трека, чтобы список запросов читался по индексу без JOIN
+        if self.venue_id is None:
+            self.venue_id = self.track.venue_id
+        if self._state.adding and not self.track_title:
+            self.snapshot_track()
+        super().save(*args, **kwargs)
+
+    def snapshot_track(self):
+        track = self.track
+        genre = genres.get(track.genre_id)
+        self.track_title = track.title
+        self.track_artist = track.artist
+        self.track_icon = track.icon
+        self.track_genre_id = track.genre_id
+        self.track_genre_name = genre.name if genre else ''
+        self.min_fee = track.price
+
+
+class ArchivedTrackRequest(models.Model):
+    """Неоплаченный запрос, перенесенный из TrackRequest командой expire_track_requests."""
+    id = models.BigIntegerField(primary_key=True)
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='+')
+    venue = models.ForeignKey(Venue, on_delete=models.CASCADE, related_name='+')
+    user_fee = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=TrackRequest.STATUS_CHOICES)
+    is_paid = models.BooleanField(default=False)
+    created_at = models.DateTimeField()
+    transaction_id = models.CharField(max_length=100, blank=True)
+    payment_token = models.UUIDField(unique=True)
+    payment_id = models.CharField(max_length=100, blank=True)
+    track_title = models.CharField(max_length=100, blank=True)
+    track_artist = models.CharField(max_length=100, blank=True)
+    track_icon = models.CharField(max_length=1000, blank=True)
+    track_genre_id = models.IntegerField(null=True)
+    track_genre_name = models.CharField(max_length=100, blank=True)
+    min_fee = models.PositiveIntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['venue', 'created_at'], name='archivedrequest_venue_idx'),
+            # Для reconcile_payments: оплата могла пройти уже после архивации
+            models.Index(
+                fields=['created_at'], condition=models.Q(payment_id__gt=''), name='archivedrequest_payment_idx'
+            ),
+        ]
 
 
 class Transaction(models.Model):
     TYPE_CHOICES = [
         ('deposit', 'Пополнение'),
         ('withdrawal', 'Списание'),
+        ('refund', 'Возврат'),
     ]
     venue = models.ForeignKey(Venue, on_delete=models.CASCADE)
     amount = models.IntegerField()
     transaction_type = models.CharField(max_length=10, choices=TYPE_CHOICES)
     track_request = models.ForeignKey(TrackRequest, on_delete=models.SET_NULL, null=True, blank=True)
+    # Уже учтена в BalanceCheckpoint.balance
+    settled = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     objects = models.Manager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['venue', 'id'], name='transaction_venue_id_idx'),
+            models.Index(fields=['venue'], condition=models.Q(settled=False), name='transaction_unsettled_idx'),
+        ]
+
+
+class BalanceCheckpoint(models.Model):
+    # Баланс заведения = balance + сумма транзакций с settled=False. Флаг, а не граница по id:
+    # транзакция с меньшим id может закоммититься позже и иначе выпала бы из баланса
+    venue = models.OneToOneField(Venue, on_delete=models.CASCADE, related_name='balance_checkpoint')
+    balance = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = models.Manager()
+
+
+class DailyStats(models.Model):
+    # Счетчики запросов за день по дате создания запроса, см. core.analytics
+    venue = models.ForeignKey(Venue, on_delete=models.CASCADE, related_name='+')
+    day = models.DateField()
+    requests = models.PositiveIntegerField(default=0)
+    paid = models.PositiveIntegerField(default=0)
+    accepted = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    revenue = models.BigIntegerField(default=0)
+
+    objects = models.Manager()
+
+    class Meta:
+        abstract = True
+
+
+class VenueDailyStats(DailyStats):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['venue', 'day'], name='venuedailystats_unique'),
+        ]
+
+
+class TrackDailyStats(DailyStats):
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['venue', 'day', 'track'], name='trackdailystats_unique'),
+        ]
+
+
+class GenreDailyStats(DailyStats):
+    genre = models.ForeignKey(Genre, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['venue', 'day', 'genre'], name='genredailystats_unique'),
+        ]
+
 
 class WithdrawalRequest(models.Model):
     STATUS_CHOICES = [
@@ -113,3 +249,127 @@ class WithdrawalRequest(models.Model):
     fee = models.PositiveIntegerField(default=0)
 
     objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['venue', 'id'], name='withdrawal_venue_id_idx'),
+            models.Index(fields=['status', 'created_at'], name='withdrawal_status_created_idx'),
+        ]
+
+
+class VenueEvent(models.Model):
+    EVENT_CHOICES = [
+        ('created', 'Создан'),
+        ('paid', 'Оплачен'),
+        ('accepted', 'Принят'),
+        ('rejected', 'Отклонен'),
+    ]
+    venue = models.ForeignKey(Venue, on_delete=models.CASCADE, related_name='events')
+    event = models.CharField(max_length=20, choices=EVENT_CHOICES)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['venue', 'id']),
+        ]
+
+
+class WebhookEvent(models.Model):
+    KIND_CHOICES = [
+        ('payment', 'Платеж'),
+        ('payout', 'Выплата'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Ожидает'),
+        ('processing', 'В обработке'),
+        ('done', 'Обработано'),
+        ('failed', 'Ошибка'),
+    ]
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.CharField(max_length=100)
+    event = models.CharField(max_length=50, blank=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=40, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='webhookevent_unique_object'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='webhookevent_queue_idx'),
+        ]
+
+
+class ProviderCall(models.Model):
+    """Исходящая очередь вызовов ЮKassa (transactional outbox).
+
+    Запись создается в той же транзакции, что и локальная запись о платеже
+    или выводе, а сам вызов выполняет core.outbox вне транзакции. Ключ
+    idempotency_key передается в ЮKassa, поэтому повтор после сбоя не
+    создает второй платеж или выплату.
+    """
+    KIND_CHOICES = [
+        ('payment', 'Платеж'),
+        ('payout', 'Выплата'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Ожидает'),
+        ('processing', 'В обработке'),
+        ('done', 'Выполнено'),
+        ('failed', 'Ошибка'),
+    ]
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    idempotency_key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    track_request = models.ForeignKey(TrackRequest, on_delete=models.CASCADE, null=True, blank=True)
+    withdrawal = models.ForeignKey(WithdrawalRequest, on_delete=models.CASCADE, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    result = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=40, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='providercall_queue_idx'),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    """Сохраненный ответ на POST с заголовком Idempotency-Key.
+
+    digest - sha256 от метода, пути, владельца и ключа: один уникальный индекс
+    фиксированной длины, по которому повтор находится одним запросом.
+    """
+    digest = models.CharField(max_length=64, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    # Пока ответа нет, ключ занят до этого момента; после него повтор забирает ключ себе
+    locked_until = models.DateTimeField(null=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotencykey_expires_idx'),
+        ]
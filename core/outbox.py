@@ -0,0 +1,215 @@
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+from yookassa.domain.exceptions import BadRequestError, ForbiddenError, NotFoundError, UnauthorizedError
+
+from . import ledger
+from .models import ProviderCall, TrackRequest, WithdrawalRequest
+from .services import (
+    acreate_yookassa_payment, acreate_yookassa_payout, create_yookassa_payment, create_yookassa_payout
+)
+from .webhooks import retry_delay
+
+
+def enqueue_payment(track_request):
+    """Платеж для запроса; вызывается в транзакции вместе с проверкой запроса.
+
+    Повторное создание платежа по тому же запросу возвращает уже поставленный
+    в очередь вызов, поэтому гость не получит два платежа.
+    """
+    call = ProviderCall.objects.filter(kind='payment', track_request=track_request).exclude(
+        status='failed'
+    ).first()
+    return call or ProviderCall.objects.create(kind='payment', track_request=track_request)
+
+
+def enqueue_payout(withdrawal):
+    return ProviderCall.objects.create(kind='payout', withdrawal=withdrawal)
+
+
+def _claimable(now):
+    visibility_timeout = getattr(settings, 'OUTBOX_VISIBILITY_TIMEOUT', timedelta(minutes=5))
+    return Q(status='pending', next_attempt_at__lte=now) | Q(status='processing', locked_at__lt=now - visibility_timeout)
+
+
+def _lock(ids, worker_id, now):
+    if not ids:
+        return []
+    worker_id = worker_id or uuid.uuid4().hex
+    # Строку забирает тот, чей UPDATE прошел первым
+    ProviderCall.objects.filter(_claimable(now), pk__in=ids).update(
+        status='processing', locked_at=now, locked_by=worker_id
+    )
+    return list(ProviderCall.objects.filter(pk__in=ids, status='processing', locked_by=worker_id))
+
+
+def claim_batch(batch_size, worker_id=None):
+    now = timezone.now()
+    ids = list(
+        ProviderCall.objects.filter(_claimable(now)).order_by('next_attempt_at', 'id').values_list(
+            'id', flat=True
+        )[:batch_size]
+    )
+    return _lock(ids, worker_id, now)
+
+
+def claim(call, worker_id=None):
+    """Забирает один вызов, например сразу после коммита в представлении; None - его уже обрабатывают."""
+    claimed = _lock([call.pk], worker_id, timezone.now())
+    return claimed[0] if claimed else None
+
+
+def _payment_kwargs(call):
+    track_request = TrackRequest.objects.get(pk=call.track_request_id)
+    return {
+        'amount': track_request.user_fee,
+        'payment_token': track_request.payment_token,
+        'description': f"Оплата трека {track_request.track_title}",
+        'idempotency_key': call.idempotency_key,
+    }
+
+
+def _payment_result(payment):
+    return {'id': payment.id, 'confirmation_url': payment.confirmation.confirmation_url}
+
+
+def _call_payment(call):
+    return _payment_result(create_yookassa_payment(**_payment_kwargs(call)))
+
+
+async def _acall_payment(call):
+    kwargs = await sync_to_async(_payment_kwargs)(call)
+    return _payment_result(await acreate_yookassa_payment(**kwargs))
+
+
+def _apply_payment(call, result):
+    TrackRequest.objects.filter(pk=call.track_request_id).update(payment_id=result['id'])
+
+
+def _payout_args(call):
+    withdrawal = WithdrawalRequest.objects.get(pk=call.withdrawal_id)
+    return withdrawal.amount, withdrawal.fee, withdrawal.bank_card_token
+
+
+def _call_payout(call):
+    payout = create_yookassa_payout(*_payout_args(call), idempotency_key=call.idempotency_key)
+    return {'id': payout.id}
+
+
+async def _acall_payout(call):
+    args = await sync_to_async(_payout_args)(call)
+    payout = await acreate_yookassa_payout(*args, idempotency_key=call.idempotency_key)
+    return {'id': payout.id}
+
+
+def _apply_payout(call, result):
+    withdrawal = WithdrawalRequest.objects.select_for_update().get(pk=call.withdrawal_id)
+    if withdrawal.status != 'pending':
+        return
+    withdrawal.yookassa_payout_id = result['id']
+    withdrawal.status = 'processing'
+    withdrawal.save(update_fields=['yookassa_payout_id', 'status'])
+
+
+def _give_up_payout(call):
+    # Выплата так и не создана: списание с баланса возвращается
+    withdrawal = WithdrawalRequest.objects.select_for_update().get(pk=call.withdrawal_id)
+    if withdrawal.status != 'pending':
+        return
+    withdrawal.status = 'failed'
+    withdrawal.save(update_fields=['status'])
+    ledger.record(withdrawal.venue_id, withdrawal.amount, 'refund')
+
+
+CALLS = {
+    'payment': _call_payment,
+    'payout': _call_payout,
+}
+ACALLS = {
+    'payment': _acall_payment,
+    'payout': _acall_payout,
+}
+APPLIERS = {
+    'payment': _apply_payment,
+    'payout': _apply_payout,
+}
+GIVE_UP = {
+    'payout': _give_up_payout,
+}
+# ЮKassa явно отклонила запрос: объект не создан, повторять бессмысленно. При таймаутах
+# и 5xx объект мог быть создан, поэтому такие вызовы только повторяются с тем же ключом.
+REJECTED = (BadRequestError, ForbiddenError, NotFoundError, UnauthorizedError)
+
+
+def _fail(call, attempts, exc):
+    rejected = isinstance(exc, REJECTED)
+    failed = rejected or attempts >= getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 10)
+    with db_transaction.atomic():
+        updated = ProviderCall.objects.filter(pk=call.pk, locked_by=call.locked_by).update(
+            status='failed' if failed else 'pending',
+            attempts=attempts,
+            next_attempt_at=timezone.now() + retry_delay(attempts),
+            last_error=f'{type(exc).__name__}: {exc}'[:2000],
+            locked_at=None,
+            locked_by=''
+        )
+        # После исчерпания попыток без явного отказа вывод остается pending до сверки
+        if updated and rejected and call.kind in GIVE_UP:
+            GIVE_UP[call.kind](call)
+
+
+def _complete(call, attempts, result):
+    with db_transaction.atomic():
+        # Вызов могли забрать повторно по таймауту, результат применяется один раз
+        done = ProviderCall.objects.filter(pk=call.pk, locked_by=call.locked_by).update(
+            status='done',
+            result=result,
+            attempts=attempts,
+            processed_at=timezone.now(),
+            last_error='',
+            locked_at=None,
+            locked_by=''
+        )
+        if done:
+            APPLIERS[call.kind](call, result)
+    if done:
+        call.status, call.result = 'done', result
+    else:
+        call.refresh_from_db()
+
+
+def dispatch(call):
+    """Выполняет забранный вызов: запрос к ЮKassa вне транзакции, затем короткая транзакция с результатом.
+
+    Если процесс упадет между шагами, вызов останется в processing и после
+    OUTBOX_VISIBILITY_TIMEOUT будет повторен с тем же ключом идемпотентности.
+    """
+    attempts = call.attempts + 1
+    try:
+        result = CALLS[call.kind](call)
+    except Exception as exc:
+        _fail(call, attempts, exc)
+        return False
+    _complete(call, attempts, result)
+    return True
+
+
+async def adispatch(call):
+    """dispatch для ASGI: ответ ЮKassa ожидается в цикле событий, работа с базой - в потоке."""
+    attempts = call.attempts + 1
+    try:
+        result = await ACALLS[call.kind](call)
+    except Exception as exc:
+        await sync_to_async(_fail)(call, attempts, exc)
+        return False
+    await sync_to_async(_complete)(call, attempts, result)
+    return True
+
+
+def process_batch(batch_size=50, worker_id=None):
+    return [dispatch(call) for call in claim_batch(batch_size, worker_id)]
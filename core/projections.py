@@ -0,0 +1,137 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import serializers
+from rest_framework.response import Response
+
+from .caching import genres
+
+# Один экземпляр на модуль: формат дат тот же, что у сериализаторов (текущая таймзона, Z вместо +00:00)
+_datetime = serializers.DateTimeField()
+
+TRACK_FIELDS = ('id', 'title', 'icon', 'genre_id', 'artist', 'price')
+
+
+def genre(genre_id, loaded=None):
+    """Повторяет GenreSerializer; жанр берется из кеша процесса, без JOIN и запроса.
+
+    loaded - результат genres.snapshot(), чтобы на странице из многих строк
+    версия справочника читалась из общего кеша один раз, а не на каждую строку.
+    """
+    instance = loaded.get(genre_id) if loaded is not None else None
+    if instance is None:
+        instance = genres.get(genre_id)
+    if instance is None:
+        return None
+    return {'id': instance.pk, 'name': instance.name}
+
+
+def track(row, prefix='', loaded_genres=None):
+    """Повторяет TrackSerializer; prefix - путь к треку в строке values()."""
+    return {
+        'id': row[f'{prefix}id'],
+        'title': row[f'{prefix}title'],
+        'icon': row[f'{prefix}icon'],
+        'genre': genre(row[f'{prefix}genre_id'], loaded_genres),
+        'artist': row[f'{prefix}artist'],
+        'price': row[f'{prefix}price'],
+    }
+
+
+def tracks(rows):
+    loaded = genres.snapshot()
+    return [track(row, loaded_genres=loaded) for row in rows]
+
+
+TRACK_SNAPSHOT_FIELDS = (
+    'track_id', 'track_title', 'track_icon', 'track_genre_id', 'track_genre_name', 'track_artist', 'min_fee',
+)
+
+
+def requested_track(row):
+    """Трек в запросе по снимку на момент создания; price - min_fee запроса."""
+    genre_snapshot = None
+    if row['track_genre_id'] is not None:
+        genre_snapshot = {'id': row['track_genre_id'], 'name': row['track_genre_name']}
+    return {
+        'id': row['track_id'],
+        'title': row['track_title'],
+        'icon': row['track_icon'],
+        'genre': genre_snapshot,
+        'artist': row['track_artist'],
+        'price': row['min_fee'],
+    }
+
+
+TRACK_REQUEST_FIELDS = (
+    'id', 'payment_id', 'user_fee', 'status', 'is_paid', 'payment_token', 'created_at', *TRACK_SNAPSHOT_FIELDS,
+)
+
+
+def track_request(row):
+    """Повторяет TrackRequestSerializer; все колонки из одной таблицы, без JOIN."""
+    payment_url = None
+    if row['payment_id']:
+        payment_url = f"{settings.DOMAIN}/api/payments/process/{row['payment_token']}/"
+    return {
+        'id': row['id'],
+        'payment_url': payment_url,
+        'track': requested_track(row),
+        'user_fee': row['user_fee'],
+        'status': row['status'],
+        'is_paid': row['is_paid'],
+        'payment_token': str(row['payment_token']),
+        'created_at': _datetime.to_representation(row['created_at']),
+        'min_fee': row['min_fee'],
+        'payment_id': row['payment_id'],
+    }
+
+
+TRANSACTION_FIELDS = ('amount', 'transaction_type', 'created_at')
+
+
+def transaction(row):
+    """Повторяет TransactionSerializer."""
+    return {
+        'amount': row['amount'],
+        'transaction_type': row['transaction_type'],
+        'created_at': _datetime.to_representation(row['created_at']),
+    }
+
+
+WITHDRAWAL_FIELDS = ('amount', 'status', 'created_at', 'fee')
+
+
+def withdrawal(row):
+    """Повторяет WithdrawalSerializer без полей только для записи."""
+    return {
+        'amount': row['amount'],
+        'status': row['status'],
+        'created_at': _datetime.to_representation(row['created_at']),
+        'fee': row['fee'],
+    }
+
+
+class ProjectionListMixin:
+    """Быстрый list() для ListAPIView: строки читаются через values() только с нужными
+    колонками и собираются в тот же JSON, что дает serializer_class, без экземпляров
+    моделей и полей сериализатора. Сериализатор остается для записи и схемы API.
+    """
+
+    projection_fields = ()
+    project = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not cls.projection_fields or cls.project is None:
+            raise ImproperlyConfigured(f'{cls.__name__}: укажите projection_fields и project')
+
+    def project_rows(self, rows):
+        # Переопределяется, когда строкам нужны общие данные, прочитанные один раз на ответ
+        return [self.project(row) for row in rows]
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).values(*self.projection_fields)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.project_rows(page))
+        return Response(self.project_rows(queryset))
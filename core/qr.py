@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import qrcode
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from PIL import Image
+from qrcode.image.svg import SvgPathImage
+
+# Меняется при изменении способа отрисовки, чтобы старые файлы не переиспользовались
+RENDER_VERSION = 1
+FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+UPLOAD_DIR = 'qr_codes'
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_sizes():
+    return tuple(getattr(settings, 'QR_SIZES', (256, 512, 1024)))
+
+
+def get_default_size():
+    return getattr(settings, 'QR_DEFAULT_SIZE', 512)
+
+
+def venue_url(venue_id):
+    return f"{settings.QR}/venue/{venue_id}/request"
+
+
+def code_name(venue_id, size=None, fmt='png'):
+    """Путь файла зависит только от содержимого кода.
+
+    Смена settings.QR, размера или версии отрисовки дает новое имя, поэтому
+    файлы и записи кеша не нужно инвалидировать, а старые просто удаляются.
+    """
+    if fmt == 'svg':
+        # SVG масштабируется без потерь, размер на содержимое не влияет
+        size = None
+    elif size is None:
+        size = get_default_size()
+    key = f'{RENDER_VERSION}:{venue_url(venue_id)}:{size}:{fmt}'
+    digest = hashlib.sha256(key.encode()).hexdigest()[:20]
+    return f'{UPLOAD_DIR}/{venue_id}/{digest}.{fmt}'
+
+
+def render(url, size, fmt):
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=1, border=4)
+    qr.add_data(url)
+    qr.make(fit=True)
+
+    if fmt == 'svg':
+        return qr.make_image(image_factory=SvgPathImage).to_string(encoding='unicode').encode()
+
+    # Модуль кода - целое число пикселей, остаток поля заливается белым
+    modules = qr.modules_count + 2 * qr.border
+    qr.box_size = max(1, size // modules)
+    image = qr.make_image().get_image().convert('1')
+    if image.size[0] < size:
+        canvas = Image.new('1', (size, size), 1)
+        offset = (size - image.size[0]) // 2
+        canvas.paste(image, (offset, offset))
+        image = canvas
+    buffer = BytesIO()
+    image.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def _store(name, content):
+    if default_storage.exists(name):
+        return
+    saved = default_storage.save(name, ContentFile(content))
+    if saved != name:
+        # Другой воркер успел записать тот же файл
+        default_storage.delete(saved)
+
+
+def get_code(venue_id, size=None, fmt='png'):
+    """Возвращает (имя, содержимое) кода, отрисовывая его только при первом запросе."""
+    name = code_name(venue_id, size, fmt)
+    cache_key = f'qr:{name}'
+    content = cache.get(cache_key)
+    if content is not None:
+        return name, content
+
+    if default_storage.exists(name):
+        with default_storage.open(name, 'rb') as stored:
+            content = stored.read()
+    else:
+        content = render(venue_url(venue_id), size or get_default_size(), fmt)
+        _store(name, content)
+    cache.set(cache_key, content, getattr(settings, 'QR_CACHE_TIMEOUT', 86400))
+    return name, content
+
+
+def _list_files(venue_id):
+    try:
+        _, files = default_storage.listdir(f'{UPLOAD_DIR}/{venue_id}')
+    except FileNotFoundError:
+        return []
+    return [f'{UPLOAD_DIR}/{venue_id}/{file}' for file in files]
+
+
+def generate_venue_codes(venue_id):
+    """Отрисовывает все размеры и SVG, записывает PNG по умолчанию в Venue.qr_code
+    и удаляет файлы, оставшиеся от прежних настроек."""
+    from .models import Venue
+
+    names = {get_code(venue_id, size, 'png')[0] for size in get_sizes()}
+    names.add(get_code(venue_id, fmt='svg')[0])
+    default_name = get_code(venue_id)[0]
+    names.add(default_name)
+
+    old_name = Venue.objects.filter(pk=venue_id).values_list('qr_code', flat=True).first()
+    if old_name is None:
+        # Заведение удалено, пока код отрисовывался
+        delete_venue_codes(venue_id)
+        return None
+    if old_name != default_name:
+        Venue.objects.filter(pk=venue_id).update(qr_code=default_name)
+
+    stale = set(_list_files(venue_id)) - names
+    if old_name and old_name != default_name:
+        stale.add(old_name)
+    for name in stale:
+        default_storage.delete(name)
+    return default_name
+
+
+def delete_venue_codes(venue_id, current=None):
+    for name in set(_list_files(venue_id)) | ({current} if current else set()):
+        default_storage.delete(name)
+
+
+def _generate_in_thread(venue_id):
+    try:
+        generate_venue_codes(venue_id)
+    except Exception:
+        logger.exception('Не удалось отрисовать QR-код заведения %s', venue_id)
+    finally:
+        connection.close()
+
+
+def schedule_generation(venue_id):
+    # Отрисовка не держит запрос регистрации: по умолчанию она идет в фоновом потоке
+    if not getattr(settings, 'QR_RENDER_ASYNC', True):
+        generate_venue_codes(venue_id)
+        return
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='qr-render')
+    _executor.submit(_generate_in_thread, venue_id)
@@ -0,0 +1,230 @@
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from . import analytics, expiry, ledger, outbox
+from .events import publish_request_event
+from .models import ArchivedTrackRequest, ProviderCall, TrackRequest, WithdrawalRequest
+from .services import create_yookassa_payout, find_payment, find_payout
+
+logger = logging.getLogger(__name__)
+
+
+def fetch(object_ids, finder, concurrency):
+    """Статусы объектов ЮKassa параллельно, не больше concurrency запросов сразу.
+
+    Возвращает {id: объект или исключение}; потоки не обращаются к базе.
+    """
+    def find(object_id):
+        try:
+            return object_id, finder(object_id)
+        except Exception as exc:
+            return object_id, exc
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return dict(executor.map(find, object_ids))
+
+
+def _chunks(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _found(summary, provider_object, object_id):
+    if isinstance(provider_object, Exception):
+        summary['errors'] += 1
+        logger.warning('Не удалось получить %s из ЮKassa: %s', object_id, provider_object)
+        return False
+    return True
+
+
+def resume_failed_payouts(cutoff, since, summary, concurrency):
+    """Выводы в pending, чей вызов ЮKassa исчерпал попытки без явного отказа.
+
+    Выплата могла быть создана: запрос повторяется с тем же ключом идемпотентности,
+    и ЮKassa возвращает уже созданную выплату. Найденная выплата переводит вывод
+    в processing, явный отказ возвращает списание на баланс. Ключ хранится в ЮKassa
+    сутки, поэтому вызовы старше since не повторяются: это может создать вторую
+    выплату, такие выводы разбираются вручную.
+    """
+    calls = list(ProviderCall.objects.filter(
+        kind='payout', status='failed', withdrawal__status='pending', created_at__lt=cutoff
+    ).order_by('created_at'))
+    for call in calls:
+        if call.created_at < since:
+            summary['checked'] += 1
+            summary['errors'] += 1
+            logger.warning('Вывод %s: ключ выплаты истек, нужна ручная проверка', call.withdrawal_id)
+    calls = [call for call in calls if call.created_at >= since]
+    if not calls:
+        return
+    # Аргументы читаются заранее: потоки fetch не обращаются к базе
+    args = {call.idempotency_key: outbox._payout_args(call) for call in calls}
+    payouts = fetch(
+        list(args), lambda key: create_yookassa_payout(*args[key], idempotency_key=key), concurrency
+    )
+    for call in calls:
+        payout = payouts[call.idempotency_key]
+        with db_transaction.atomic():
+            if isinstance(payout, outbox.REJECTED):
+                summary['checked'] += 1
+                summary['canceled'] += 1
+                outbox._give_up_payout(call)
+                continue
+            if not _found(summary, payout, call.withdrawal_id):
+                summary['checked'] += 1
+                continue
+            # Дальше вывод проверяется вместе с остальными выплатами в processing
+            ProviderCall.objects.filter(pk=call.pk).update(status='done', result={'id': payout.id}, last_error='')
+            outbox._apply_payout(call, {'id': payout.id})
+
+
+def reconcile_payouts(cutoff, since, batch_size, concurrency):
+    summary = Counter()
+    resume_failed_payouts(cutoff, since, summary, concurrency)
+    rows = list(
+        WithdrawalRequest.objects.filter(status='processing', created_at__lt=cutoff)
+        .exclude(yookassa_payout_id='').order_by('created_at').values_list('id', 'yookassa_payout_id')
+    )
+    for chunk in _chunks(rows, batch_size):
+        payouts = fetch([payout_id for _, payout_id in chunk], find_payout, concurrency)
+        summary['checked'] += len(chunk)
+        with db_transaction.atomic():
+            # Повторная проверка статуса: webhook мог успеть раньше
+            withdrawals = WithdrawalRequest.objects.select_for_update().filter(
+                pk__in=[pk for pk, _ in chunk], status='processing'
+            )
+            changed = {'succeeded': [], 'canceled': []}
+            for withdrawal in withdrawals:
+                # Строка могла смениться после выборки: ее проверит следующая сверка
+                payout = payouts.get(withdrawal.yookassa_payout_id)
+                if payout is None:
+                    summary['unchanged'] += 1
+                    continue
+                if not _found(summary, payout, withdrawal.yookassa_payout_id):
+                    continue
+                if payout.status not in changed:
+                    summary['unchanged'] += 1
+                    continue
+                changed[payout.status].append(withdrawal)
+                summary[payout.status] += 1
+            for new_status, items in changed.items():
+                WithdrawalRequest.objects.filter(pk__in=[w.pk for w in items]).update(status=new_status)
+            ledger.record_refunds(changed['canceled'])
+    return summary
+
+
+def _record_paid(paid):
+    TrackRequest.objects.bulk_update(paid, ['is_paid', 'transaction_id', 'status'])
+    ledger.record_deposits(paid)
+    analytics.record_events(paid, 'paid')
+    for track_request in paid:
+        publish_request_event(track_request, 'paid')
+
+
+def reconcile_payments(cutoff, since, batch_size, concurrency):
+    summary = Counter()
+    rows = list(
+        TrackRequest.objects.filter(
+            status__in=['pending', 'expired'], is_paid=False, payment_id__gt='',
+            created_at__lt=cutoff, created_at__gte=since
+        ).order_by('created_at').values_list('id', 'payment_id')
+    )
+    for chunk in _chunks(rows, batch_size):
+        payments = fetch([payment_id for _, payment_id in chunk], find_payment, concurrency)
+        summary['checked'] += len(chunk)
+        with db_transaction.atomic():
+            track_requests = TrackRequest.objects.select_for_update(of=('self',)).filter(
+                pk__in=[pk for pk, _ in chunk], is_paid=False
+            )
+            paid, canceled = [], []
+            for track_request in track_requests:
+                # Платеж могли пересоздать после выборки: его проверит следующая сверка
+                payment = payments.get(track_request.payment_id)
+                if payment is None:
+                    summary['unchanged'] += 1
+                    continue
+                if not _found(summary, payment, track_request.payment_id):
+                    continue
+                if payment.status == 'succeeded':
+                    track_request.is_paid = True
+                    track_request.transaction_id = payment.id
+                    if track_request.status == 'expired':
+                        track_request.status = 'pending'
+                    paid.append(track_request)
+                elif payment.status == 'canceled':
+                    canceled.append(track_request.pk)
+                else:
+                    summary['unchanged'] += 1
+
+            _record_paid(paid)
+            # Отмененный платеж больше не в пути: гость может создать новый
+            TrackRequest.objects.filter(pk__in=canceled).update(payment_id='')
+            ProviderCall.objects.filter(kind='payment', track_request_id__in=canceled, status='done').update(
+                status='failed', last_error='Платеж отменен'
+            )
+            summary['succeeded'] += len(paid)
+            summary['canceled'] += len(canceled)
+    reconcile_archived_payments(cutoff, since, batch_size, concurrency, summary)
+    return summary
+
+
+def reconcile_archived_payments(cutoff, since, batch_size, concurrency, summary):
+    """Запросы, перенесенные в архив с созданным платежом.
+
+    Оплата могла пройти уже после архивации: такой запрос возвращается из
+    архива через expiry.restore и зачисляется так же, как по webhook.
+    """
+    rows = list(
+        ArchivedTrackRequest.objects.filter(
+            payment_id__gt='', created_at__lt=cutoff, created_at__gte=since
+        ).order_by('created_at').values_list('id', 'payment_id')
+    )
+    for chunk in _chunks(rows, batch_size):
+        payments = fetch([payment_id for _, payment_id in chunk], find_payment, concurrency)
+        summary['checked'] += len(chunk)
+        with db_transaction.atomic():
+            # Запрос мог уже вернуть webhook: его строки в архиве больше нет
+            archived = ArchivedTrackRequest.objects.select_for_update().filter(
+                pk__in=[pk for pk, _ in chunk]
+            ).values_list('id', 'payment_token', 'payment_id')
+            paid, canceled = [], []
+            for pk, payment_token, payment_id in archived:
+                payment = payments.get(payment_id)
+                if payment is None:
+                    summary['unchanged'] += 1
+                    continue
+                if not _found(summary, payment, payment_id):
+                    continue
+                if payment.status == 'succeeded':
+                    track_request = expiry.restore(payment_token)
+                    track_request.is_paid = True
+                    track_request.transaction_id = payment.id
+                    paid.append(track_request)
+                elif payment.status == 'canceled':
+                    canceled.append(pk)
+                else:
+                    summary['unchanged'] += 1
+
+            _record_paid(paid)
+            ArchivedTrackRequest.objects.filter(pk__in=canceled).update(payment_id='')
+            summary['succeeded'] += len(paid)
+            summary['canceled'] += len(canceled)
+
+
+def run(batch_size=100, concurrency=None, now=None):
+    """Сверяет зависшие выплаты и платежи с ЮKassa; возвращает сводку по каждому виду."""
+    now = now or timezone.now()
+    concurrency = concurrency or getattr(settings, 'RECONCILE_CONCURRENCY', 8)
+    cutoff = now - getattr(settings, 'RECONCILE_STALE_AFTER', timedelta(minutes=15))
+    since = now - getattr(settings, 'RECONCILE_PAYMENT_MAX_AGE', timedelta(days=2))
+    replay_since = now - getattr(settings, 'RECONCILE_PAYOUT_REPLAY_WINDOW', timedelta(hours=23))
+    return {
+        'payouts': reconcile_payouts(cutoff, replay_since, batch_size, concurrency),
+        'payments': reconcile_payments(cutoff, since, batch_size, concurrency),
+    }
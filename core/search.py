@@ -0,0 +1,76 @@
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import BaseFilterBackend
+
+from .models import Track
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MAX_TOKENS = 8
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(query.lower())[:MAX_TOKENS]
+
+
+def search_tracks(queryset, query):
+    """Фильтрует треки по поисковой строке и сортирует по релевантности.
+
+    Каждое слово ищется как префикс, чтобы поиск работал по мере ввода.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return queryset
+
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        return _search_sqlite(queryset, tokens)
+    if vendor == 'postgresql':
+        return _search_postgresql(queryset, tokens, query)
+
+    condition = Q()
+    for token in tokens:
+        condition &= Q(title__icontains=token) | Q(artist__icontains=token)
+    return queryset.filter(condition)
+
+
+def _search_sqlite(queryset, tokens):
+    table = Track._meta.db_table
+    match = ' '.join(f'"{token}"*' for token in tokens)
+    return queryset.extra(
+        tables=[f'{table}_fts'],
+        where=[f'{table}_fts.rowid = {table}.id', f'{table}_fts MATCH %s'],
+        params=[match],
+        select={'search_rank': f'{table}_fts.rank'},
+        order_by=['search_rank', 'id'],
+    )
+
+
+def _search_postgresql(queryset, tokens, query):
+    table = Track._meta.db_table
+    document = f"({table}.title || ' ' || {table}.artist)"
+    vector = f"to_tsvector('simple', {document})"
+    tsquery = ' & '.join(f'{token}:*' for token in tokens)
+    return queryset.filter(
+        RawSQL(
+            f"({vector} @@ to_tsquery('simple', %s) OR {document} %% %s)",
+            [tsquery, query],
+            output_field=BooleanField()
+        )
+    ).annotate(
+        search_rank=RawSQL(
+            f"ts_rank({vector}, to_tsquery('simple', %s)) + similarity({document}, %s)",
+            [tsquery, query],
+            output_field=FloatField()
+        )
+    ).order_by('-search_rank', 'id')
+
+
+class TrackSearchFilter(BaseFilterBackend):
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '')
+        return search_tracks(queryset, query)
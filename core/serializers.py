@@ -1,8 +1,13 @@
+from datetime import timedelta
+
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
 from rest_framework import serializers
 from .models import *
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.db import transaction
+from . import ledger, projections
+from .caching import genres
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
@@ -20,27 +25,60 @@ class GenreSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class CachedGenreField(serializers.PrimaryKeyRelatedField):
+    """Проверяет genre_id по кешу жанров процесса вместо запроса к базе."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            genre = genres.get(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if genre is None:
+            self.fail('does_not_exist', pk_value=data)
+        return genre
+
+
 class TrackSerializer(serializers.ModelSerializer):
-    genre = GenreSerializer(read_only=True)
-    genre_id = serializers.PrimaryKeyRelatedField(
+    genre = serializers.SerializerMethodField()
+    genre_id = CachedGenreField(
         queryset=Genre.objects.all(),
         source='genre',
         write_only=True
     )
 
+    @staticmethod
+    def get_genre(obj):
+        return projections.genre(obj.genre_id)
+
     class Meta:
         model = Track
         fields = ['id', 'title', 'icon', 'genre', 'genre_id', 'artist', 'price']
 
 
+class TrackImportRowSerializer(serializers.Serializer):
+    title = serializers.CharField(max_length=100)
+    artist = serializers.CharField(max_length=100)
+    icon = serializers.CharField(max_length=1000)
+    price = serializers.IntegerField(min_value=1)
+    genre = serializers.CharField(max_length=100, required=False)
+    genre_id = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        if 'genre' not in attrs and 'genre_id' not in attrs:
+            raise serializers.ValidationError("Укажите genre или genre_id")
+        return attrs
+
+
 class TrackRequestSerializer(serializers.ModelSerializer):
-    min_fee = serializers.SerializerMethodField()
-    track = TrackSerializer(read_only=True)
+    track = serializers.SerializerMethodField()
     payment_url = serializers.SerializerMethodField()
 
     @staticmethod
-    def get_min_fee(obj):
-        return obj.track.price
+    def get_track(obj):
+        # Снимок трека на момент запроса, см. TrackRequest.snapshot_track
+        return projections.requested_track({name: getattr(obj, name) for name in projections.TRACK_SNAPSHOT_FIELDS})
 
     def validate_user_fee(self, value):
         track_id = self.initial_data.get('track')
@@ -50,13 +88,14 @@ class TrackRequestSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Недостаточно данных для создания запроса")
 
         try:
-            track = Track.objects.get(pk=track_id, venue_id=venue_id)
-        except ObjectDoesNotExist:
+            # Трек передается дальше в save(), жанр для ответа берется из кеша
+            self.validated_track = Track.objects.get(pk=track_id, venue_id=venue_id)
+        except (ObjectDoesNotExist, ValueError, TypeError):
             raise serializers.ValidationError("Указанный трек не добавлен в данное заведение")
 
-        if value < track.price:
+        if value < self.validated_track.price:
             raise serializers.ValidationError(
-                f"Сумма должна быть не меньше {track.price}"
+                f"Сумма должна быть не меньше {self.validated_track.price}"
             )
         return value
 
@@ -72,7 +111,22 @@ class TrackRequestSerializer(serializers.ModelSerializer):
         read_only_fields = ['payment_url', 'is_paid', 'payment_token', 'created_at', 'min_fee']
 
 
+class TrackRequestStatusSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=['accepted', 'rejected'])
+
+
+class TrackRequestBulkUpdateSerializer(serializers.Serializer):
+    items = TrackRequestStatusSerializer(many=True, allow_empty=False, max_length=200)
+
+
 class VenueSerializer(serializers.ModelSerializer):
+    balance = serializers.SerializerMethodField()
+
+    @staticmethod
+    def get_balance(obj):
+        return ledger.get_balance(obj.pk)
+
     class Meta:
         model = Venue
         fields = ['id', 'name', 'city', 'phone', 'qr_code', 'balance']
@@ -176,6 +230,35 @@ class WithdrawalSerializer(serializers.ModelSerializer):
         return value
 
 
+class LedgerExportFilterSerializer(serializers.Serializer):
+    date_from = serializers.DateTimeField(required=False, input_formats=['iso-8601', '%Y-%m-%d'])
+    date_to = serializers.DateTimeField(required=False, input_formats=['iso-8601', '%Y-%m-%d'])
+    venue = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    def validate(self, attrs):
+        if 'date_from' in attrs and 'date_to' in attrs and attrs['date_from'] >= attrs['date_to']:
+            raise serializers.ValidationError("date_from должна быть раньше date_to")
+        return attrs
+
+
+class AnalyticsQuerySerializer(serializers.Serializer):
+    MAX_DAYS = 366
+
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+    def validate(self, attrs):
+        attrs.setdefault('date_to', timezone.localdate())
+        attrs.setdefault('date_from', attrs['date_to'] - timedelta(days=29))
+        days = (attrs['date_to'] - attrs['date_from']).days + 1
+        if days < 1:
+            raise serializers.ValidationError("date_from должна быть не позже date_to")
+        if days > self.MAX_DAYS:
+            raise serializers.ValidationError(f"Период не может быть длиннее {self.MAX_DAYS} дней")
+        return attrs
+
+
 class TransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Transaction
@@ -1,14 +1,352 @@
-from yookassa import Configuration, Payment, Payout
+import asyncio
+import itertools
+import threading
+import time
+import uuid
+import weakref
+from collections import defaultdict, deque
+
+import requests
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from requests.adapters import HTTPAdapter
+from yookassa import Configuration, Payment, Payout
+from yookassa.client import ApiClient
+from yookassa.domain.common import HttpVerb, RequestObject
+from yookassa.domain.exceptions import (
+    ApiError, BadRequestError, ForbiddenError, InternalServerError, NotFoundError, ResponseProcessingError,
+    TooManyRequestsError, UnauthorizedError
+)
+from yookassa.domain.request import PaymentRequest, PayoutRequest
+from yookassa.domain.response import PaymentResponse, PayoutResponse
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 Configuration.configure(settings.YOOKASSA_SHOP_ID, settings.YOOKASSA_SECRET_KEY)
 
 
-def create_yookassa_payment(amount, payment_token, description):
+class ProviderUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Перестает обращаться к ЮKassa после серии ошибок подряд.
+
+    Пока цепь разомкнута, вызовы сразу завершаются ProviderUnavailable.
+    По истечении reset_timeout пропускается один пробный запрос: успех
+    замыкает цепь, ошибка снова размыкает ее.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        with self._lock:
+            state = self._state()
+            if state == 'open' or (state == 'half-open' and self._trial_in_flight):
+                raise ProviderUnavailable('ЮKassa временно недоступна')
+            if state == 'half-open':
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def reset(self):
+        self.record_success()
+
+
+class LatencyStats:
+    sample_size = 1000
+
+    def __init__(self):
+        self._calls = defaultdict(int)
+        self._errors = defaultdict(int)
+        self._samples = defaultdict(lambda: deque(maxlen=self.sample_size))
+        self._lock = threading.Lock()
+
+    def record(self, operation, elapsed, ok):
+        with self._lock:
+            self._calls[operation] += 1
+            if not ok:
+                self._errors[operation] += 1
+            self._samples[operation].append(elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for operation, samples in self._samples.items():
+                ordered = sorted(samples)
+                result[operation] = {
+                    'calls': self._calls[operation],
+                    'errors': self._errors[operation],
+                    'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+                    'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+                    'max_ms': round(ordered[-1] * 1000, 2),
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._errors.clear()
+            self._samples.clear()
+
+
+def percentile(ordered, value):
+    if not ordered:
+        return 0
+    index = min(len(ordered) - 1, int(round(value / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+breaker = CircuitBreaker(
+    failure_threshold=getattr(settings, 'YOOKASSA_BREAKER_THRESHOLD', 5),
+    reset_timeout=getattr(settings, 'YOOKASSA_BREAKER_RESET_TIMEOUT', 30)
+)
+stats = LatencyStats()
+
+_session = None
+_session_lock = threading.Lock()
+
+# Повторы при ответе 202 (ЮKassa еще обрабатывает запрос) и при ошибке соединения, с тем же
+# ключом идемпотентности. Все попытки вместе укладываются в YOOKASSA_DEADLINE.
+RETRIES = 2
+RETRY_BACKOFF = 0.2
+
+API_ERRORS = {
+    error.HTTP_CODE: error
+    for error in (
+        BadRequestError, ForbiddenError, NotFoundError, TooManyRequestsError, UnauthorizedError,
+        ResponseProcessingError, InternalServerError
+    )
+}
+
+
+def get_session():
+    # Одна сессия на процесс: соединения keep-alive переиспользуются между запросами
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = getattr(settings, 'YOOKASSA_POOL_SIZE', 10)
+            # Повторы выполняет PooledApiClient.execute в пределах срока вызова
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def call_deadline():
+    return time.monotonic() + getattr(settings, 'YOOKASSA_DEADLINE', 15)
+
+
+def attempt_timeouts(deadline):
+    """(connect, read) очередной попытки: не дольше, чем осталось до срока вызова."""
+    remaining = max(deadline - time.monotonic(), 0.001)
+    return (
+        min(getattr(settings, 'YOOKASSA_CONNECT_TIMEOUT', 3), remaining),
+        min(getattr(settings, 'YOOKASSA_READ_TIMEOUT', 10), remaining)
+    )
+
+
+def backoff(attempt, deadline):
+    """Пауза перед повтором; None - попытки или время вызова кончились."""
+    pause = RETRY_BACKOFF * 2 ** attempt
+    if attempt >= RETRIES or time.monotonic() + pause >= deadline:
+        return None
+    return pause
+
+
+def raise_api_error(raw_response):
+    """Исключение SDK ЮKassa по коду ответа, как в yookassa.client.ApiClient."""
+    try:
+        content = raw_response.json()
+    except ValueError:
+        content = {'type': 'error', 'description': raw_response.text[:1000]}
+    raise API_ERRORS.get(raw_response.status_code, ApiError)(content)
+
+
+def record_response(operation, started, raw_response):
+    ok = raw_response.status_code < 500 and raw_response.status_code != 429
+    stats.record(operation, time.perf_counter() - started, ok=ok)
+    if ok:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+
+def record_error(operation, started, exc):
+    stats.record(operation, time.perf_counter() - started, ok=False)
+    breaker.record_failure()
+    return ProviderUnavailable(str(exc))
+
+
+class PooledApiClient(ApiClient):
+    def __init__(self):
+        super().__init__()
+        self.endpoint = getattr(settings, 'YOOKASSA_API_URL', None) or self.endpoint
+
+    def request(self, method="", path="", query_params=None, headers=None, body=None):
+        if isinstance(body, RequestObject):
+            body.validate()
+            body = dict(body)
+
+        raw_response = self.execute(body, method, path, query_params, self.prepare_request_headers(headers))
+        if raw_response.status_code != 200:
+            raise_api_error(raw_response)
+        return raw_response.json()
+
+    def execute(self, body, method, path, query_params, request_headers):
+        operation = f"{str(method).upper()} /{path.strip('/').split('/')[0]}"
+        breaker.before_call()
+        deadline = call_deadline()
+        started = time.perf_counter()
+        try:
+            for attempt in itertools.count():
+                try:
+                    raw_response = get_session().request(
+                        method,
+                        self.endpoint + path,
+                        params=query_params,
+                        headers=request_headers,
+                        json=body,
+                        verify=self.configuration.verify,
+                        timeout=attempt_timeouts(deadline)
+                    )
+                except requests.ConnectionError:
+                    # Таймаут чтения не повторяется: ответ мог просто не успеть, а срок уже потрачен
+                    pause = backoff(attempt, deadline)
+                    if pause is None:
+                        raise
+                else:
+                    pause = backoff(attempt, deadline) if raw_response.status_code == 202 else None
+                    if pause is None:
+                        break
+                time.sleep(pause)
+        except requests.RequestException as exc:
+            raise record_error(operation, started, exc) from exc
+
+        record_response(operation, started, raw_response)
+        return raw_response
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client(verify=True):
+    """httpx.AsyncClient текущего цикла событий: соединения переиспользуются между запросами.
+
+    Клиент привязан к циклу, поэтому у каждого цикла (воркера ASGI) он свой.
+    """
+    if httpx is None:
+        raise ImproperlyConfigured('Для асинхронного клиента ЮKassa установите пакет httpx')
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        pool_size = getattr(settings, 'YOOKASSA_ASYNC_POOL_SIZE', 100)
+        client = httpx.AsyncClient(
+            verify=verify,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        _async_clients[loop] = client
+    return client
+
+
+class AsyncPooledApiClient(PooledApiClient):
+    """PooledApiClient для ASGI: пока ЮKassa отвечает, поток не занят.
+
+    Общие с синхронным клиентом размыкатель цепи, статистика задержек и срок вызова.
+    """
+
+    async def request(self, method="", path="", query_params=None, headers=None, body=None):
+        if isinstance(body, RequestObject):
+            body.validate()
+            body = dict(body)
+
+        raw_response = await self.execute(body, method, path, query_params, self.prepare_request_headers(headers))
+        if raw_response.status_code != 200:
+            raise_api_error(raw_response)
+        return raw_response.json()
+
+    async def execute(self, body, method, path, query_params, request_headers):
+        operation = f"{str(method).upper()} /{path.strip('/').split('/')[0]}"
+        breaker.before_call()
+        client = get_async_client(self.configuration.verify)
+        deadline = call_deadline()
+        started = time.perf_counter()
+        try:
+            for attempt in itertools.count():
+                connect, read = attempt_timeouts(deadline)
+                try:
+                    raw_response = await client.request(
+                        method,
+                        self.endpoint + path,
+                        params=query_params,
+                        headers=request_headers,
+                        json=body,
+                        timeout=httpx.Timeout(read, connect=connect)
+                    )
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    pause = backoff(attempt, deadline)
+                    if pause is None:
+                        raise
+                else:
+                    pause = backoff(attempt, deadline) if raw_response.status_code == 202 else None
+                    if pause is None:
+                        break
+                await asyncio.sleep(pause)
+        except httpx.HTTPError as exc:
+            raise record_error(operation, started, exc) from exc
+
+        record_response(operation, started, raw_response)
+        return raw_response
+
+
+class PooledPayment(Payment):
+    def __init__(self):
+        self.client = PooledApiClient()
+
+
+class PooledPayout(Payout):
+    def __init__(self):
+        self.client = PooledApiClient()
+
+
+def payment_params(amount, payment_token, description):
     if not isinstance(amount, (int, float)) or amount <= 0:
         raise ValueError("Invalid amount value")
 
-    return Payment.create({
+    return {
         "amount": {
             "value": f"{amount:.2f}",
             "currency": "RUB"
@@ -23,16 +361,31 @@ def create_yookassa_payment(amount, payment_token, description):
             "payment_token": str(payment_token),
             "user_id": str(payment_token)
         }
-    })
+    }
+
+
+def create_yookassa_payment(amount, payment_token, description, idempotency_key=None):
+    return PooledPayment.create(payment_params(amount, payment_token, description), idempotency_key)
+
+
+async def acreate_yookassa_payment(amount, payment_token, description, idempotency_key=None):
+    params = PooledPayment().add_default_cms_name(PaymentRequest(payment_params(amount, payment_token, description)))
+    response = await AsyncPooledApiClient().request(
+        HttpVerb.POST, Payment.base_path, None, {'Idempotence-Key': str(idempotency_key or uuid.uuid4())}, params
+    )
+    return PaymentResponse(response)
+
+
+def find_payment(payment_id):
+    return PooledPayment.find_one(payment_id)
 
 
 def create_card_token(card_data):
-    response = Configuration.configure(settings.YOOKASSA_SHOP_ID, settings.YOOKASSA_SECRET_KEY)
     return "mock_token_123"
 
 
-def create_yookassa_payout(amount, fee, card_token):
-    return Payout.create({
+def payout_params(amount, fee, card_token):
+    return {
         "amount": {
             "value": amount - fee,
             "currency": "RUB"
@@ -47,4 +400,20 @@ def create_yookassa_payout(amount, fee, card_token):
         "metadata": {
             "fee": fee
         }
-    })
+    }
+
+
+def create_yookassa_payout(amount, fee, card_token, idempotency_key=None):
+    return PooledPayout.create(payout_params(amount, fee, card_token), idempotency_key)
+
+
+async def acreate_yookassa_payout(amount, fee, card_token, idempotency_key=None):
+    response = await AsyncPooledApiClient().request(
+        HttpVerb.POST, Payout.base_path, None, {'Idempotence-Key': str(idempotency_key or uuid.uuid4())},
+        PayoutRequest(payout_params(amount, fee, card_token))
+    )
+    return PayoutResponse(response)
+
+
+def find_payout(payout_id):
+    return PooledPayout.find_one(payout_id)
@@ -1,8 +1,64 @@
-from django.db.models.signals import pre_delete
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from .models import Venue
+from . import authentication, middleware, qr
+from .caching import bump_catalog_version, bump_genres_version
+from .models import BalanceCheckpoint, Genre, Track, Venue
+
+@receiver(connection_created)
+def count_asgi_queries(sender, connection, **kwargs):
+    middleware.install_counter(connection)
+
 
 @receiver(pre_delete, sender=Venue)
 def delete_dj_files(sender, instance, **kwargs):
-    if instance.qr_code:
-        instance.qr_code.delete(save=False)
+    qr.delete_venue_codes(instance.pk, instance.qr_code.name)
+
+
+@receiver(post_save, sender=Venue)
+def create_balance_checkpoint(sender, instance, created, **kwargs):
+    if created:
+        BalanceCheckpoint.objects.create(venue=instance, balance=instance.balance)
+
+
+@receiver(post_save, sender=Venue)
+def generate_qr_code(sender, instance, created, **kwargs):
+    if created and not instance.qr_code:
+        venue_id = instance.pk
+        transaction.on_commit(lambda: qr.schedule_generation(venue_id))
+
+
+@receiver(post_save, sender=Track)
+@receiver(post_delete, sender=Track)
+def invalidate_venue_catalog(sender, instance, **kwargs):
+    # Повторный сброс после коммита отбрасывает записи, которые другие воркеры
+    # успели собрать из еще не закоммиченных данных
+    venue_id = instance.venue_id
+    bump_catalog_version(venue_id)
+    transaction.on_commit(lambda: bump_catalog_version(venue_id))
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def invalidate_genres(sender, instance, **kwargs):
+    bump_genres_version()
+    transaction.on_commit(bump_genres_version)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_state(sender, instance, **kwargs):
+    # Блокировка, удаление и смена пароля сразу действуют на уже выданные токены
+    user_id = instance.pk
+    authentication.invalidate_user_state(user_id)
+    transaction.on_commit(lambda: authentication.invalidate_user_state(user_id))
+
+
+@receiver(post_save, sender=Venue)
+@receiver(post_delete, sender=Venue)
+def invalidate_venue_owner_state(sender, instance, **kwargs):
+    user_id = instance.user_id
+    authentication.invalidate_user_state(user_id)
+    transaction.on_commit(lambda: authentication.invalidate_user_state(user_id))
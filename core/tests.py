@@ -1,7 +1,280 @@
-from django.urls import reverse
-from rest_framework import status
-from rest_framework.test import APITestCase, APIClient
+import importlib
+import io
+import json
+import math
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import timedelta
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import addModuleCleanup, mock, skipUnless
+
+import requests
+from asgiref.sync import async_to_sync, sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from rest_framework import generics, status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.test import APITestCase, APIClient, APITransactionTestCase
+from yookassa.domain.exceptions import BadRequestError, NotFoundError, ResponseProcessingError
+from server import databases
+from . import (
+    analytics, async_views, authentication, benchmark, caching, checks, expiry, idempotency, ledger, outbox, projections,
+    qr, reconciliation, throttling, views
+)
+from .caching import get_or_build
+from .fake_yookassa import FakeYooKassa
+from .imports import iter_json_array
+from .middleware import AdmissionControlMiddleware
+from .projections import ProjectionListMixin
+from .events import DatabaseBroker, _brokers, format_sse, get_broker
 from .models import *
+from .serializers import (
+    CustomTokenObtainPairSerializer, TrackRequestSerializer, TrackSerializer, TransactionSerializer, WithdrawalSerializer
+)
+from .services import (
+    CircuitBreaker, ProviderUnavailable, acreate_yookassa_payment, breaker, create_yookassa_payment, find_payment,
+    get_async_client, get_session, stats
+)
+from .webhooks import mark_paid, process_batch
+
+
+def setUpModule():
+    # Лимиты действуют во всех тестах, но корзины в памяти: файл в /dev/shm пережил бы прогон,
+    # а id заведений в новой тестовой базе начинаются заново
+    store = override_settings(RATE_LIMIT_BACKEND='core.throttling.MemoryBucketStore')
+    store.enable()
+    addModuleCleanup(store.disable)
+
+
+class QueryBudgetTests(APITestCase):
+    """Бюджет запросов к базе для каждого маршрута core/urls.py.
+
+    Новый маршрут без бюджета роняет test_every_route_has_budget, а рост числа
+    запросов с размером страницы - тесты на N+1 ниже.
+    """
+
+    # Маршрут -> максимум запросов к базе; None - маршрут не проверяется
+    BUDGETS = {
+        'token_obtain_pair': 2,
+        'register': 6,
+        'genres': 0,
+        'profile': 2,
+        'venue-qr': 1,
+        'tracks-list': 1,
+        'tracks-import': 5,
+        'track-detail': 1,
+        'track-request-create': 7,
+        'track-request-list': 1,
+        'track-request-bulk-update': 7,
+        'track-request-stream': None,  # бесконечный SSE-поток под ASGI
+        'track-request-update': 9,  # строка перечитывается под блокировкой
+        'withdrawal-create': 7,
+        'mock-payment': 7,
+        'analytics': 3,
+        'transaction-list': 1,
+        'transaction-export': 1,
+        'withdrawal-export': 1,
+        'withdrawal-history': 1,
+        'create-payment': 12,  # очередь вызовов: запись, захват, результат - отдельные короткие транзакции
+        'payment-webhook': 3,
+        'withdrawal-webhook': 3,
+        'mock-withdrawal': 8,  # сумма журнала читается отдельным запросом после блокировки баланса
+    }
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        cache.clear()
+        self.user = User.objects.create_user(username='budget', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Budget', city='City', phone='+79123456789')
+        self.genre = Genre.objects.create(name='Rock')
+        self.track = Track.objects.create(venue=self.venue, genre=self.genre, title='T', artist='A', price=100)
+        # Настоящий токен, а не force_authenticate: бюджет включает аутентификацию
+        token = CustomTokenObtainPairSerializer.get_token(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.grow(3)
+        # Бюджеты считаются для работающего процесса с прогретыми кешами жанров и пользователей
+        caching.genres.all()
+        authentication.get_user_state(self.user.pk)
+
+    def grow(self, count):
+        for _ in range(count):
+            genre = Genre.objects.create(name='G')
+            track = Track.objects.create(venue=self.venue, genre=genre, title='T', artist='A', price=100)
+            track_request = TrackRequest.objects.create(track=track, user_fee=150, is_paid=True)
+            ledger.record(self.venue.id, 1000, 'deposit', track_request=track_request)
+            WithdrawalRequest.objects.create(venue=self.venue, amount=500, bank_card_token='t', yookassa_payout_id='p')
+
+    def call(self, name, method='get', kwargs=None, data=None, format=None, **extra):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(reverse(name, kwargs=kwargs), data, format=format, **extra)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 500, name)
+        return response, len(queries)
+
+    def assertQueryBudget(self, name, *args, **kwargs):
+        response, count = self.call(name, *args, **kwargs)
+        self.assertLessEqual(count, self.BUDGETS[name], f'{name}: {count} запросов к базе')
+        return response
+
+    def scenarios(self):
+        pending = TrackRequest.objects.filter(venue=self.venue).first()
+        venue = {'venue_id': self.venue.id}
+        return [
+            ('token_obtain_pair', 'post', None, {'username': 'budget', 'password': 'testpass123'}),
+            ('register', 'post', None, {
+                'username': 'new', 'password': 'newpass123', 'email': 'n@example.com',
+                'name': 'New', 'city': 'City', 'phone': '+79123456789'
+            }),
+            ('genres', 'get', None, None),
+            ('profile', 'get', None, None),
+            ('venue-qr', 'get', venue, None),
+            ('tracks-list', 'get', venue, None),
+            ('tracks-import', 'post', venue, {
+                'file': SimpleUploadedFile('c.csv', b'title,artist,genre,price,icon\nN,A,Rock,100,i\n')
+            }, 'multipart'),
+            ('track-detail', 'get', {'venue_id': self.venue.id, 'track_id': self.track.id}, None),
+            ('track-request-create', 'post', venue, {'track': self.track.id, 'user_fee': 150}),
+            ('track-request-list', 'get', None, None),
+            ('track-request-bulk-update', 'post', None, {
+                'items': [{'id': pending.id, 'status': 'rejected'}]
+            }, 'json'),
+            ('track-request-update', 'patch', {'pk': TrackRequest.objects.filter(status='pending').last().pk},
+             {'status': 'accepted'}),
+            ('withdrawal-create', 'post', None, {
+                'amount': 500, 'card_number': '4111111111111111', 'card_expiry_year': '2030',
+                'card_expiry_month': '12', 'card_csc': '123'
+            }),
+            ('mock-payment', 'post', {
+                'payment_token': TrackRequest.objects.create(track=self.track, user_fee=150).payment_token
+            }, None),
+            ('analytics', 'get', None, None),
+            ('transaction-list', 'get', None, None),
+            ('transaction-export', 'get', None, {'format': 'csv'}),
+            ('withdrawal-export', 'get', None, {'format': 'ndjson'}),
+            ('withdrawal-history', 'get', None, None),
+            ('create-payment', 'post', {'payment_token': pending.payment_token}, None),
+            ('payment-webhook', 'post', None, {'event': 'payment.succeeded', 'object': {'id': 'pay_1'}}, 'json'),
+            ('withdrawal-webhook', 'post', None, {'event': 'payout.succeeded', 'object': {'id': 'po_1'}}, 'json'),
+            ('mock-withdrawal', 'post', None, {
+                'amount': 500, 'card_number': '4111111111111111', 'card_expiry_year': '2030',
+                'card_expiry_month': '12', 'card_csc': '123'
+            }),
+        ]
+
+    def test_every_route_has_budget(self):
+        from .urls import urlpatterns
+        self.assertEqual({pattern.name for pattern in urlpatterns}, set(self.BUDGETS))
+        checked = {scenario[0] for scenario in self.scenarios()}
+        self.assertEqual(checked, {name for name, budget in self.BUDGETS.items() if budget is not None})
+
+    @mock.patch('core.outbox.create_yookassa_payout', return_value=SimpleNamespace(id='po_1'))
+    @mock.patch('core.outbox.create_yookassa_payment')
+    def test_routes_within_budget(self, create_payment, create_payout):
+        create_payment.return_value = SimpleNamespace(
+            id='pay_1', confirmation=SimpleNamespace(confirmation_url='https://pay.example.com')
+        )
+        for name, method, kwargs, data, *format in self.scenarios():
+            with self.subTest(name):
+                self.assertQueryBudget(name, method, kwargs, data, *format)
+
+    def test_lists_do_not_grow_with_page_size(self):
+        lists = [
+            ('genres', None, None),
+            ('tracks-list', {'venue_id': self.venue.id}, None),
+            ('track-request-list', None, None),
+            ('transaction-list', None, None),
+            ('withdrawal-history', None, None),
+            ('transaction-export', None, {'format': 'csv'}),
+            ('withdrawal-export', None, {'format': 'csv'}),
+            ('analytics', None, None),
+        ]
+        before = {name: self.call(name, 'get', kwargs, data)[1] for name, kwargs, data in lists}
+        self.grow(20)
+        analytics.rebuild(self.venue.id)
+        cache.clear()
+        caching.genres.all()
+        authentication.get_user_state(self.user.pk)
+        after = {name: self.call(name, 'get', kwargs, data)[1] for name, kwargs, data in lists}
+        self.assertEqual(after, before)
+
+    @override_settings(QUERY_COUNT_HEADERS=True)
+    def test_debug_headers(self):
+        response = self.client.get(reverse('tracks-list', kwargs={'venue_id': self.venue.id}))
+        self.assertEqual(response['X-DB-Query-Count'], '1')
+        self.assertIn('db;dur=', response['Server-Timing'])
+
+    @override_settings(QUERY_COUNT_HEADERS=False, QUERY_COUNT_WARNING=1)
+    def test_warning_without_headers(self):
+        with self.assertLogs('core.middleware', 'WARNING'):
+            response = self.client.get(reverse('profile'))
+        self.assertNotIn('X-DB-Query-Count', response)
+
+
+class AuthenticationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='owner', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Venue', city='City', phone='+79123456789')
+        self.login(CustomTokenObtainPairSerializer.get_token(self.user).access_token)
+
+    def login(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_user_and_venue_come_from_token_and_cache(self):
+        url = reverse('transaction-list')
+        with self.assertNumQueries(2):
+            # Промах кеша: один запрос за флагами пользователя
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    def test_token_without_venue_claim(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.user).access_token
+        del token['venue_id']
+        self.login(token)
+        Transaction.objects.create(venue=self.venue, amount=100, transaction_type='deposit')
+        response = self.client.get(reverse('transaction-list'))
+        self.assertEqual(len(response.data), 1)
+
+    def test_deactivated_and_deleted_users_are_rejected(self):
+        self.client.get(reverse('transaction-list'))
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('transaction-list')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.user.delete()
+        self.assertEqual(self.client.get(reverse('transaction-list')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(AUTH_USER_STATE_TIMEOUT=60)
+    def test_state_is_cached_until_invalidated(self):
+        self.client.get(reverse('transaction-list'))
+        # Изменение в обход сигналов (другой процесс с локальным кешем) видно только после TTL
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get(reverse('transaction-list')).status_code, status.HTTP_200_OK)
+        authentication.invalidate_user_state(self.user.pk)
+        self.assertEqual(self.client.get(reverse('transaction-list')).status_code, status.HTTP_401_UNAUTHORIZED)
 
 
 class VenueTests(APITestCase):
@@ -42,6 +315,70 @@ class VenueTests(APITestCase):
         self.assertEqual(response.data['name'], 'Test Club')
 
 
+class VenueQRCodeTests(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, QR_RENDER_ASYNC=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        cache.clear()
+
+        self.user = User.objects.create_user(username='qrvenue', password='testpass123')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.venue = Venue.objects.create(user=self.user, name='QR Club', city='City', phone='+79123456789')
+
+    def test_codes_are_generated_after_commit(self):
+        self.venue.refresh_from_db()
+        self.assertEqual(self.venue.qr_code.name, qr.code_name(self.venue.id))
+        for size in qr.get_sizes():
+            self.assertTrue(default_storage.exists(qr.code_name(self.venue.id, size)))
+        self.assertTrue(default_storage.exists(qr.code_name(self.venue.id, fmt='svg')))
+
+    def test_endpoint_serves_sizes_and_svg(self):
+        url = reverse('venue-qr', kwargs={'venue_id': self.venue.id})
+        response = self.client.get(url, {'size': 256})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+        response = self.client.get(url, {'format': 'svg'})
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', response.content)
+
+        etag = self.client.get(url, {'size': 256})['ETag']
+        response = self.client.get(url, {'size': 256}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.assertEqual(self.client.get(url, {'size': 300}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            self.client.get(reverse('venue-qr', kwargs={'venue_id': 999})).status_code,
+            status.HTTP_404_NOT_FOUND
+        )
+
+    def test_cached_code_is_not_rendered_again(self):
+        url = reverse('venue-qr', kwargs={'venue_id': self.venue.id})
+        with mock.patch('core.qr.render') as render:
+            self.client.get(url)
+            default_storage.delete(qr.code_name(self.venue.id))
+            self.client.get(url)
+        render.assert_not_called()
+
+    def test_regenerate_after_domain_change(self):
+        old_name = qr.code_name(self.venue.id)
+        with override_settings(QR='https://new.example.com'):
+            call_command('regenerate_qr_codes', workers=1, stdout=io.StringIO())
+            self.venue.refresh_from_db()
+            self.assertEqual(self.venue.qr_code.name, qr.code_name(self.venue.id))
+            self.assertNotEqual(self.venue.qr_code.name, old_name)
+            self.assertFalse(default_storage.exists(old_name))
+            self.assertTrue(default_storage.exists(self.venue.qr_code.name))
+
+    def test_delete_venue_removes_files(self):
+        name = qr.code_name(self.venue.id)
+        self.venue.delete()
+        self.assertFalse(default_storage.exists(name))
+
+
 class TrackTests(APITestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -83,6 +420,306 @@ class TrackTests(APITestCase):
         self.assertEqual(len(response.data), 1)
 
 
+class TrackSearchTests(APITestCase):
+    def setUp(self):
+        throttling._stores.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.venue = Venue.objects.create(
+            user=self.user,
+            name='Test Venue',
+            city='Test City',
+            phone='+79123456789'
+        )
+        self.genre = Genre.objects.create(name='Test Genre')
+        for title, artist in [
+            ('Smells Like Teen Spirit', 'Nirvana'),
+            ('Come As You Are', 'Nirvana'),
+            ('Группа крови', 'Кино'),
+            ('Spirit in the Sky', 'Norman Greenbaum'),
+        ]:
+            Track.objects.create(venue=self.venue, genre=self.genre, title=title, artist=artist, price=100)
+        self.url = reverse('tracks-list', kwargs={'venue_id': self.venue.id})
+
+    def search(self, query):
+        response = self.client.get(self.url, {'search': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [track['title'] for track in response.data]
+
+    def test_prefix_search(self):
+        self.assertEqual(set(self.search('nirv')), {'Smells Like Teen Spirit', 'Come As You Are'})
+        self.assertEqual(self.search('груп кин'), ['Группа крови'])
+
+    def test_all_words_must_match(self):
+        self.assertEqual(self.search('spirit sky'), ['Spirit in the Sky'])
+
+    def test_index_follows_track_changes(self):
+        track = Track.objects.get(title='Come As You Are')
+        track.title = 'Lithium'
+        track.save()
+        self.assertEqual(self.search('lith'), ['Lithium'])
+        self.assertEqual(self.search('come'), [])
+
+        track.delete()
+        self.assertEqual(self.search('lith'), [])
+
+    def test_search_is_scoped_to_venue(self):
+        other_user = User.objects.create_user(username='other', password='testpass123')
+        other_venue = Venue.objects.create(user=other_user, name='Other', city='City', phone='+79000000000')
+        Track.objects.create(venue=other_venue, genre=self.genre, title='Nirvana Cover', artist='Band', price=100)
+        self.assertNotIn('Nirvana Cover', self.search('nirvana'))
+
+    def test_punctuation_is_ignored(self):
+        self.assertEqual(self.search('"spirit*'), self.search('spirit'))
+        self.assertEqual(len(self.search('***')), 4)
+
+
+class TrackImportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.venue = Venue.objects.create(
+            user=self.user,
+            name='Test Venue',
+            city='Test City',
+            phone='+79123456789'
+        )
+        self.genre = Genre.objects.create(name='Rock')
+        Track.objects.create(
+            venue=self.venue, genre=self.genre, title='Existing', artist='Band', icon='old.png', price=100
+        )
+        self.url = reverse('tracks-import', kwargs={'venue_id': self.venue.id})
+        self.client.force_authenticate(user=self.user)
+
+    def upload(self, name, content, data=None, **params):
+        query = '&'.join(f'{k}={v}' for k, v in params.items())
+        return self.client.post(
+            f'{self.url}?{query}',
+            {'file': SimpleUploadedFile(name, content.encode()), **(data or {})},
+            format='multipart'
+        )
+
+    def test_csv_import_upserts_and_creates_genres(self):
+        content = (
+            'title,artist,genre,price,icon\n'
+            'Existing,Band,Rock,300,new.png\n'
+            'Fresh,Artist,Jazz,150,a.png\n'
+            'Broken,Artist,Jazz,0,a.png\n'
+        )
+        response = self.upload('catalog.csv', content)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['updated'], 1)
+        self.assertEqual(response.data['failed'], 1)
+        self.assertEqual(response.data['errors'][0]['row'], 3)
+        self.assertEqual(response.data['genres_created'], ['Jazz'])
+        self.assertEqual(Track.objects.get(title='Existing').price, 300)
+        self.assertEqual(Track.objects.get(title='Fresh').genre.name, 'Jazz')
+
+    def test_json_and_ndjson(self):
+        rows = [
+            {'title': f'Song {i}', 'artist': 'A', 'genre_id': self.genre.id, 'price': 100, 'icon': 'i'}
+            for i in range(5)
+        ]
+        response = self.upload('catalog.json', json.dumps(rows))
+        self.assertEqual(response.data['created'], 5)
+
+        rows[0]['price'] = 150
+        rows.append({'title': 'Song 5', 'artist': 'A', 'genre_id': 999, 'price': 100, 'icon': 'i'})
+        response = self.upload('catalog.txt', '\n'.join(json.dumps(r) for r in rows), data={'format': 'ndjson'})
+        self.assertEqual((response.data['updated'], response.data['unchanged']), (1, 4))
+        self.assertEqual(response.data['errors'][0]['errors'], {'genre_id': ['Жанр не найден']})
+
+    def test_dry_run_does_not_write(self):
+        response = self.upload('catalog.csv', 'title,artist,genre,price,icon\nNew,A,Pop,100,i\n', dry_run='true')
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['genres_created'], ['Pop'])
+        self.assertFalse(Track.objects.filter(title='New').exists())
+        self.assertFalse(Genre.objects.filter(name='Pop').exists())
+
+    def test_import_is_searchable(self):
+        self.upload('catalog.csv', 'title,artist,genre,price,icon\nImported Tune,A,Rock,100,i\n')
+        response = self.client.get(reverse('tracks-list', kwargs={'venue_id': self.venue.id}), {'search': 'impor'})
+        self.assertEqual([t['title'] for t in response.data], ['Imported Tune'])
+
+    def test_foreign_venue_is_forbidden(self):
+        other_user = User.objects.create_user(username='other', password='testpass123')
+        self.client.force_authenticate(user=other_user)
+        self.assertEqual(self.upload('catalog.csv', 'title\n').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_malformed_json(self):
+        self.assertEqual(self.upload('catalog.json', '[{"title": ').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_json_array_parser_handles_chunk_boundaries(self):
+        rows = [{'n': i, 'value': 'x' * (i % 7)} for i in range(200)]
+        text = io.StringIO(' [ ' + ' , '.join(json.dumps(r) for r in rows) + ' ] ')
+        self.assertEqual(list(iter_json_array(text, read_size=7)), rows)
+
+
+class CatalogCacheTests(APITestCase):
+    def setUp(self):
+        throttling._stores.clear()
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.venue = Venue.objects.create(
+            user=self.user,
+            name='Test Venue',
+            city='Test City',
+            phone='+79123456789'
+        )
+        self.genre = Genre.objects.create(name='Test Genre')
+        self.track = Track.objects.create(
+            venue=self.venue,
+            genre=self.genre,
+            title='Test Track',
+            artist='Test Artist',
+            price=100
+        )
+        self.url = reverse('tracks-list', kwargs={'venue_id': self.venue.id})
+
+    def test_catalog_is_served_from_cache(self):
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_conditional_get(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_track_changes_invalidate_catalog(self):
+        etag = self.client.get(self.url)['ETag']
+        self.track.price = 200
+        self.track.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['price'], 200)
+
+        self.track.delete()
+        self.assertEqual(self.client.get(self.url).data, [])
+
+    def test_genre_rename_invalidates_catalog(self):
+        self.client.get(self.url)
+        self.genre.name = 'Renamed'
+        self.genre.save()
+        self.assertEqual(self.client.get(self.url).data[0]['genre']['name'], 'Renamed')
+
+    def test_track_detail_is_cached(self):
+        self.client.force_authenticate(user=self.user)
+        url = reverse('track-detail', kwargs={'venue_id': self.venue.id, 'track_id': self.track.id})
+        response = self.client.get(url)
+        self.assertEqual(response.data['title'], 'Test Track')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_only_one_worker_rebuilds_cold_entry(self):
+        builds = []
+        cache.add('catalog:test:lock', 1, 5)
+
+        def build():
+            builds.append(1)
+            return {'value': 1}
+
+        def fill_later():
+            time.sleep(0.1)
+            cache.set('catalog:test', ('"etag"', {'value': 0}))
+
+        thread = threading.Thread(target=fill_later)
+        thread.start()
+        etag, data = get_or_build('catalog:test', build)
+        thread.join()
+
+        self.assertEqual(builds, [])
+        self.assertEqual(data, {'value': 0})
+
+    def test_deploy_check_rejects_process_local_cache(self):
+        local = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache_table'}}
+        with override_settings(DEBUG=False, CACHES=local):
+            self.assertEqual([e.id for e in checks.check_shared_cache(None)], ['core.E001'])
+        with override_settings(DEBUG=True, CACHES=local):
+            self.assertEqual(checks.check_shared_cache(None), [])
+        with override_settings(DEBUG=False, CACHES=shared):
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+    def test_database_cache_lock_is_shared_between_workers(self):
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache_table'}}
+        with override_settings(CACHES=shared):
+            call_command('createcachetable', verbosity=0)
+            # Отдельные экземпляры бэкенда, как в разных воркерах
+            first, second = caches.create_connection('default'), caches.create_connection('default')
+            self.assertTrue(first.add('catalog:1:lock', 1, 5))
+            self.assertFalse(second.add('catalog:1:lock', 1, 5))
+            first.set('catalog:version', 2)
+            self.assertEqual(second.get('catalog:version'), 2)
+
+
+class GenreCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Test Venue', city='Test City', phone='+79123456789')
+        self.genre = Genre.objects.create(name='Rock')
+        self.client.force_authenticate(user=self.user)
+        caching.genres.all()
+
+    def test_track_write_does_not_query_genres(self):
+        url = reverse('tracks-list', kwargs={'venue_id': self.venue.id})
+        data = {'genre_id': self.genre.id, 'title': 'Song', 'artist': 'Band', 'icon': 'i', 'price': 150}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['genre'], {'id': self.genre.id, 'name': 'Rock'})
+        genre_table = Genre._meta.db_table
+        self.assertFalse([q['sql'] for q in queries if genre_table in q['sql']])
+
+        data['genre_id'] = 999
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('genre_id', response.data)
+
+    def test_changes_are_visible(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse('genres')).data, [{'id': self.genre.id, 'name': 'Rock'}])
+
+        self.client.post(reverse('genres'), {'name': 'Jazz'})
+        self.genre.name = 'Hard Rock'
+        self.genre.save()
+        names = [genre['name'] for genre in self.client.get(reverse('genres')).data]
+        self.assertEqual(names, ['Hard Rock', 'Jazz'])
+
+    def test_track_page_reads_genre_version_once(self):
+        for index in range(5):
+            Track.objects.create(venue=self.venue, genre=self.genre, title=f'Song {index}', artist='Band', price=100)
+        url = reverse('tracks-list', kwargs={'venue_id': self.venue.id})
+        cache.clear()
+        with mock.patch('core.caching.get_version', wraps=caching.get_version) as get_version:
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(response.data[0]['genre'], {'id': self.genre.id, 'name': 'Rock'})
+        # Версия каталога, версия жанров для ключа кеша и одна загрузка справочника
+        self.assertEqual(
+            [call.args[0] for call in get_version.call_args_list].count(caching.GENRES_VERSION_KEY), 2
+        )
+
+    def test_rows_created_without_signals_are_found(self):
+        created = Genre.objects.bulk_create([Genre(name='Pop')])[0]
+        self.assertEqual(caching.genres.get(created.pk).name, 'Pop')
+        self.assertIsNone(caching.genres.get(999))
+
+
 class TrackRequestTests(APITestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -119,7 +756,7 @@ class TrackRequestTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
-class WithdrawalTests(APITestCase):
+class TrackRequestListTests(APITestCase):
     def setUp(self):
         self.user = User.objects.create_user(
             username='testuser',
@@ -129,26 +766,1706 @@ class WithdrawalTests(APITestCase):
             user=self.user,
             name='Test Venue',
             city='Test City',
-            phone='+79123456789',
-            balance=1000
+            phone='+79123456789'
+        )
+        self.genre = Genre.objects.create(name='Test Genre')
+        self.track = Track.objects.create(
+            venue=self.venue,
+            genre=self.genre,
+            title='Test Track',
+            artist='Test Artist',
+            price=100
         )
+        for i in range(5):
+            TrackRequest.objects.create(track=self.track, user_fee=100 + i, is_paid=i % 2 == 0)
         self.client.force_authenticate(user=self.user)
+        caching.genres.all()
 
-    def test_create_withdrawal(self):
-        url = reverse('withdrawal-create')
-        data = {
-            'amount': 500,
-            'account_details': 'Test Account'
-        }
-        response = self.client.post(url, data)
-        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(WithdrawalRequest.objects.count(), 1)
+    def test_venue_is_copied_from_track(self):
+        self.assertFalse(TrackRequest.objects.exclude(venue=self.venue).exists())
 
-    def test_insufficient_balance(self):
-        url = reverse('withdrawal-create')
-        data = {
-            'amount': 1500,
-            'account_details': 'Test Account'
-        }
-        response = self.client.post(url, data)
-        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+    def test_cursor_pagination(self):
+        url = reverse('track-request-list')
+        response = self.client.get(url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 2)
+
+        seen = [r['id'] for r in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen += [r['id'] for r in response.data['results']]
+        self.assertEqual(sorted(seen), sorted(TrackRequest.objects.values_list('id', flat=True)))
+
+    def test_status_and_is_paid_filters(self):
+        url = reverse('track-request-list')
+        response = self.client.get(url, {'status': 'pending', 'is_paid': 'true'})
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertTrue(all(r['is_paid'] for r in response.data['results']))
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        url = reverse('track-request-list')
+        with CaptureQueriesContext(connection) as small_page:
+            self.client.get(url, {'page_size': 1})
+        with CaptureQueriesContext(connection) as large_page:
+            self.client.get(url, {'page_size': 5})
+        self.assertEqual(len(small_page), len(large_page))
+
+    def test_snapshot_keeps_track_at_request_time(self):
+        Track.objects.filter(pk=self.track.pk).update(title='Renamed', price=500)
+        response = self.client.get(reverse('track-request-list'))
+        for row in response.data['results']:
+            self.assertEqual((row['min_fee'], row['track']['title'], row['track']['price']), (100, 'Test Track', 100))
+            self.assertEqual(row['track']['genre'], {'id': self.genre.id, 'name': 'Test Genre'})
+
+    def test_list_reads_only_track_requests(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('track-request-list'))
+        self.assertEqual(len(response.data['results']), 5)
+        selects = [query['sql'] for query in queries if 'core_trackrequest' in query['sql']]
+        self.assertTrue(selects)
+        for sql in selects:
+            self.assertNotIn('JOIN', sql)
+
+    def test_backfill_fills_snapshot(self):
+        migration = importlib.import_module('core.migrations.0014_trackrequest_track_snapshot')
+        TrackRequest.objects.update(track_title='', track_genre_id=None, track_genre_name='', min_fee=0)
+        Track.objects.filter(pk=self.track.pk).update(price=102)
+        migration.fill_track_snapshot(apps, None)
+        # Текущая цена трека выше user_fee части запросов: берется меньшее
+        self.assertEqual(
+            sorted(TrackRequest.objects.values_list('track_title', 'track_genre_name', 'min_fee')),
+            [('Test Track', 'Test Genre', fee) for fee in (100, 101, 102, 102, 102)]
+        )
+
+
+class ProjectionTests(APITestCase):
+    """Списки на values() должны отдавать ровно то же, что сериализаторы."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Test Venue', city='Test City', phone='+79123456789')
+        genres = [Genre.objects.create(name='Rock'), Genre.objects.create(name='Jazz')]
+        for index in range(4):
+            track = Track.objects.create(
+                venue=self.venue, genre=genres[index % 2], title=f'Song {index}', artist='Band', price=100 + index
+            )
+            TrackRequest.objects.create(
+                track=track,
+                user_fee=150 + index,
+                is_paid=index % 2 == 0,
+                status='accepted' if index == 0 else 'pending',
+                payment_id=f'pay-{index}' if index % 2 else ''
+            )
+            Transaction.objects.create(venue=self.venue, amount=100 * (index + 1), transaction_type='deposit')
+            WithdrawalRequest.objects.create(venue=self.venue, amount=500 + index, fee=index, bank_card_token='tok')
+        self.client.force_authenticate(user=self.user)
+
+    @staticmethod
+    def dump(data):
+        # Сравнение строк JSON проверяет и порядок ключей
+        return json.dumps(data, ensure_ascii=False)
+
+    def assertParity(self, response, serializer_class, queryset):
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        if isinstance(data, dict):
+            data = data['results']
+        expected = json.loads(JSONRenderer().render(serializer_class(queryset, many=True).data))
+        self.assertEqual(self.dump(data), self.dump(expected))
+
+    @override_settings(TIME_ZONE='Europe/Moscow')
+    def test_track_requests(self):
+        response = self.client.get(reverse('track-request-list'))
+        queryset = TrackRequest.objects.filter(venue=self.venue).order_by('-created_at', 'id')
+        self.assertParity(response, TrackRequestSerializer, queryset)
+        self.assertIsNotNone(response.json()['results'][0]['payment_url'])
+
+        response = self.client.get(reverse('track-request-list'), {'status': 'pending', 'is_paid': 'false'})
+        self.assertParity(
+            response, TrackRequestSerializer, queryset.filter(status='pending', is_paid=False)
+        )
+
+    def test_tracks(self):
+        url = reverse('tracks-list', kwargs={'venue_id': self.venue.id})
+        queryset = Track.objects.filter(venue=self.venue)
+        self.assertParity(self.client.get(url), TrackSerializer, queryset)
+        genre = Genre.objects.get(name='Jazz')
+        self.assertParity(self.client.get(url, {'genre': genre.id}), TrackSerializer, queryset.filter(genre=genre))
+        self.assertParity(
+            self.client.get(url, {'search': 'song 2'}), TrackSerializer, queryset.filter(title='Song 2')
+        )
+
+    def test_transactions_and_withdrawals(self):
+        self.assertParity(
+            self.client.get(reverse('transaction-list')),
+            TransactionSerializer,
+            Transaction.objects.filter(venue=self.venue).order_by('-created_at')
+        )
+        self.assertParity(
+            self.client.get(reverse('withdrawal-history')),
+            WithdrawalSerializer,
+            WithdrawalRequest.objects.filter(venue=self.venue).order_by('-created_at')
+        )
+
+    def test_mixin_requires_projection(self):
+        with self.assertRaises(ImproperlyConfigured):
+            class BrokenListView(ProjectionListMixin, generics.ListAPIView):
+                projection_fields = projections.TRANSACTION_FIELDS
+
+
+class FakeRedis:
+    """Замена Redis для RedisBucketStore: скрипт корзины выполняется той же логикой refill, что и Lua."""
+
+    def __init__(self):
+        self.hashes = {}
+        self.expires = {}
+
+    def register_script(self, script):
+        def run(keys, args):
+            capacity, rate, now = (float(arg) for arg in args)
+            bucket = self.hashes.get(keys[0], {})
+            tokens, retry_after = throttling.refill(bucket.get('tokens'), bucket.get('updated'), capacity, rate, now)
+            self.hashes[keys[0]] = {'tokens': tokens, 'updated': now}
+            self.expires[keys[0]] = math.ceil(capacity / rate) + 1
+            return str(retry_after).encode()
+        return run
+
+
+@override_settings(
+    RATE_LIMIT_BACKEND='core.throttling.MemoryBucketStore',
+    RATE_LIMITS={
+        'catalog': {'client': (2, 0.001)},
+        'track_request': {'client': (2, 0.001), 'venue': (3, 0.001)},
+    }
+)
+class RateLimitTests(APITestCase):
+    def setUp(self):
+        throttling._stores.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Test Venue', city='Test City', phone='+79123456789')
+        self.track = Track.objects.create(
+            venue=self.venue, genre=Genre.objects.create(name='Rock'), title='Song', artist='Band', price=100
+        )
+        self.url = reverse('track-request-create', kwargs={'venue_id': self.venue.id})
+
+    def request_track(self, client_ip='10.0.0.1'):
+        return self.client.post(self.url, {'track': self.track.id, 'user_fee': 100}, REMOTE_ADDR=client_ip)
+
+    def test_client_bucket(self):
+        self.assertEqual(self.request_track().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.request_track().status_code, status.HTTP_201_CREATED)
+        response = self.request_track()
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.request_track('10.0.0.2').status_code, status.HTTP_201_CREATED)
+
+    def test_spoofed_forwarded_for_does_not_reset_client_bucket(self):
+        codes = [
+            self.client.post(
+                self.url, {'track': self.track.id, 'user_fee': 100},
+                REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR=f'203.0.113.{index}'
+            ).status_code
+            for index in range(3)
+        ]
+        self.assertEqual(codes, [201, 201, 429])
+
+    def test_trusted_proxy_address_is_used(self):
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            codes = [
+                self.client.post(
+                    self.url, {'track': self.track.id, 'user_fee': 100},
+                    REMOTE_ADDR='10.0.0.254', HTTP_X_FORWARDED_FOR=f'203.0.113.{index}, 198.51.100.7'
+                ).status_code
+                for index in range(3)
+            ]
+        # Левую часть заголовка задает клиент, учитывается адрес, добавленный прокси
+        self.assertEqual(codes, [201, 201, 429])
+
+    def test_redis_store(self):
+        redis = FakeRedis()
+        store = throttling.RedisBucketStore(client=redis)
+        self.assertEqual(store.take('key', 2, 0.5), 0)
+        self.assertEqual(store.take('key', 2, 0.5), 0)
+        self.assertAlmostEqual(store.take('key', 2, 0.5), 2, delta=0.1)
+        self.assertEqual(redis.expires, {'ratelimit:key': 5})
+
+    def test_venue_bucket_is_shared_by_clients(self):
+        codes = [self.request_track(f'10.0.0.{index}').status_code for index in range(4)]
+        self.assertEqual(codes, [201, 201, 201, 429])
+
+    def test_owner_is_not_limited(self):
+        self.client.force_authenticate(user=self.user)
+        url = reverse('tracks-list', kwargs={'venue_id': self.venue.id})
+        codes = {self.client.get(url).status_code for _ in range(5)}
+        self.assertEqual(codes, {status.HTTP_200_OK})
+
+    def test_store_failure_lets_requests_through(self):
+        with mock.patch.object(throttling.MemoryBucketStore, 'take', side_effect=OSError), \
+                self.assertLogs('core.throttling', 'ERROR'):
+            codes = {self.request_track().status_code for _ in range(3)}
+        self.assertEqual(codes, {status.HTTP_201_CREATED})
+
+    def test_refill(self):
+        self.assertEqual(throttling.refill(None, None, 5, 1.0, 100.0), (4, 0.0))
+        self.assertEqual(throttling.refill(0.5, 100.0, 5, 1.0, 100.25), (0.75, 0.25))
+        self.assertEqual(throttling.refill(0.0, 100.0, 5, 1.0, 200.0), (4, 0.0))
+
+    def test_sqlite_store_is_shared_between_workers(self):
+        path = Path(tempfile.mkdtemp()) / 'limits.sqlite3'
+        self.addCleanup(shutil.rmtree, path.parent, ignore_errors=True)
+        # Два экземпляра с одним файлом - как два воркера gunicorn
+        first, second = throttling.SQLiteBucketStore(path), throttling.SQLiteBucketStore(path)
+        self.assertEqual(first.take('key', 2, 0.001), 0)
+        self.assertEqual(second.take('key', 2, 0.001), 0)
+        self.assertGreater(first.take('key', 2, 0.001), 0)
+
+    @override_settings(ADMISSION_LIMITS_PER_WORKER={'guest': 1})
+    def test_admission_sheds_only_guest_pool(self):
+        middleware = AdmissionControlMiddleware(lambda request: HttpResponse())
+        guest_view = views.TrackRequestCreateView.as_view()
+        dj_view = views.TrackRequestListView.as_view()
+        factory = RequestFactory()
+        first, second, dj = factory.post('/'), factory.post('/'), factory.get('/')
+
+        self.assertIsNone(middleware.process_view(first, guest_view, (), {}))
+        with self.assertLogs('core.middleware', 'WARNING'):
+            response = middleware.process_view(second, guest_view, (), {})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertIsNone(middleware.process_view(dj, dj_view, (), {}))
+
+        middleware.release(first)
+        self.assertIsNone(middleware.process_view(second, guest_view, (), {}))
+
+
+class TrackRequestBulkUpdateTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.venue = Venue.objects.create(
+            user=self.user,
+            name='Test Venue',
+            city='Test City',
+            phone='+79123456789'
+        )
+        self.genre = Genre.objects.create(name='Test Genre')
+        self.track = Track.objects.create(
+            venue=self.venue,
+            genre=self.genre,
+            title='Test Track',
+            artist='Test Artist',
+            price=100
+        )
+        self.paid = [TrackRequest.objects.create(track=self.track, user_fee=100 + i, is_paid=True) for i in range(3)]
+        self.unpaid = TrackRequest.objects.create(track=self.track, user_fee=100)
+        self.url = reverse('track-request-bulk-update')
+        self.client.force_authenticate(user=self.user)
+        caching.genres.all()
+
+    def test_bulk_accept_and_reject(self):
+        items = [{'id': r.id, 'status': 'accepted'} for r in self.paid[:2]]
+        items.append({'id': self.paid[2].id, 'status': 'rejected'})
+        response = self.client.post(self.url, {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(all(r['ok'] for r in response.data['results']))
+        self.assertEqual(TrackRequest.objects.filter(status='accepted').count(), 2)
+        self.assertEqual(TrackRequest.objects.filter(status='rejected').count(), 1)
+        self.assertEqual(Transaction.objects.filter(transaction_type='deposit').count(), 2)
+        self.assertEqual(ledger.get_balance(self.venue.id), 201)
+
+    def test_per_item_errors(self):
+        other_user = User.objects.create_user(username='other', password='testpass123')
+        other_venue = Venue.objects.create(user=other_user, name='Other', city='City', phone='+79000000000')
+        other_track = Track.objects.create(venue=other_venue, genre=self.genre, title='T', artist='A', price=100)
+        foreign = TrackRequest.objects.create(track=other_track, user_fee=100, is_paid=True)
+
+        items = [
+            {'id': self.paid[0].id, 'status': 'accepted'},
+            {'id': self.paid[0].id, 'status': 'accepted'},
+            {'id': self.unpaid.id, 'status': 'accepted'},
+            {'id': foreign.id, 'status': 'rejected'},
+        ]
+        response = self.client.post(self.url, {'items': items}, format='json')
+        self.assertEqual([r['ok'] for r in response.data['results']], [True, False, False, False])
+        self.assertEqual(Transaction.objects.count(), 1)
+
+        response = self.client.post(self.url, {'items': items[:1]}, format='json')
+        self.assertFalse(response.data['results'][0]['ok'])
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_query_count_does_not_depend_on_batch_size(self):
+        with CaptureQueriesContext(connection) as one:
+            self.client.post(self.url, {'items': [{'id': self.paid[0].id, 'status': 'accepted'}]}, format='json')
+        with CaptureQueriesContext(connection) as many:
+            self.client.post(
+                self.url, {'items': [{'id': r.id, 'status': 'accepted'} for r in self.paid[1:]]}, format='json'
+            )
+        self.assertEqual(len(one), len(many))
+
+    def test_single_and_bulk_accept_deposit_once(self):
+        track_request = self.paid[0]
+        # PATCH прочитал строку до того, как массовое принятие ее изменило
+        stale = TrackRequest.objects.get(pk=track_request.pk)
+        response = self.client.post(self.url, {'items': [{'id': track_request.id, 'status': 'accepted'}]}, format='json')
+        self.assertTrue(response.data['results'][0]['ok'])
+
+        with mock.patch.object(views.TrackRequestUpdateView, 'get_object', return_value=stale):
+            response = self.client.patch(
+                reverse('track-request-update', kwargs={'pk': track_request.pk}), {'status': 'accepted'}
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Transaction.objects.filter(transaction_type='deposit').count(), 1)
+
+    def test_invalid_status(self):
+        response = self.client.post(self.url, {'items': [{'id': self.unpaid.id, 'status': 'pending'}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TrackRequestExpiryTests(APITestCase):
+    def setUp(self):
+        throttling._stores.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Test Venue', city='City', phone='+79123456789')
+        self.genre = Genre.objects.create(name='Rock')
+        self.track = Track.objects.create(venue=self.venue, genre=self.genre, title='Hit', artist='A', price=100)
+
+    def make_request(self, age, **fields):
+        track_request = TrackRequest.objects.create(track=self.track, user_fee=150, **fields)
+        TrackRequest.objects.filter(pk=track_request.pk).update(created_at=timezone.now() - age)
+        return track_request
+
+    def test_abandoned_requests_expire_then_archive(self):
+        ancient = self.make_request(timedelta(days=3))
+        stale = self.make_request(timedelta(hours=3))
+        fresh = self.make_request(timedelta(minutes=5))
+        paid = self.make_request(timedelta(days=3), is_paid=True)
+        accepted = self.make_request(timedelta(days=3), is_paid=True, status='accepted')
+
+        out = io.StringIO()
+        call_command('expire_track_requests', '--batch-size', '1', '--pause', '0', stdout=out)
+        self.assertIn('Истекло запросов: 2, перенесено в архив: 1', out.getvalue())
+
+        self.assertFalse(TrackRequest.objects.filter(pk=ancient.pk).exists())
+        archived = ArchivedTrackRequest.objects.get()
+        self.assertEqual(
+            (archived.pk, archived.status, archived.payment_token, archived.venue_id),
+            (ancient.pk, 'expired', ancient.payment_token, self.venue.pk)
+        )
+        self.assertEqual(TrackRequest.objects.get(pk=stale.pk).status, 'expired')
+        self.assertEqual(
+            sorted(TrackRequest.objects.filter(pk__in=[fresh.pk, paid.pk, accepted.pk]).values_list('status', flat=True)),
+            ['accepted', 'pending', 'pending']
+        )
+
+    def test_expired_request_cannot_start_payment(self):
+        track_request = self.make_request(timedelta(hours=3))
+        call_command('expire_track_requests', stdout=io.StringIO())
+        response = self.client.post(reverse('mock-payment', kwargs={'payment_token': track_request.payment_token}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(TrackRequest.objects.get(pk=track_request.pk).is_paid)
+
+    def test_late_payment_restores_archived_request(self):
+        track_request = self.make_request(timedelta(days=3), payment_id='pay_1')
+        created_at = TrackRequest.objects.get(pk=track_request.pk).created_at
+        call_command('expire_track_requests', stdout=io.StringIO())
+        self.assertEqual(ArchivedTrackRequest.objects.count(), 1)
+        Track.objects.filter(pk=self.track.pk).update(title='Renamed', price=300)
+
+        mark_paid(track_request.payment_token, 'pay_1')
+
+        restored = TrackRequest.objects.get(pk=track_request.pk)
+        self.assertEqual((restored.status, restored.is_paid, restored.transaction_id), ('pending', True, 'pay_1'))
+        self.assertEqual(restored.created_at, created_at)
+        self.assertEqual((restored.track_title, restored.track_genre_name, restored.min_fee), ('Hit', 'Rock', 100))
+        self.assertFalse(ArchivedTrackRequest.objects.exists())
+        self.assertEqual(ledger.get_balance(self.venue.pk), 150)
+
+    def test_rebuild_counts_archived_requests(self):
+        self.make_request(timedelta(days=3))
+        self.make_request(timedelta(days=3))
+        call_command('expire_track_requests', stdout=io.StringIO())
+        analytics.rebuild(self.venue.pk)
+        self.assertEqual(VenueDailyStats.objects.get().requests, 2)
+        self.assertEqual(TrackDailyStats.objects.get().requests, 2)
+
+
+class WithdrawalTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.venue = Venue.objects.create(
+            user=self.user,
+            name='Test Venue',
+            city='Test City',
+            phone='+79123456789',
+            balance=1000
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_create_withdrawal(self):
+        url = reverse('withdrawal-create')
+        data = {
+            'amount': 500,
+            'account_details': 'Test Account'
+        }
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(WithdrawalRequest.objects.count(), 1)
+
+    def test_insufficient_balance(self):
+        url = reverse('withdrawal-create')
+        data = {
+            'amount': 1500,
+            'account_details': 'Test Account'
+        }
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(EVENTS_BROKER='core.events.LocalBroker')
+class TrackRequestEventTests(APITestCase):
+    def setUp(self):
+        throttling._stores.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.venue = Venue.objects.create(
+            user=self.user,
+            name='Test Venue',
+            city='Test City',
+            phone='+79123456789'
+        )
+        self.genre = Genre.objects.create(name='Test Genre')
+        self.track = Track.objects.create(
+            venue=self.venue,
+            genre=self.genre,
+            title='Test Track',
+            artist='Test Artist',
+            price=100
+        )
+        _brokers.clear()
+        self.events = []
+        self.handle = get_broker().add_listener(self.venue.id, self.events.append)
+        self.addCleanup(get_broker().remove_listener, self.handle)
+
+    def test_request_lifecycle_events(self):
+        url = reverse('track-request-create', kwargs={'venue_id': self.venue.id})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'track': self.track.id, 'user_fee': 150})
+        track_request = TrackRequest.objects.get(pk=response.data['id'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('mock-payment', kwargs={'payment_token': track_request.payment_token}))
+
+        self.client.force_authenticate(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(
+                reverse('track-request-update', kwargs={'pk': track_request.id}),
+                {'status': 'accepted'}
+            )
+
+        self.assertEqual([e['event'] for e in self.events], ['created', 'paid', 'accepted'])
+        self.assertEqual(self.events[-1]['data']['status'], 'accepted')
+        self.assertTrue(self.events[-1]['data']['is_paid'])
+
+    def test_events_are_scoped_to_venue(self):
+        other_user = User.objects.create_user(username='other', password='testpass123')
+        other_venue = Venue.objects.create(user=other_user, name='Other', city='City', phone='+79000000000')
+        other_track = Track.objects.create(
+            venue=other_venue, genre=self.genre, title='Other', artist='Other', price=100
+        )
+        url = reverse('track-request-create', kwargs={'venue_id': other_venue.id})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {'track': other_track.id, 'user_fee': 150})
+        self.assertEqual(self.events, [])
+
+    def test_database_broker_fans_out_between_processes(self):
+        publisher, subscriber = DatabaseBroker(), DatabaseBroker()
+        received = []
+        subscriber._ensure_poller = lambda: None
+        subscriber.add_listener(self.venue.id, received.append)
+        subscriber.poll()
+
+        message = publisher.publish(self.venue.id, 'created', {'id': 1})
+        subscriber.poll()
+
+        self.assertEqual(received, [message])
+        self.assertEqual(subscriber.replay(self.venue.id, 0), [message])
+
+    def test_database_broker_delivers_late_committed_events(self):
+        publisher, subscriber = DatabaseBroker(), DatabaseBroker()
+        received = []
+        subscriber._ensure_poller = lambda: None
+        subscriber.add_listener(self.venue.id, received.append)
+        subscriber.poll()
+
+        slow = publisher.publish(self.venue.id, 'created', {'id': 1})
+        fast = publisher.publish(self.venue.id, 'created', {'id': 2})
+        # Событие с меньшим id еще не закоммичено, когда опрос уже видит следующее
+        VenueEvent.objects.filter(pk=slow['id']).delete()
+        subscriber.poll()
+        VenueEvent.objects.create(id=slow['id'], venue=self.venue, event='created', payload={'id': 1})
+        subscriber.poll()
+        subscriber.poll()
+
+        self.assertEqual(received, [fast, slow])
+
+        with override_settings(EVENTS_POLL_LOOKBACK=0):
+            subscriber.poll()
+            subscriber.poll()
+        self.assertEqual(subscriber._floor, fast['id'])
+        self.assertEqual(subscriber._seen, set())
+
+    def test_stream_requires_token(self):
+        response = self.client.get(reverse('track-request-stream'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_stream_delivers_published_events(self):
+        token = await sync_to_async(
+            lambda: str(CustomTokenObtainPairSerializer.get_token(self.user).access_token)
+        )()
+        response = await self.async_client.get(reverse('track-request-stream'), {'token': token})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+        get_broker().publish(self.venue.id, 'paid', {'id': 1})
+        self.assertIn(b'event: paid', await anext(stream))
+        await stream.aclose()
+
+    def test_format_sse(self):
+        message = {'id': 7, 'event': 'paid', 'data': {'id': 1}}
+        self.assertEqual(format_sse(message), 'id: 7\nevent: paid\ndata: {"id": 1}\n\n')
+
+
+
+class LedgerTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.venue = Venue.objects.create(
+            user=self.user,
+            name='Test Venue',
+            city='Test City',
+            phone='+79123456789',
+            balance=1000
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_balance_is_derived_from_ledger(self):
+        ledger.record(self.venue.id, 300, 'deposit')
+        ledger.record(self.venue.id, -200, 'withdrawal')
+        self.assertEqual(ledger.get_balance(self.venue.id), 1100)
+        self.assertEqual(self.client.get(reverse('profile')).data['balance'], 1100)
+
+    def test_deposits_do_not_touch_venue_row(self):
+        with CaptureQueriesContext(connection) as queries:
+            ledger.record(self.venue.id, 300, 'deposit')
+        self.assertFalse(any('core_venue' in q['sql'] and 'UPDATE' in q['sql'] for q in queries))
+
+    def test_checkpoint_preserves_balance(self):
+        ledger.record(self.venue.id, 300, 'deposit')
+        ledger.record(self.venue.id, -100, 'withdrawal')
+        checkpoint = ledger.advance_checkpoint(self.venue.id)
+        self.assertEqual(checkpoint.balance, 1200)
+        self.assertEqual(ledger.get_balance(self.venue.id), 1200)
+
+        ledger.record(self.venue.id, 50, 'deposit')
+        self.assertEqual(ledger.get_balance(self.venue.id), 1250)
+        self.venue.refresh_from_db()
+        self.assertEqual(self.venue.balance, 1200)
+
+    def test_late_committed_transaction_is_not_skipped(self):
+        ledger.record(self.venue.id, 300, 'deposit')
+        later = Transaction.objects.create(id=1000, venue_id=self.venue.id, amount=50, transaction_type='deposit')
+        ledger.advance_checkpoint(self.venue.id)
+        # Строка с меньшим id закоммитилась после сдвига точки, спустя больше минуты
+        late = Transaction.objects.create(
+            id=later.id - 1, venue_id=self.venue.id, amount=-200, transaction_type='withdrawal'
+        )
+        Transaction.objects.filter(pk=late.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(ledger.get_balance(self.venue.id), 1150)
+        with ledger.locked_balance(self.venue.id) as balance:
+            self.assertEqual(balance, 1150)
+
+        checkpoint = ledger.advance_checkpoint(self.venue.id)
+        self.assertEqual(checkpoint.balance, 1150)
+        self.assertEqual(ledger.get_balance(self.venue.id), 1150)
+        self.assertFalse(Transaction.objects.filter(settled=False).exists())
+
+    def test_withdrawal_checks_ledger_balance(self):
+        ledger.record(self.venue.id, -400, 'withdrawal')
+        response = self.client.post(reverse('mock-withdrawal'), {'amount': 700})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('mock-withdrawal'), {'amount': 600})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ledger.get_balance(self.venue.id), 0)
+
+    def test_missing_checkpoint_is_rebuilt_from_ledger(self):
+        other = User.objects.create_user(username='other', password='testpass123')
+        venue = Venue.objects.bulk_create([
+            Venue(user=other, name='Other', city='City', phone='+79123456780', balance=200)
+        ])[0]
+        ledger.record(venue.id, 300, 'deposit')
+        ledger.record(venue.id, -100, 'withdrawal')
+        # Venue.balance уже учитывает эти строки, повторно их не складываем
+        self.assertEqual(ledger.get_balance(venue.id), 200)
+        with ledger.locked_balance(venue.id) as balance:
+            self.assertEqual(balance, 200)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Проверка блокировок READ COMMITTED нужна только для PostgreSQL')
+class LedgerConcurrencyTests(APITransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=user, name='Test Venue', city='City', phone='+79123456789')
+        ledger.record(self.venue.id, 1000, 'deposit')
+
+    def test_concurrent_withdrawals_cannot_overdraw(self):
+        locked = threading.Event()
+        results = {}
+
+        def withdraw(name, hold):
+            try:
+                with ledger.locked_balance(self.venue.id) as balance:
+                    locked.set()
+                    # Второе списание успевает начать SELECT ... FOR UPDATE и ждет блокировку
+                    time.sleep(hold)
+                    results[name] = balance >= 700
+                    if results[name]:
+                        ledger.record(self.venue.id, -700, 'withdrawal')
+            finally:
+                connection.close()
+
+        first = threading.Thread(target=withdraw, args=('first', 0.5))
+        first.start()
+        locked.wait(5)
+        second = threading.Thread(target=withdraw, args=('second', 0))
+        second.start()
+        first.join()
+        second.join()
+
+        self.assertEqual(results, {'first': True, 'second': False})
+        self.assertEqual(ledger.get_balance(self.venue.id), 300)
+
+
+class IdempotencyTests(APITestCase):
+    def setUp(self):
+        throttling._stores.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(
+            user=self.user, name='Test Venue', city='City', phone='+79123456789', balance=1000
+        )
+        self.genre = Genre.objects.create(name='Rock')
+        self.track = Track.objects.create(venue=self.venue, genre=self.genre, title='Hit', artist='A', price=100)
+
+    def create_request(self, key, fee=150):
+        return self.client.post(
+            reverse('track-request-create', kwargs={'venue_id': self.venue.id}),
+            {'track': self.track.id, 'user_fee': fee},
+            HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_track_request(self):
+        first = self.create_request('key-1')
+        retry = self.create_request('key-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(TrackRequest.objects.count(), 1)
+
+        self.create_request('key-2')
+        self.assertEqual(TrackRequest.objects.count(), 2)
+
+    def test_key_reused_with_other_body(self):
+        self.create_request('key-1')
+        response = self.create_request('key-1', fee=300)
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(TrackRequest.objects.count(), 1)
+
+    def test_failed_request_is_not_stored(self):
+        self.assertEqual(self.create_request('key-1', fee=10).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.create_request('key-1', fee=150).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+    def test_expired_key_runs_again(self):
+        self.create_request('key-1')
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        response = self.create_request('key-1')
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(TrackRequest.objects.count(), 2)
+
+    # Шесть запросов гостя подряд: больше, чем корзина 'client' для track_request
+    @override_settings(RATE_LIMITS={})
+    def test_retry_takes_over_key_after_crash(self):
+        # Процесс упал после занятия ключа: ответ так и не записан
+        with mock.patch('core.idempotency.finish'):
+            self.create_request('key-1')
+        self.assertEqual(self.create_request('key-1').status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.create_request('key-1', fee=300).status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        IdempotencyKey.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.create_request('key-1', fee=300).status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        response = self.create_request('key-1')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', response)
+
+        retry = self.create_request('key-1')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), response.json())
+
+    def test_overtaken_request_does_not_store_response(self):
+        def guest_request():
+            request = RequestFactory().post('/', HTTP_IDEMPOTENCY_KEY='key-1')
+            request.user = AnonymousUser()
+            return request
+
+        record, _ = idempotency.begin(guest_request())
+        IdempotencyKey.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        taken, response = idempotency.begin(guest_request())
+        self.assertIsNone(response)
+
+        idempotency.finish(record, Response({'id': 1}, status=status.HTTP_201_CREATED))
+        idempotency.finish(taken, Response({'id': 2}, status=status.HTTP_201_CREATED))
+        self.assertEqual(IdempotencyKey.objects.get().response, {'id': 2})
+
+    @mock.patch('core.outbox.create_yookassa_payment')
+    def test_payment_created_once(self, create_payment):
+        create_payment.return_value = SimpleNamespace(
+            id='pay_1', confirmation=SimpleNamespace(confirmation_url='https://pay.example.com')
+        )
+        track_request = TrackRequest.objects.create(track=self.track, user_fee=150)
+        self.client.force_authenticate(user=self.user)
+        url = reverse('create-payment', kwargs={'payment_token': track_request.payment_token})
+        responses = [self.client.post(url, HTTP_IDEMPOTENCY_KEY='pay-key') for _ in range(2)]
+        self.assertEqual([r.status_code for r in responses], [status.HTTP_201_CREATED] * 2)
+        self.assertEqual(responses[1].data, {'confirmation_url': 'https://pay.example.com'})
+        create_payment.assert_called_once()
+
+    def test_withdrawal_charged_once(self):
+        self.client.force_authenticate(user=self.user)
+        for _ in range(2):
+            response = self.client.post(reverse('mock-withdrawal'), {'amount': 600}, HTTP_IDEMPOTENCY_KEY='w-1')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(WithdrawalRequest.objects.count(), 1)
+        self.assertEqual(ledger.get_balance(self.venue.id), 400)
+
+    def test_keys_are_scoped_to_user(self):
+        other = User.objects.create_user(username='other', password='testpass123')
+        Venue.objects.create(user=other, name='Other', city='City', phone='+79123456780', balance=1000)
+        for user in (self.user, other):
+            self.client.force_authenticate(user=user)
+            response = self.client.post(reverse('mock-withdrawal'), {'amount': 500}, HTTP_IDEMPOTENCY_KEY='w-1')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(WithdrawalRequest.objects.count(), 2)
+
+
+class AnalyticsTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Test Venue', city='City', phone='+79123456789')
+        self.rock = Genre.objects.create(name='Rock')
+        self.jazz = Genre.objects.create(name='Jazz')
+        self.hit = Track.objects.create(venue=self.venue, genre=self.rock, title='Hit', artist='A', price=100)
+        self.tune = Track.objects.create(venue=self.venue, genre=self.jazz, title='Tune', artist='B', price=100)
+        self.client.force_authenticate(user=self.user)
+
+    def request_track(self, track, fee, paid=False, decision=None):
+        response = self.client.post(
+            reverse('track-request-create', kwargs={'venue_id': self.venue.id}), {'track': track.id, 'user_fee': fee}
+        )
+        track_request = TrackRequest.objects.get(pk=response.data['id'])
+        if paid:
+            self.client.post(reverse('mock-payment', kwargs={'payment_token': track_request.payment_token}))
+        if decision:
+            self.client.patch(reverse('track-request-update', kwargs={'pk': track_request.pk}), {'status': decision})
+        return track_request
+
+    def stats(self):
+        return {
+            model.__name__: sorted(model.objects.values_list(*analytics.METRICS))
+            for model in (VenueDailyStats, TrackDailyStats, GenreDailyStats)
+        }
+
+    def test_rollups_follow_request_lifecycle(self):
+        self.request_track(self.hit, 300, paid=True, decision='accepted')
+        self.request_track(self.hit, 200, paid=True, decision='accepted')
+        self.request_track(self.tune, 150, paid=True, decision='rejected')
+        self.request_track(self.tune, 100)
+
+        response = self.client.get(reverse('analytics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        totals = response.data['totals']
+        self.assertEqual(
+            (totals['requests'], totals['paid'], totals['accepted'], totals['rejected'], totals['revenue']),
+            (4, 3, 2, 1, 650)
+        )
+        self.assertEqual(totals['acceptance_rate'], 0.6667)
+        self.assertEqual(response.data['daily'][0]['day'], timezone.localdate())
+        self.assertEqual([t['title'] for t in response.data['top_tracks']], ['Hit', 'Tune'])
+        self.assertEqual([(g['name'], g['revenue']) for g in response.data['top_genres']], [('Rock', 500), ('Jazz', 150)])
+
+    def test_bulk_moderation_is_counted(self):
+        requests = [self.request_track(self.hit, 100, paid=True) for _ in range(3)]
+        self.client.post(
+            reverse('track-request-bulk-update'),
+            {'items': [{'id': r.id, 'status': 'accepted'} for r in requests]},
+            format='json'
+        )
+        self.assertEqual(VenueDailyStats.objects.get(venue=self.venue).accepted, 3)
+        self.assertEqual(TrackDailyStats.objects.get(track=self.hit).accepted, 3)
+
+    def test_events_do_not_load_tracks_one_by_one(self):
+        for track in (self.hit, self.tune, self.hit):
+            TrackRequest.objects.create(track=track, user_fee=100)
+
+        def queries(count):
+            # Как у webhook'ов и сверки: запросы без select_related('track')
+            track_requests = list(TrackRequest.objects.order_by('id')[:count])
+            with CaptureQueriesContext(connection) as captured:
+                analytics.record_events(track_requests, 'paid')
+            return len(captured)
+
+        self.assertEqual(queries(1), queries(3))
+        self.assertEqual(
+            sorted(GenreDailyStats.objects.values_list('genre__name', 'paid')), [('Jazz', 1), ('Rock', 3)]
+        )
+
+    def test_rebuild_matches_incremental(self):
+        self.request_track(self.hit, 300, paid=True, decision='accepted')
+        self.request_track(self.tune, 150, paid=True, decision='rejected')
+        old = self.request_track(self.tune, 120, paid=True)
+        incremental = self.stats()
+
+        for model in (VenueDailyStats, TrackDailyStats, GenreDailyStats):
+            model.objects.all().delete()
+        call_command('rebuild_analytics', stdout=io.StringIO())
+        self.assertEqual(self.stats(), incremental)
+
+        TrackRequest.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=3))
+        analytics.rebuild(self.venue.id)
+        self.assertEqual(
+            list(VenueDailyStats.objects.order_by('day').values_list('requests', 'revenue')), [(1, 120), (2, 450)]
+        )
+
+    def test_period_validation(self):
+        response = self.client.get(reverse('analytics'), {'date_from': '2024-01-01', 'date_to': '2025-06-01'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class LedgerExportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Test Venue', city='City', phone='+79123456789')
+        other_user = User.objects.create_user(username='other', password='testpass123')
+        self.other = Venue.objects.create(user=other_user, name='Other', city='City', phone='+79123456789')
+
+        self.old = ledger.record(self.venue.id, 100, 'deposit')
+        Transaction.objects.filter(pk=self.old.pk).update(created_at=timezone.now() - timedelta(days=10))
+        self.recent = ledger.record(self.venue.id, -50, 'withdrawal')
+        ledger.record(self.other.id, 700, 'deposit')
+        WithdrawalRequest.objects.create(venue=self.venue, amount=600, fee=30, bank_card_token='secret')
+        self.client.force_authenticate(user=self.user)
+
+    def export(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_export_filters_by_date_and_own_venue(self):
+        body = self.export('transaction-export', format='csv', venue=self.other.id)
+        lines = body.splitlines()
+        self.assertEqual(lines[0], 'id,venue_id,amount,transaction_type,track_request_id,created_at')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], [str(self.old.id), str(self.recent.id)])
+
+        since = (timezone.now() - timedelta(days=1)).date().isoformat()
+        lines = self.export('transaction-export', format='csv', date_from=since).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith(f'{self.recent.id},{self.venue.id},-50,withdrawal,'))
+
+    def test_ndjson_withdrawals_hide_card_token(self):
+        response = self.client.get(reverse('withdrawal-export'), HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(r['amount'], r['fee']) for r in rows], [(600, 30)])
+        self.assertNotIn('bank_card_token', rows[0])
+
+    def test_staff_can_export_other_venues(self):
+        self.user.is_staff = True
+        self.user.save()
+        rows = self.export('transaction-export', format='ndjson', venue=self.other.id).splitlines()
+        self.assertEqual([json.loads(r)['amount'] for r in rows], [700])
+
+    @override_settings(ROOT_URLCONF='server.urls_asgi')
+    async def test_asgi_export_streams_chunks(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.user).access_token
+        headers = {'Authorization': f'Bearer {token}'}
+        produced = []
+
+        def chunks(*args, **kwargs):
+            for chunk in ('a\n', 'b\n', 'c\n'):
+                produced.append(chunk)
+                yield chunk
+
+        with mock.patch('core.views.stream_export', chunks):
+            response = await AsyncClient().get(reverse('transaction-export'), {'format': 'csv'}, headers=headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.is_async)
+            # Первый кусок отдается до того, как прочитана вся выгрузка
+            body = aiter(response.streaming_content)
+            self.assertEqual(await anext(body), b'a\n')
+            self.assertEqual(produced, ['a\n'])
+            self.assertEqual([chunk async for chunk in body], [b'b\n', b'c\n'])
+
+        response = await AsyncClient().get(reverse('transaction-export'), {'format': 'csv'}, headers=headers)
+        lines = b''.join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        self.assertEqual(lines[0], 'id,venue_id,amount,transaction_type,track_request_id,created_at')
+        self.assertEqual(len(lines), 3)
+
+    def test_invalid_range(self):
+        response = self.client.get(
+            reverse('transaction-export'), {'format': 'csv', 'date_from': '2024-02-01', 'date_to': '2024-01-01'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('export_ledger', 'transactions', '--venue', str(self.other.id), '--format', 'ndjson', stdout=out)
+        self.assertEqual([json.loads(r)['amount'] for r in out.getvalue().splitlines()], [700])
+
+
+class BenchmarkTests(APITestCase):
+    def test_seed_creates_requested_volumes(self):
+        venues = benchmark.seed(venues=2, tracks_per_venue=5, history_per_venue=20)
+        self.assertEqual(len(benchmark.bench_venues()), 2)
+        self.assertEqual(Track.objects.filter(venue__in=venues).count(), 10)
+        self.assertEqual(TrackRequest.objects.filter(venue=venues[0]).count(), 20)
+        self.assertEqual(VenueDailyStats.objects.get(venue=venues[0]).requests, 20)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'operations': {
+            'list_tracks': {'requests': 100, 'errors': 0, 'rps': 50.0, 'p99_ms': 40.0},
+            'create_request': {'requests': 100, 'errors': 0, 'rps': 20.0, 'p99_ms': 100.0},
+        }}
+        report = {'operations': {
+            'list_tracks': {'requests': 100, 'errors': 0, 'rps': 48.0, 'p99_ms': 43.0},
+            'create_request': {'requests': 50, 'errors': 10, 'rps': 10.0, 'p99_ms': 200.0},
+        }}
+        regressions = benchmark.compare(report, baseline)
+        self.assertEqual(len(regressions), 3)
+        self.assertTrue(all(r.startswith('create_request') for r in regressions))
+        self.assertEqual(benchmark.compare(baseline, baseline), [])
+
+    @override_settings(ROOT_URLCONF='server.urls_asgi')
+    def test_asgi_server_counts_requests_in_flight(self):
+        in_flight = benchmark.InFlight()
+        with benchmark.live_asgi_server(in_flight) as base_url:
+            response = requests.post(
+                f'{base_url}/api/payment-webhook/', data='{', headers={'Content-Type': 'application/json'}, timeout=5
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(in_flight.report()['peak'], 1)
+
+    def test_pay_request_records_deposit(self):
+        venue = benchmark.seed(venues=1, tracks_per_venue=1, history_per_venue=0)[0]
+        track = Track.objects.get(venue=venue)
+        benchmark._pay_request(track.id, track.price)
+        track_request = TrackRequest.objects.get(track=track)
+        self.assertTrue(track_request.is_paid)
+        self.assertEqual(ledger.get_balance(venue.id), track.price)
+
+
+class DatabaseProfileTests(APITestCase):
+    def test_sqlite_wal(self):
+        config = databases.database('sqlite-wal')
+        self.assertEqual(config['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        self.assertIn('journal_mode=WAL', config['OPTIONS']['init_command'])
+        self.assertNotIn('OPTIONS', databases.database('sqlite'))
+
+    def test_postgresql(self):
+        with mock.patch.dict('os.environ', {'DB_CONN_MAX_AGE': '120'}):
+            config = databases.database('postgresql')
+        self.assertEqual(config['CONN_MAX_AGE'], 120)
+        self.assertTrue(config['CONN_HEALTH_CHECKS'])
+        self.assertNotIn('pool', config['OPTIONS'])
+
+        # Пул psycopg 3 несовместим с постоянными соединениями Django
+        with mock.patch.dict('os.environ', {'DB_POOL': 'true', 'DB_POOL_MAX_SIZE': '4'}):
+            config = databases.database('postgresql')
+        self.assertEqual(config['CONN_MAX_AGE'], 0)
+        self.assertEqual(config['OPTIONS']['pool']['max_size'], 4)
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            databases.database('mysql')
+
+
+class WebhookInboxTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123'
+        )
+        self.venue = Venue.objects.create(
+            user=self.user,
+            name='Test Venue',
+            city='Test City',
+            phone='+79123456789'
+        )
+        self.genre = Genre.objects.create(name='Test Genre')
+        self.track = Track.objects.create(
+            venue=self.venue,
+            genre=self.genre,
+            title='Test Track',
+            artist='Test Artist',
+            price=100
+        )
+        self.track_request = TrackRequest.objects.create(
+            track=self.track, user_fee=150, payment_id='pay_1'
+        )
+        self.payment = SimpleNamespace(
+            id='pay_1',
+            status='succeeded',
+            metadata={'payment_token': str(self.track_request.payment_token)}
+        )
+
+    def notify(self, object_id='pay_1', event='payment.succeeded'):
+        return self.client.post(
+            reverse('payment-webhook'),
+            {'event': event, 'object': {'id': object_id}},
+            format='json'
+        )
+
+    def test_webhook_only_enqueues(self):
+        with mock.patch('core.webhooks.find_payment') as find_one:
+            response = self.notify()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        find_one.assert_not_called()
+        self.assertEqual(WebhookEvent.objects.get().status, 'pending')
+
+    def test_duplicates_are_collapsed(self):
+        self.notify()
+        self.notify()
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_malformed_webhook(self):
+        response = self.client.post(reverse('payment-webhook'), {'event': 'x'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_worker_applies_payment_once(self):
+        self.notify()
+        with mock.patch('core.webhooks.find_payment', return_value=self.payment):
+            self.assertEqual(process_batch(concurrency=1), [True])
+            self.notify()
+            self.assertEqual(process_batch(concurrency=1), [])
+
+        self.track_request.refresh_from_db()
+        self.assertTrue(self.track_request.is_paid)
+        self.assertEqual(ledger.get_balance(self.venue.id), 150)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(WebhookEvent.objects.get().status, 'done')
+
+    @override_settings(WEBHOOK_MAX_ATTEMPTS=2)
+    def test_retry_with_backoff(self):
+        self.notify()
+        with mock.patch('core.webhooks.find_payment', side_effect=ConnectionError('timeout')):
+            self.assertEqual(process_batch(concurrency=1), [False])
+            webhook_event = WebhookEvent.objects.get()
+            self.assertEqual(webhook_event.status, 'pending')
+            self.assertEqual(webhook_event.attempts, 1)
+            self.assertGreater(webhook_event.next_attempt_at, timezone.now())
+            self.assertEqual(process_batch(concurrency=1), [])
+
+            WebhookEvent.objects.update(next_attempt_at=timezone.now())
+            process_batch(concurrency=1)
+        webhook_event.refresh_from_db()
+        self.assertEqual(webhook_event.status, 'failed')
+        self.assertIn('timeout', webhook_event.last_error)
+
+    def test_payout_cancel_refunds_once(self):
+        withdrawal = WithdrawalRequest.objects.create(
+            venue=self.venue, amount=500, bank_card_token='token',
+            yookassa_payout_id='po_1', status='processing'
+        )
+        self.client.post(
+            reverse('withdrawal-webhook'),
+            {'event': 'payout.canceled', 'object': {'id': 'po_1'}},
+            format='json'
+        )
+        payout = SimpleNamespace(id='po_1', status='canceled')
+        with mock.patch('core.webhooks.find_payout', return_value=payout):
+            process_batch(concurrency=1)
+            WebhookEvent.objects.update(status='pending')
+            process_batch(concurrency=1)
+
+        withdrawal.refresh_from_db()
+        self.assertEqual(withdrawal.status, 'canceled')
+        self.assertEqual(ledger.get_balance(self.venue.id), 500)
+
+
+
+class ProviderOutboxTests(APITestCase):
+    CARD = {
+        'amount': 500, 'card_number': '4111111111111111', 'card_expiry_year': '2030',
+        'card_expiry_month': '12', 'card_csc': '123'
+    }
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(
+            user=self.user, name='Test Venue', city='City', phone='+79123456789', balance=1000
+        )
+        self.genre = Genre.objects.create(name='Rock')
+        self.track = Track.objects.create(venue=self.venue, genre=self.genre, title='Hit', artist='A', price=100)
+        self.track_request = TrackRequest.objects.create(track=self.track, user_fee=150)
+        self.client.force_authenticate(user=self.user)
+        # Внешние транзакции теста; вызов ЮKassa не должен открывать свою
+        self.depth = len(connection.atomic_blocks)
+
+    def provider(self, result):
+        def call(*args, **kwargs):
+            self.assertEqual(len(connection.atomic_blocks), self.depth, 'вызов ЮKassa внутри транзакции')
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return call
+
+    def withdraw(self):
+        response = self.client.post(reverse('withdrawal-create'), self.CARD)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return WithdrawalRequest.objects.get(), ProviderCall.objects.get(kind='payout')
+
+    def expire_lock(self):
+        ProviderCall.objects.update(locked_at=timezone.now() - timedelta(minutes=10))
+
+    @mock.patch('core.outbox.create_yookassa_payout')
+    def test_withdrawal_is_committed_before_payout(self, create_payout):
+        create_payout.side_effect = self.provider(SimpleNamespace(id='po_1'))
+        withdrawal, call = self.withdraw()
+        create_payout.assert_not_called()
+        self.assertEqual((withdrawal.status, call.status), ('pending', 'pending'))
+        self.assertEqual(ledger.get_balance(self.venue.id), 500)
+
+        self.assertEqual(outbox.process_batch(), [True])
+        withdrawal.refresh_from_db()
+        self.assertEqual((withdrawal.status, withdrawal.yookassa_payout_id), ('processing', 'po_1'))
+        self.assertEqual(create_payout.call_args.kwargs['idempotency_key'], call.idempotency_key)
+        self.assertEqual(ProviderCall.objects.get().status, 'done')
+
+    @mock.patch('core.outbox.create_yookassa_payout')
+    def test_worker_crash_during_call_is_retried_with_same_key(self, create_payout):
+        create_payout.side_effect = self.provider(SimpleNamespace(id='po_1'))
+        withdrawal, call = self.withdraw()
+        outbox.claim_batch(10)  # воркер забрал вызов и упал
+
+        self.assertEqual(outbox.process_batch(), [])
+        self.expire_lock()
+        self.assertEqual(outbox.process_batch(), [True])
+        create_payout.assert_called_once()
+        self.assertEqual(create_payout.call_args.kwargs['idempotency_key'], call.idempotency_key)
+        self.assertEqual(WithdrawalRequest.objects.get().status, 'processing')
+
+    @mock.patch('core.outbox.create_yookassa_payout')
+    def test_crash_before_result_is_applied(self, create_payout):
+        create_payout.side_effect = self.provider(SimpleNamespace(id='po_1'))
+        withdrawal, call = self.withdraw()
+
+        def crash(call, result):
+            raise RuntimeError('процесс упал')
+
+        with mock.patch.dict(outbox.APPLIERS, {'payout': crash}), self.assertRaises(RuntimeError):
+            outbox.process_batch()
+        self.assertEqual(ProviderCall.objects.get().status, 'processing')
+        self.assertEqual(WithdrawalRequest.objects.get().status, 'pending')
+
+        self.expire_lock()
+        self.assertEqual(outbox.process_batch(), [True])
+        keys = {c.kwargs['idempotency_key'] for c in create_payout.call_args_list}
+        self.assertEqual(keys, {call.idempotency_key})
+        self.assertEqual(WithdrawalRequest.objects.get().yookassa_payout_id, 'po_1')
+        self.assertEqual(ledger.get_balance(self.venue.id), 500)
+
+    @mock.patch('core.outbox.create_yookassa_payout')
+    def test_unavailable_provider_keeps_withdrawal_pending(self, create_payout):
+        create_payout.side_effect = self.provider(ProviderUnavailable('timeout'))
+        self.withdraw()
+        self.assertEqual(outbox.process_batch(), [False])
+        call = ProviderCall.objects.get()
+        self.assertEqual((call.status, call.attempts), ('pending', 1))
+        self.assertGreater(call.next_attempt_at, timezone.now())
+        self.assertEqual(WithdrawalRequest.objects.get().status, 'pending')
+        self.assertEqual(ledger.get_balance(self.venue.id), 500)
+
+    @mock.patch('core.outbox.create_yookassa_payout')
+    def test_rejected_payout_is_refunded_once(self, create_payout):
+        create_payout.side_effect = self.provider(BadRequestError({'type': 'error', 'code': 'invalid_request'}))
+        self.withdraw()
+        self.assertEqual(outbox.process_batch(), [False])
+        self.assertEqual(outbox.process_batch(), [])
+        self.assertEqual(ProviderCall.objects.get().status, 'failed')
+        self.assertEqual(WithdrawalRequest.objects.get().status, 'failed')
+        self.assertEqual(ledger.get_balance(self.venue.id), 1000)
+
+    @mock.patch('core.outbox.create_yookassa_payment')
+    def test_payment_link_after_provider_outage(self, create_payment):
+        url = reverse('create-payment', kwargs={'payment_token': self.track_request.payment_token})
+        create_payment.side_effect = self.provider(ProviderUnavailable('timeout'))
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(ProviderCall.objects.get().status, 'pending')
+
+        create_payment.side_effect = self.provider(
+            SimpleNamespace(id='pay_1', confirmation=SimpleNamespace(confirmation_url='https://pay.example.com'))
+        )
+        ProviderCall.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(outbox.process_batch(), [True])
+        self.assertEqual(TrackRequest.objects.get().payment_id, 'pay_1')
+
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'confirmation_url': 'https://pay.example.com'})
+        self.assertEqual(create_payment.call_count, 2)
+        self.assertEqual(len({c.kwargs['idempotency_key'] for c in create_payment.call_args_list}), 1)
+
+
+class ReconciliationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Test Venue', city='City', phone='+79123456789')
+        self.genre = Genre.objects.create(name='Rock')
+        self.track = Track.objects.create(venue=self.venue, genre=self.genre, title='Hit', artist='A', price=100)
+        self.provider = {}
+
+    def find(self, object_id):
+        result = self.provider[object_id]
+        if isinstance(result, Exception):
+            raise result
+        return SimpleNamespace(id=object_id, status=result)
+
+    def age(self, obj, delta=timedelta(hours=1)):
+        type(obj).objects.filter(pk=obj.pk).update(created_at=timezone.now() - delta)
+        return obj
+
+    def withdrawal(self, payout_id, provider_status, status='processing', age=timedelta(hours=1)):
+        self.provider[payout_id] = provider_status
+        return self.age(WithdrawalRequest.objects.create(
+            venue=self.venue, amount=500, status=status, yookassa_payout_id=payout_id, bank_card_token='t'
+        ), age)
+
+    def track_request(self, payment_id, provider_status, **fields):
+        self.provider[payment_id] = provider_status
+        age = fields.pop('age', timedelta(hours=1))
+        return self.age(TrackRequest.objects.create(
+            track=self.track, user_fee=150, payment_id=payment_id, **fields
+        ), age)
+
+    def reconcile(self):
+        with mock.patch('core.reconciliation.find_payout', self.find), \
+                mock.patch('core.reconciliation.find_payment', self.find):
+            out = io.StringIO()
+            call_command('reconcile_payments', '--batch-size', '2', '--concurrency', '2', stdout=out)
+        return out.getvalue()
+
+    def test_stale_payouts_are_settled(self):
+        self.withdrawal('po_1', 'succeeded')
+        self.withdrawal('po_2', 'canceled')
+        self.withdrawal('po_3', 'pending')
+        self.withdrawal('po_4', 'canceled', age=timedelta(minutes=1))
+        self.withdrawal('po_5', ProviderUnavailable('timeout'))
+
+        out = self.reconcile()
+        self.assertIn('Выплаты: проверено 4, оплачено/выплачено 1, отменено 1, без изменений 1, ошибок 1', out)
+        statuses = dict(WithdrawalRequest.objects.values_list('yookassa_payout_id', 'status'))
+        self.assertEqual(statuses, {
+            'po_1': 'succeeded', 'po_2': 'canceled', 'po_3': 'processing', 'po_4': 'processing', 'po_5': 'processing'
+        })
+        self.assertEqual(list(Transaction.objects.values_list('amount', 'transaction_type')), [(500, 'refund')])
+
+        self.reconcile()
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    @override_settings(EVENTS_BROKER='core.events.LocalBroker')
+    def test_lost_payment_webhooks_are_applied(self):
+        paid = self.track_request('pay_1', 'succeeded')
+        late = self.track_request('pay_2', 'succeeded', status='expired')
+        canceled = self.track_request('pay_3', 'canceled')
+        ProviderCall.objects.create(kind='payment', track_request=canceled, status='done')
+        waiting = self.track_request('pay_4', 'pending')
+        ancient = self.track_request('pay_5', 'succeeded', age=timedelta(days=5))
+
+        out = self.reconcile()
+        self.assertIn('Платежи: проверено 4, оплачено/выплачено 2, отменено 1, без изменений 1, ошибок 0', out)
+        rows = dict(TrackRequest.objects.values_list('pk', 'is_paid'))
+        self.assertEqual(rows, {paid.pk: True, late.pk: True, canceled.pk: False, waiting.pk: False, ancient.pk: False})
+        self.assertEqual(TrackRequest.objects.get(pk=late.pk).status, 'pending')
+        self.assertEqual(TrackRequest.objects.get(pk=canceled.pk).payment_id, '')
+        self.assertEqual(ProviderCall.objects.get().status, 'failed')
+        self.assertEqual(ledger.get_balance(self.venue.id), 300)
+        self.assertEqual(VenueDailyStats.objects.get().paid, 2)
+
+    @override_settings(EVENTS_BROKER='core.events.LocalBroker')
+    def test_archived_requests_with_payment_are_reconciled(self):
+        paid = self.track_request('pay_1', 'succeeded', status='expired')
+        canceled = self.track_request('pay_2', 'canceled', status='expired')
+        waiting = self.track_request('pay_3', 'pending', status='expired')
+        self.assertEqual(expiry.archive_batch(timezone.now(), 10), 3)
+
+        out = self.reconcile()
+        self.assertIn('Платежи: проверено 3, оплачено/выплачено 1, отменено 1, без изменений 1, ошибок 0', out)
+        restored = TrackRequest.objects.get()
+        self.assertEqual((restored.pk, restored.status, restored.is_paid), (paid.pk, 'pending', True))
+        self.assertEqual(ledger.get_balance(self.venue.id), 150)
+        archived = dict(ArchivedTrackRequest.objects.values_list('pk', 'payment_id'))
+        self.assertEqual(archived, {canceled.pk: '', waiting.pk: 'pay_3'})
+
+        self.reconcile()
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def failed_payout(self, age=timedelta(hours=1)):
+        withdrawal = self.withdrawal('', None, status='pending')
+        call = self.age(ProviderCall.objects.create(kind='payout', withdrawal=withdrawal, status='failed'), age)
+        return withdrawal, call
+
+    def test_failed_payout_calls_are_replayed(self):
+        found, found_call = self.failed_payout()
+        rejected, rejected_call = self.failed_payout()
+        expired, _ = self.failed_payout(age=timedelta(days=2))
+        replies = {
+            found_call.idempotency_key: SimpleNamespace(id='po_found', status='pending'),
+            rejected_call.idempotency_key: BadRequestError({'type': 'error', 'code': 'invalid_request'}),
+        }
+        self.provider['po_found'] = 'succeeded'
+
+        def create_payout(amount, fee, token, idempotency_key):
+            reply = replies[idempotency_key]
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+        with mock.patch('core.reconciliation.create_yookassa_payout', side_effect=create_payout) as replay:
+            out = self.reconcile()
+        self.assertEqual(replay.call_count, 2)
+        self.assertIn('Выплаты: проверено 3, оплачено/выплачено 1, отменено 1, без изменений 0, ошибок 1', out)
+        statuses = {w.pk: (w.status, w.yookassa_payout_id) for w in WithdrawalRequest.objects.all()}
+        self.assertEqual(statuses, {
+            found.pk: ('succeeded', 'po_found'), rejected.pk: ('failed', ''), expired.pk: ('pending', '')
+        })
+        self.assertEqual(ProviderCall.objects.get(pk=found_call.pk).status, 'done')
+        self.assertEqual(list(Transaction.objects.values_list('amount', 'transaction_type')), [(500, 'refund')])
+
+    def test_rows_changed_after_fetch_are_left_for_next_run(self):
+        self.withdrawal('po_1', 'succeeded')
+        self.track_request('pay_1', 'succeeded')
+        real_fetch = reconciliation.fetch
+
+        def fetch(object_ids, finder, concurrency):
+            found = real_fetch(object_ids, finder, concurrency)
+            # Пока шел запрос к ЮKassa, webhook сменил выплату и платеж пересоздали
+            WithdrawalRequest.objects.filter(yookassa_payout_id__in=object_ids).update(yookassa_payout_id='po_2')
+            TrackRequest.objects.filter(payment_id__in=object_ids).update(payment_id='pay_2')
+            return found
+
+        with mock.patch('core.reconciliation.fetch', fetch):
+            out = self.reconcile()
+        self.assertIn('Выплаты: проверено 1, оплачено/выплачено 0, отменено 0, без изменений 1, ошибок 0', out)
+        self.assertIn('Платежи: проверено 1, оплачено/выплачено 0, отменено 0, без изменений 1, ошибок 0', out)
+        self.assertFalse(TrackRequest.objects.get().is_paid)
+
+    def test_cost_does_not_grow_with_history(self):
+        self.withdrawal('po_1', 'pending')
+        self.track_request('pay_1', 'pending')
+
+        def queries():
+            with CaptureQueriesContext(connection) as captured:
+                self.reconcile()
+            return len(captured)
+
+        before = queries()
+        for i in range(20):
+            self.withdrawal(f'po_done_{i}', 'succeeded', status='succeeded')
+            self.track_request(f'pay_done_{i}', 'succeeded', is_paid=True)
+        self.assertEqual(queries(), before)
+
+
+@override_settings(ROOT_URLCONF='server.urls_asgi')
+class AsyncViewTests(APITestCase):
+    """Асинхронные представления (server.urls_asgi) отвечают так же, как синхронные."""
+
+    def setUp(self):
+        throttling._stores.clear()
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.venue = Venue.objects.create(user=self.user, name='Test Venue', city='City', phone='+79123456789')
+        self.genre = Genre.objects.create(name='Rock')
+        self.track = Track.objects.create(venue=self.venue, genre=self.genre, title='Hit', artist='A', price=100)
+        token = CustomTokenObtainPairSerializer.get_token(self.user).access_token
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+        self.payment = SimpleNamespace(
+            id='pay_1', confirmation=SimpleNamespace(confirmation_url='https://pay.example.com')
+        )
+
+    def test_guest_routes_are_async(self):
+        for name, kwargs in (
+            ('tracks-list', {'venue_id': 1}),
+            ('track-request-create', {'venue_id': 1}),
+            ('create-payment', {'payment_token': uuid.uuid4()}),
+            ('payment-webhook', None),
+            ('withdrawal-webhook', None),
+        ):
+            view_class = resolve(reverse(name, kwargs=kwargs)).func.view_class
+            self.assertTrue(issubclass(view_class, async_views.AsyncAPIView), name)
+            self.assertTrue(view_class.view_is_async, name)
+        # Остальные маршруты остаются синхронными
+        self.assertIs(resolve(reverse('track-request-list')).func.view_class, views.TrackRequestListView)
+
+    def test_catalog_hit_is_served_without_database(self):
+        url = reverse('tracks-list', kwargs={'venue_id': self.venue.id})
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual([track['id'] for track in first.json()], [self.track.id])
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(url)
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(cached.json(), first.json())
+        self.assertEqual(cached['ETag'], first['ETag'])
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_owner_adds_track_through_sync_view(self):
+        url = reverse('tracks-list', kwargs={'venue_id': self.venue.id})
+        data = {
+            'title': 'New', 'artist': 'B', 'price': 200, 'genre_id': self.genre.id, 'icon': 'https://example.com/i.png'
+        }
+        self.assertEqual(self.client.post(url, data).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.post(url, data, **self.auth).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Track.objects.filter(venue=self.venue).count(), 2)
+
+    def test_track_request_matches_sync_view(self):
+        url = reverse('track-request-create', kwargs={'venue_id': self.venue.id})
+        response = self.client.post(url, {'track': self.track.id, 'user_fee': 150}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        track_request = TrackRequest.objects.get()
+        self.assertEqual(response.json(), json.loads(JSONRenderer().render(TrackRequestSerializer(track_request).data)))
+
+        response = self.client.post(url, {'track': self.track.id, 'user_fee': 10})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('user_fee', response.json())
+
+    def test_track_request_idempotency(self):
+        url = reverse('track-request-create', kwargs={'venue_id': self.venue.id})
+        data = {'track': self.track.id, 'user_fee': 150}
+        first, retry = [self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='key-1') for _ in range(2)]
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(TrackRequest.objects.count(), 1)
+
+    @override_settings(
+        RATE_LIMITS={'track_request': {'client': (1, 0.01)}}, RATE_LIMIT_BACKEND='core.throttling.MemoryBucketStore'
+    )
+    def test_guest_is_throttled(self):
+        throttling._stores.clear()
+        self.addCleanup(throttling._stores.clear)
+        url = reverse('track-request-create', kwargs={'venue_id': self.venue.id})
+        data = {'track': self.track.id, 'user_fee': 150}
+        self.assertEqual(self.client.post(url, data).status_code, status.HTTP_201_CREATED)
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+    def test_invalid_token_is_rejected(self):
+        response = self.client.post(
+            reverse('track-request-create', kwargs={'venue_id': self.venue.id}),
+            {'track': self.track.id, 'user_fee': 150},
+            HTTP_AUTHORIZATION='Bearer broken'
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+
+    @mock.patch('core.outbox.acreate_yookassa_payment', new_callable=mock.AsyncMock)
+    def test_payment_is_created_by_async_client(self, create_payment):
+        create_payment.return_value = self.payment
+        track_request = TrackRequest.objects.create(track=self.track, user_fee=150)
+        url = reverse('create-payment', kwargs={'payment_token': track_request.payment_token})
+        response = self.client.post(url, **self.auth)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json(), {'confirmation_url': 'https://pay.example.com'})
+        call = ProviderCall.objects.get()
+        self.assertEqual(call.status, 'done')
+        self.assertEqual(create_payment.call_args.kwargs['idempotency_key'], call.idempotency_key)
+        self.assertEqual(TrackRequest.objects.get().payment_id, 'pay_1')
+
+        self.assertEqual(self.client.post(url, **self.auth).status_code, status.HTTP_201_CREATED)
+        create_payment.assert_called_once()
+
+    @mock.patch('core.outbox.acreate_yookassa_payment', new_callable=mock.AsyncMock)
+    def test_payment_provider_outage(self, create_payment):
+        create_payment.side_effect = ProviderUnavailable('timeout')
+        track_request = TrackRequest.objects.create(track=self.track, user_fee=150)
+        response = self.client.post(
+            reverse('create-payment', kwargs={'payment_token': track_request.payment_token}), **self.auth
+        )
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(ProviderCall.objects.get().status, 'pending')
+
+    def test_payment_errors(self):
+        track_request = TrackRequest.objects.create(track=self.track, user_fee=150, status='expired')
+        url = reverse('create-payment', kwargs={'payment_token': track_request.payment_token})
+        response = self.client.post(url, **self.auth)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {'detail': 'Срок оплаты запроса истек'})
+        response = self.client.post(reverse('create-payment', kwargs={'payment_token': uuid.uuid4()}), **self.auth)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_webhooks_are_enqueued(self):
+        for name, kind in (('payment-webhook', 'payment'), ('withdrawal-webhook', 'payout')):
+            response = self.client.post(reverse(name), {'event': 'e', 'object': {'id': 'obj_1'}}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(WebhookEvent.objects.filter(kind=kind, object_id='obj_1').exists())
+        response = self.client.post(reverse('payment-webhook'), {'event': 'e'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('payment-webhook'), 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_guest_flow_under_asgi(self):
+        client = AsyncClient()
+        response = await client.post(
+            reverse('track-request-create', kwargs={'venue_id': self.venue.id}),
+            {'track': self.track.id, 'user_fee': 150},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with mock.patch('core.outbox.acreate_yookassa_payment', new_callable=mock.AsyncMock) as create_payment:
+            create_payment.return_value = self.payment
+            response = await client.post(
+                reverse('create-payment', kwargs={'payment_token': response.json()['payment_token']}),
+                headers={'Authorization': self.auth['HTTP_AUTHORIZATION']}
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(await ProviderCall.objects.filter(status='done').acount(), 1)
+
+    @override_settings(QUERY_COUNT_HEADERS=True)
+    async def test_query_count_under_asgi(self):
+        url = reverse('track-request-create', kwargs={'venue_id': self.venue.id})
+        data = {'track': self.track.id, 'user_fee': 150}
+        # Первый запрос заполняет кеши процесса
+        await sync_to_async(self.client.post)(url, data, format='json')
+        sync_response = await sync_to_async(self.client.post)(url, data, format='json')
+        async_response = await AsyncClient().post(url, data, content_type='application/json')
+        self.assertEqual(async_response.status_code, status.HTTP_201_CREATED)
+        self.assertGreater(int(sync_response['X-DB-Query-Count']), 0)
+        self.assertEqual(async_response['X-DB-Query-Count'], sync_response['X-DB-Query-Count'])
+
+        # Синхронное представление под ASGI тоже выполняется в потоке sync_to_async
+        response = await AsyncClient().get(reverse('transaction-list'), headers={
+            'Authorization': self.auth['HTTP_AUTHORIZATION']
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(int(response['X-DB-Query-Count']), 0)
+
+
+class YooKassaClientTests(APITestCase):
+    def setUp(self):
+        self.fake = FakeYooKassa().start()
+        self.addCleanup(self.fake.stop)
+        breaker.reset()
+        stats.reset()
+        self.addCleanup(breaker.reset)
+        override = override_settings(YOOKASSA_API_URL=self.fake.url, YOOKASSA_READ_TIMEOUT=0.5)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_payment_roundtrip_through_fake_provider(self):
+        token = uuid.uuid4()
+        payment = create_yookassa_payment(150, token, 'Оплата трека')
+        self.assertEqual(payment.status, 'pending')
+        self.assertTrue(payment.confirmation.confirmation_url.startswith(self.fake.url))
+
+        payment = find_payment(payment.id)
+        self.assertEqual(payment.status, 'succeeded')
+        self.assertEqual(payment.metadata['payment_token'], str(token))
+        self.assertEqual(stats.snapshot()['POST /payments']['calls'], 1)
+        self.assertEqual(stats.snapshot()['GET /payments']['calls'], 1)
+
+    def test_connections_are_reused(self):
+        self.assertIs(get_session(), get_session())
+
+    def test_async_client_roundtrip(self):
+        async def create():
+            payment = await acreate_yookassa_payment(150, uuid.uuid4(), 'Оплата трека', idempotency_key='key-1')
+            self.assertIs(get_async_client(), get_async_client())
+            return payment
+
+        payment = async_to_sync(create)()
+        self.assertEqual(payment.status, 'pending')
+        self.assertTrue(payment.confirmation.confirmation_url.startswith(self.fake.url))
+        self.assertEqual(find_payment(payment.id).description, 'Оплата трека')
+        self.assertEqual(stats.snapshot()['POST /payments']['calls'], 1)
+
+    def test_async_client_hits_deadline(self):
+        self.fake.latency = 1
+        with self.assertRaises(ProviderUnavailable):
+            async_to_sync(acreate_yookassa_payment)(150, uuid.uuid4(), 'Оплата трека')
+        self.assertEqual(stats.snapshot()['POST /payments']['errors'], 1)
+
+    def test_slow_provider_hits_deadline(self):
+        self.fake.latency = 1
+        with self.assertRaises(ProviderUnavailable):
+            find_payment('payment_missing')
+        self.assertEqual(stats.snapshot()['GET /payments']['errors'], 1)
+
+    def test_read_timeout_is_not_retried(self):
+        self.fake.latency = 1
+        started = time.monotonic()
+        with self.assertRaises(ProviderUnavailable):
+            create_yookassa_payment(150, uuid.uuid4(), 'Оплата трека', idempotency_key='key-1')
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(self.fake.objects, {})
+
+    @override_settings(YOOKASSA_DEADLINE=0.5)
+    def test_accepted_retries_stay_within_deadline(self):
+        self.fake.latency = 0.3
+        self.fake.accepted_rate = 1
+        for create in (create_yookassa_payment, async_to_sync(acreate_yookassa_payment)):
+            started = time.monotonic()
+            with self.assertRaises(ResponseProcessingError):
+                create(150, uuid.uuid4(), 'Оплата трека')
+            # Без срока вызова три попытки с паузами заняли бы около 1.5 с
+            self.assertLess(time.monotonic() - started, 0.9)
+
+    def test_api_errors_are_mapped_from_status(self):
+        with self.assertRaises(NotFoundError):
+            find_payment('payment_missing')
+
+    def test_breaker_opens_and_fails_fast(self):
+        self.fake.error_rate = 1
+        for _ in range(breaker.failure_threshold):
+            with self.assertRaises(Exception):
+                find_payment('payment_1')
+        self.assertEqual(breaker.state, 'open')
+
+        self.fake.error_rate = 0
+        with self.assertRaises(ProviderUnavailable):
+            find_payment('payment_1')
+        self.assertEqual(stats.snapshot()['GET /payments']['calls'], breaker.failure_threshold)
+
+    def test_breaker_half_open_trial(self):
+        circuit = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        circuit.record_failure()
+        self.assertEqual(circuit.state, 'half-open')
+        circuit.before_call()
+        with self.assertRaises(ProviderUnavailable):
+            circuit.before_call()
+        circuit.record_success()
+        self.assertEqual(circuit.state, 'closed')
@@ -0,0 +1,202 @@
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def refill(tokens, updated, capacity, rate, now):
+    """Пополняет корзину на момент now и пытается взять токен.
+
+    Возвращает (остаток, через сколько секунд повторить); 0 - токен выдан.
+    Отсутствующая корзина считается полной.
+    """
+    if tokens is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBucketStore:
+    """Корзины в памяти процесса: для тестов и запуска с одним воркером."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (None, None))
+            tokens, retry_after = refill(tokens, updated, capacity, rate, now)
+            self.buckets[key] = (tokens, now)
+        return retry_after
+
+
+class SQLiteBucketStore:
+    """Корзины в файле SQLite, общем для всех воркеров gunicorn на машине.
+
+    Файл по умолчанию лежит в /dev/shm, то есть фактически в разделяемой
+    памяти. Взятие токена - одна короткая транзакция BEGIN IMMEDIATE, поэтому
+    воркеры не теряют обновления друг друга. Потерять файл не страшно:
+    корзины просто начнутся заново полными.
+    """
+
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, path=None):
+        self.path = str(path or getattr(settings, 'RATE_LIMIT_SQLITE_PATH', None) or self.default_path())
+        self.local = threading.local()
+        self.last_prune = 0.0
+
+    @staticmethod
+    def default_path():
+        shm = Path('/dev/shm')
+        directory = shm if shm.is_dir() else Path(tempfile.gettempdir())
+        return directory / 'server-rate-limits.sqlite3'
+
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS buckets '
+                '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+            )
+            self.local.connection = conn
+        return conn
+
+    def take(self, key, capacity, rate):
+        conn = self.connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, retry_after = refill(*(row or (None, None)), capacity, rate, now)
+            conn.execute(
+                'INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (key, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self.prune(conn, now)
+        return retry_after
+
+    def prune(self, conn, now):
+        # Давно не тронутые корзины уже полные, их можно удалить
+        if now - self.last_prune < self.PRUNE_INTERVAL:
+            return
+        self.last_prune = now
+        idle = getattr(settings, 'RATE_LIMIT_IDLE_TIMEOUT', 3600)
+        conn.execute('DELETE FROM buckets WHERE updated < ?', (now - idle,))
+
+
+class RedisBucketStore:
+    """Корзины в Redis для нескольких машин; нужен пакет redis.
+
+    Пополнение и взятие токена выполняются одним Lua-скриптом на сервере,
+    поэтому операция атомарна и стоит один сетевой запрос.
+    """
+
+    SCRIPT = """
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local tokens = tonumber(bucket[1])
+    if tokens == nil then
+        tokens = capacity
+    else
+        tokens = math.min(capacity, tokens + math.max(0, now - tonumber(bucket[2])) * rate)
+    end
+    local retry_after = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(retry_after)
+    """
+
+    def __init__(self, url=None, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImproperlyConfigured('Для RedisBucketStore установите пакет redis')
+            client = redis.Redis.from_url(url or settings.RATE_LIMIT_REDIS_URL)
+        self.client = client
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, capacity, rate):
+        return float(self.script(keys=[f'ratelimit:{key}'], args=[capacity, rate, time.time()]))
+
+
+def get_store():
+    path = getattr(settings, 'RATE_LIMIT_BACKEND', 'core.throttling.SQLiteBucketStore')
+    if path not in _stores:
+        with _stores_lock:
+            if path not in _stores:
+                _stores[path] = import_string(path)()
+    return _stores[path]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Ограничение публичных эндпоинтов корзинами токенов.
+
+    Лимиты берутся из RATE_LIMITS[view.rate_limit_scope]: корзина 'client'
+    на пару (заведение, клиент) и общая корзина 'venue' на заведение, чтобы
+    вирусный QR-код не съел всю пропускную способность. Владельцы заведений
+    с токеном не ограничиваются. Если хранилище недоступно, запрос
+    пропускается: ограничение не должно ронять сервис.
+    """
+
+    def __init__(self):
+        self.retry_after = None
+
+    def allow_request(self, request, view):
+        limits = getattr(settings, 'RATE_LIMITS', {}).get(getattr(view, 'rate_limit_scope', None))
+        if not limits or request.user.is_authenticated:
+            return True
+
+        scope = view.rate_limit_scope
+        venue_id = view.kwargs.get('venue_id', '-')
+        keys = {'client': f'{scope}:{venue_id}:{self.get_ident(request)}'}
+        if venue_id != '-':
+            keys['venue'] = f'{scope}:{venue_id}'
+
+        for name, key in keys.items():
+            if name not in limits:
+                continue
+            capacity, rate = limits[name]
+            try:
+                retry_after = get_store().take(key, capacity, rate)
+            except Exception:
+                logger.exception('Хранилище лимитов недоступно')
+                return True
+            if retry_after:
+                self.retry_after = retry_after
+                return False
+        return True
+
+    def wait(self):
+        return self.retry_after
@@ -27,11 +27,21 @@ urlpatterns = [
          views.VenueView.as_view(),
          name='profile'
     ),
+    path(
+        'venue/<int:venue_id>/qr/',
+        views.VenueQRCodeView.as_view(),
+        name='venue-qr'
+    ),
     path(
         'venue/<int:venue_id>/tracks/',
          views.VenueTrackListView.as_view(),
          name='tracks-list'
     ),
+    path(
+        'venue/<int:venue_id>/tracks/import/',
+        views.TrackImportView.as_view(),
+        name='tracks-import'
+    ),
     path(
         'venue/<int:venue_id>/tracks/<int:track_id>/',
         views.TrackDetailView.as_view(),
@@ -47,6 +57,16 @@ urlpatterns = [
          views.TrackRequestListView.as_view(),
          name='track-request-list'
     ),
+    path(
+        'requests/bulk/',
+        views.TrackRequestBulkUpdateView.as_view(),
+        name='track-request-bulk-update'
+    ),
+    path(
+        'requests/stream/',
+        views.TrackRequestStreamView.as_view(),
+        name='track-request-stream'
+    ),
     path(
         'requests/<int:pk>/',
          views.TrackRequestUpdateView.as_view(),
@@ -62,11 +82,26 @@ urlpatterns = [
         views.MockPaymentView.as_view(),
         name='mock-payment'
     ),
+    path(
+        'analytics/',
+        views.AnalyticsView.as_view(),
+        name='analytics'
+    ),
     path(
         'transactions/',
         views.TransactionListView.as_view(),
         name='transaction-list'
     ),
+    path(
+        'transactions/export/',
+        views.LedgerExportView.as_view(kind='transactions'),
+        name='transaction-export'
+    ),
+    path(
+        'withdrawals/export/',
+        views.LedgerExportView.as_view(kind='withdrawals'),
+        name='withdrawal-export'
+    ),
     path(
         'withdrawals/history/',
         views.WithdrawalListView.as_view(),
@@ -0,0 +1,46 @@
+from django.urls import path
+from . import async_views, views
+from .exports import astream
+
+
+# Под ASGI (server.asgi) эти маршруты обслуживают асинхронные представления,
+# остальные берутся из core/urls.py; пути и имена совпадают
+urlpatterns = [
+    path(
+        'venue/<int:venue_id>/tracks/',
+        async_views.VenueTrackListView.as_view(),
+        name='tracks-list'
+    ),
+    path(
+        'venue/<int:venue_id>/request/',
+        async_views.TrackRequestCreateView.as_view(),
+        name='track-request-create'
+    ),
+    path(
+        'payment/<uuid:payment_token>/',
+        async_views.PaymentCreateView.as_view(),
+        name='create-payment'
+    ),
+    path(
+        'payment-webhook/',
+        async_views.PaymentWebhookView.as_view(),
+        name='payment-webhook'
+    ),
+    path(
+        'withdrawal-webhook/',
+        async_views.WithdrawalWebhookView.as_view(),
+        name='withdrawal-webhook'
+    ),
+    # Синхронный итератор StreamingHttpResponse Django под ASGI собирает в список целиком,
+    # поэтому выгрузка отдается асинхронным итератором, читающим куски по одному
+    path(
+        'transactions/export/',
+        views.LedgerExportView.as_view(kind='transactions', stream=astream),
+        name='transaction-export'
+    ),
+    path(
+        'withdrawals/export/',
+        views.LedgerExportView.as_view(kind='withdrawals', stream=astream),
+        name='withdrawal-export'
+    ),
+]
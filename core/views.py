@@ -1,16 +1,33 @@
-from django.db.models import F
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
+from django.views import View
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import generics, permissions, status
 from django.shortcuts import get_object_or_404
 from django.db import transaction as db_transaction
 from rest_framework.exceptions import ValidationError
-from rest_framework.filters import SearchFilter
+from rest_framework.parsers import MultiPartParser
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from yookassa import Payment, Payout
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from . import analytics, ledger, outbox, projections, qr
+from .authentication import VenueJWTAuthentication, get_venue_id
+from .caching import cached_catalog_response, genres
+from .events import event_stream, publish_request_event
+from .exports import RENDERERS as EXPORT_RENDERERS, stream_export
+from .idempotency import idempotent
+from .imports import FORMATS as IMPORT_FORMATS, detect_format, import_tracks
 from .serializers import *
 from .models import Venue, TrackRequest, Transaction, WithdrawalRequest
-from .services import create_yookassa_payment, create_card_token, create_yookassa_payout
+from .pagination import TrackRequestCursorPagination
+from .projections import ProjectionListMixin
+from .search import TrackSearchFilter
+from .throttling import TokenBucketThrottle
+from .services import create_card_token
+from .webhooks import enqueue
 
 
 class VenueView(generics.RetrieveUpdateAPIView):
@@ -18,7 +35,7 @@ class VenueView(generics.RetrieveUpdateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_object(self):
-        return get_object_or_404(Venue, user=self.request.user)
+        return get_object_or_404(Venue, pk=get_venue_id(self.request.user))
 
 
 class VenueRegistrationView(generics.CreateAPIView):
@@ -26,19 +43,56 @@ class VenueRegistrationView(generics.CreateAPIView):
     permission_classes = [permissions.AllowAny]
 
 
+class VenueQRCodeView(View):
+    # Обычный View: DRF занимает ?format= под выбор рендерера
+    def get(self, request, venue_id):
+        fmt = request.GET.get('format', 'png')
+        if fmt not in qr.FORMATS:
+            return JsonResponse({"detail": "Неподдерживаемый формат"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            size = int(request.GET.get('size') or qr.get_default_size())
+        except ValueError:
+            size = None
+        if size not in qr.get_sizes():
+            return JsonResponse(
+                {"detail": f"Допустимые размеры: {', '.join(map(str, qr.get_sizes()))}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not Venue.objects.filter(pk=venue_id).exists():
+            return JsonResponse({"detail": "Заведение не найдено"}, status=status.HTTP_404_NOT_FOUND)
+
+        # Имя файла - хеш содержимого, поэтому подходит как ETag без чтения файла
+        etag = f'"{qr.code_name(venue_id, size, fmt).rsplit("/", 1)[-1]}"'
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            _, content = qr.get_code(venue_id, size, fmt)
+            response = HttpResponse(content, content_type=qr.FORMATS[fmt])
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age=3600'
+        return response
+
+
 class GenresView(generics.ListCreateAPIView):
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
     permission_classes = [permissions.IsAuthenticated]
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        return Response(self.get_serializer(genres.all(), many=True).data)
+
 
-class VenueTrackListView(generics.ListCreateAPIView):
+class VenueTrackListView(ProjectionListMixin, generics.ListCreateAPIView):
     serializer_class = TrackSerializer
+    throttle_classes = [TokenBucketThrottle]
+    rate_limit_scope = 'catalog'
+    admission_pool = 'guest'
+    projection_fields = projections.TRACK_FIELDS
+    project = staticmethod(projections.track)
     permission_classes = [permissions.AllowAny]
-    filter_backends = [DjangoFilterBackend, SearchFilter]
+    filter_backends = [DjangoFilterBackend, TrackSearchFilter]
     filterset_fields = ['genre']
-    search_fields = ['title', 'artist']
 
     def get_permissions(self):
         if self.request.method == 'POST':
@@ -49,8 +103,49 @@ class VenueTrackListView(generics.ListCreateAPIView):
         venue_id = self.kwargs.get('venue_id')
         return Track.objects.filter(venue_id=venue_id)
 
+    @staticmethod
+    def project_rows(rows):
+        return projections.tracks(rows)
+
+    def list(self, request, *args, **kwargs):
+        return cached_catalog_response(
+            request,
+            self.kwargs['venue_id'],
+            'tracks',
+            lambda: super(VenueTrackListView, self).list(request, *args, **kwargs).data
+        )
+
     def perform_create(self, serializer):
-        serializer.save(venue=self.request.user.venue)
+        serializer.save(venue_id=get_venue_id(self.request.user))
+
+
+class TrackImportView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, venue_id):
+        if venue_id != get_venue_id(request.user):
+            raise Http404
+        venue = get_object_or_404(Venue, pk=venue_id)
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"detail": "Не передан файл"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # ?format= занят DRF под выбор рендерера, поэтому формат передается полем формы
+        fmt = request.data.get('format') or detect_format(upload.name)
+        if fmt not in IMPORT_FORMATS:
+            return Response({"detail": "Неподдерживаемый формат файла"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            report = import_tracks(
+                venue,
+                upload,
+                fmt=fmt,
+                dry_run=request.query_params.get('dry_run') in ('1', 'true')
+            )
+        except ValueError as exc:
+            return Response({"detail": f"Не удалось прочитать файл: {exc}"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report, status=status.HTTP_200_OK)
 
 
 class TrackDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -60,15 +155,26 @@ class TrackDetailView(generics.RetrieveUpdateDestroyAPIView):
     lookup_url_kwarg = 'track_id'
 
     def get_queryset(self):
-        return Track.objects.filter(venue__user=self.request.user)
+        return Track.objects.filter(venue_id=get_venue_id(self.request.user))
+
+    def retrieve(self, request, *args, **kwargs):
+        venue_id = get_venue_id(request.user)
+        if venue_id is None:
+            raise Http404
+        return cached_catalog_response(
+            request,
+            venue_id,
+            f"track:{self.kwargs['track_id']}",
+            lambda: super(TrackDetailView, self).retrieve(request, *args, **kwargs).data
+        )
 
     def perform_update(self, serializer):
-        if serializer.instance.venue.user != self.request.user:
+        if serializer.instance.venue_id != get_venue_id(self.request.user):
             raise permissions.exceptions.PermissionDenied("Вы не являетесь владельцем этого трека")
         serializer.save()
 
     def perform_destroy(self, instance):
-        if instance.venue.user != self.request.user:
+        if instance.venue_id != get_venue_id(self.request.user):
             raise permissions.exceptions.PermissionDenied("Вы не можете удалить чужой трек")
         instance.delete()
 
@@ -76,21 +182,37 @@ class TrackDetailView(generics.RetrieveUpdateDestroyAPIView):
 class TrackRequestCreateView(generics.CreateAPIView):
     serializer_class = TrackRequestSerializer
     permission_classes = [permissions.AllowAny]
+    throttle_classes = [TokenBucketThrottle]
+    rate_limit_scope = 'track_request'
+    admission_pool = 'guest'
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context['venue_id'] = self.kwargs['venue_id']
         return context
 
-    @db_transaction.atomic
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
     def perform_create(self, serializer):
-        venue = get_object_or_404(Venue, pk=self.kwargs['venue_id'])
-        track = get_object_or_404(Track, pk=self.request.data['track'], venue=venue)
-        serializer.save(track=track)
+        create_track_request(serializer)
+
+
+@db_transaction.atomic
+def create_track_request(serializer):
+    # Трек заведения уже найден при валидации user_fee
+    track_request = serializer.save(track=serializer.validated_track)
+    analytics.record_event(track_request, 'created')
+    publish_request_event(track_request, 'created')
+    return track_request
 
 
 class MockPaymentView(APIView):
     permission_classes = [permissions.AllowAny]
+    throttle_classes = [TokenBucketThrottle]
+    rate_limit_scope = 'payment'
+    admission_pool = 'guest'
 
     @staticmethod
     def get(request, payment_token):  # Добавляем обработчик GET
@@ -105,7 +227,7 @@ class MockPaymentView(APIView):
     def post(request, payment_token):
         with db_transaction.atomic():
             track_request = get_object_or_404(
-                TrackRequest,
+                TrackRequest.objects.select_related('track'),
                 payment_token=payment_token
             )
 
@@ -114,9 +236,16 @@ class MockPaymentView(APIView):
                     {"detail": "Запрос уже оплачен"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            if track_request.status == 'expired':
+                return Response(
+                    {"detail": "Срок оплаты запроса истек"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
 
             track_request.is_paid = True
             track_request.save()
+            analytics.record_event(track_request, 'paid')
+            publish_request_event(track_request, 'paid')
 
             # Убрано начисление средств на баланс заведения
             return Response(
@@ -129,17 +258,17 @@ class WithdrawalView(generics.CreateAPIView):
     serializer_class = WithdrawalSerializer
     permission_classes = [permissions.IsAuthenticated]
 
-    @db_transaction.atomic
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
     def perform_create(self, serializer):
-        venue = self.request.user.venue
+        venue_id = get_venue_id(self.request.user)
         amount = serializer.validated_data['amount']
         fee_percent = getattr(settings, 'WITHDRAWAL_FEE_PERCENT', 0.05)
         fee = int(amount * fee_percent)
 
-        locked_venue = Venue.objects.select_for_update().get(pk=venue.pk)
-        if locked_venue.balance < amount:
-            raise ValidationError("Недостаточно средств на балансе")
-
+        # Токен карты ничего не списывает, поэтому запрашивается до транзакции
         card_token = create_card_token({
             'number': serializer.validated_data['card_number'],
             'expiry_year': serializer.validated_data['card_expiry_year'],
@@ -147,65 +276,54 @@ class WithdrawalView(generics.CreateAPIView):
             'csc': serializer.validated_data['card_csc']
         })
 
-        payout = create_yookassa_payout(amount, fee, card_token)
-
-        withdrawal = WithdrawalRequest.objects.create(
-            venue=venue,
-            amount=amount,
-            bank_card_token=card_token,
-            fee=fee,
-            yookassa_payout_id=payout.id,
-            status='processing'
-        )
-
-        locked_venue.balance = F('balance') - amount
-        locked_venue.save()
+        # Выплату в ЮKassa создает manage.py dispatch_provider_calls после коммита
+        with ledger.locked_balance(venue_id) as balance:
+            if balance < amount:
+                raise ValidationError("Недостаточно средств на балансе")
+
+            withdrawal = WithdrawalRequest.objects.create(
+                venue_id=venue_id,
+                amount=amount,
+                bank_card_token=card_token,
+                fee=fee,
+                status='pending'
+            )
 
-        Transaction.objects.create(
-            venue=venue,
-            amount=-amount,
-            transaction_type='withdrawal'
-        )
+            ledger.record(venue_id, -amount, 'withdrawal')
+            outbox.enqueue_payout(withdrawal)
 
 
 class MockWithdrawalView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
+    @idempotent
     @db_transaction.atomic
     def post(self, request):
         serializer = WithdrawalSerializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
 
-        venue = request.user.venue
+        venue_id = get_venue_id(request.user)
         amount = serializer.validated_data['amount']
         fee_percent = getattr(settings, 'WITHDRAWAL_FEE_PERCENT', 0.05)
         fee = int(amount * fee_percent)
 
-        locked_venue = Venue.objects.select_for_update().get(pk=venue.pk)
-        if locked_venue.balance < amount:
-            return Response(
-                {"detail": "Недостаточно средств на балансе"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        withdrawal = WithdrawalRequest.objects.create(
-            venue=venue,
-            amount=amount,
-            bank_card_token='mock_card_token',
-            fee=fee,
-            yookassa_payout_id=f'mock_payout_{uuid.uuid4()}',
-            status='succeeded'
-        )
+        with ledger.locked_balance(venue_id) as balance:
+            if balance < amount:
+                return Response(
+                    {"detail": "Недостаточно средств на балансе"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
 
-        # Обновляем баланс
-        locked_venue.balance = F('balance') - amount
-        locked_venue.save()
+            withdrawal = WithdrawalRequest.objects.create(
+                venue_id=venue_id,
+                amount=amount,
+                bank_card_token='mock_card_token',
+                fee=fee,
+                yookassa_payout_id=f'mock_payout_{uuid.uuid4()}',
+                status='succeeded'
+            )
 
-        Transaction.objects.create(
-            venue=venue,
-            amount=-amount,
-            transaction_type='withdrawal',
-        )
+            ledger.record(venue_id, -amount, 'withdrawal')
 
         return Response({
             "id": withdrawal.id,
@@ -220,36 +338,61 @@ class WithdrawalWebhookView(APIView):
 
     @staticmethod
     def post(request):
-        payout = Payout.find_one(request.data['object']['id'])
+        return enqueue_webhook('payout', request.data)
 
-        withdrawal = WithdrawalRequest.objects.get(
-            yookassa_payout_id=payout.id
-        )
 
-        if payout.status == 'succeeded':
-            withdrawal.status = 'succeeded'
-        elif payout.status == 'canceled':
-            withdrawal.status = 'canceled'
+class TrackRequestListView(ProjectionListMixin, generics.ListAPIView):
+    serializer_class = TrackRequestSerializer
+    projection_fields = projections.TRACK_REQUEST_FIELDS
+    project = staticmethod(projections.track_request)
+    permission_classes = [permissions.AllowAny]
+    pagination_class = TrackRequestCursorPagination
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['status', 'is_paid']
 
-            Venue.objects.filter(pk=withdrawal.venue.pk).update(
-                balance=F('balance') + withdrawal.amount
-            )
-        else:
-            withdrawal.status = payout.status
+    def get_queryset(self):
+        return TrackRequest.objects.filter(venue_id=get_venue_id(self.request.user))
 
-        withdrawal.save()
-        return Response(status=status.HTTP_200_OK)
 
+class TrackRequestStreamView(View):
+    # Server-Sent Events: работает только под ASGI (server.asgi)
+    async def get(self, request):
+        venue_id = await self.authenticate(request)
+        if venue_id is None:
+            return JsonResponse(
+                {"detail": "Учетные данные не были предоставлены"},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
 
-class TrackRequestListView(generics.ListAPIView):
-    serializer_class = TrackRequestSerializer
-    permission_classes = [permissions.AllowAny]
-    pagination_class = None
+        last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id') or 0
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            last_event_id = 0
 
-    def get_queryset(self):
-        return TrackRequest.objects.filter(
-            track__venue=self.request.user.venue
-        ).select_related('track')
+        response = StreamingHttpResponse(
+            event_stream(venue_id, last_event_id),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @staticmethod
+    async def authenticate(request):
+        # EventSource в браузере не умеет передавать заголовки, поэтому токен можно передать в ?token=
+        auth = VenueJWTAuthentication()
+        header = auth.get_header(request)
+        raw_token = auth.get_raw_token(header) if header else request.GET.get('token')
+        if not raw_token:
+            return None
+        try:
+            validated_token = auth.get_validated_token(raw_token)
+            # Состояние пользователя обычно берется из кеша, в базу идет только промах
+            user = await sync_to_async(auth.get_user)(validated_token)
+        except (InvalidToken, AuthenticationFailed):
+            return None
+        return user.venue_id
 
 
 class TrackRequestUpdateView(generics.UpdateAPIView):
@@ -259,12 +402,17 @@ class TrackRequestUpdateView(generics.UpdateAPIView):
 
     def get_queryset(self):
         return TrackRequest.objects.filter(
-            track__venue=self.request.user.venue
+            venue_id=get_venue_id(self.request.user)
         ).select_related('track')
 
     @db_transaction.atomic
     def perform_update(self, serializer):
-        instance = self.get_object()
+        # Строка перечитывается под блокировкой: массовое принятие или второй PATCH
+        # могли изменить ее после get_object, и депозит начислился бы дважды
+        instance = TrackRequest.objects.select_for_update(of=('self',)).select_related('track').get(
+            pk=serializer.instance.pk
+        )
+        serializer.instance = instance
         new_status = serializer.validated_data.get('status')
 
         if instance.status != 'pending':
@@ -275,63 +423,178 @@ class TrackRequestUpdateView(generics.UpdateAPIView):
 
         serializer.save()
 
+        if new_status in ('accepted', 'rejected'):
+            analytics.record_event(serializer.instance, new_status)
+            publish_request_event(serializer.instance, new_status)
+
         if new_status == 'accepted':
-            with db_transaction.atomic():
-                venue = Venue.objects.select_for_update().get(pk=instance.track.venue.pk)
-                venue.balance = F('balance') + instance.user_fee
-                venue.save()
-
-                Transaction.objects.create(
-                    venue=venue,
-                    amount=instance.user_fee,
-                    transaction_type='deposit',
-                    track_request=instance
-                )
+            ledger.record(instance.venue_id, instance.user_fee, 'deposit', track_request=instance)
+
 
+class TrackRequestBulkUpdateView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    @db_transaction.atomic
+    def post(self, request):
+        serializer = TrackRequestBulkUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data['items']
+
+        track_requests = TrackRequest.objects.select_for_update(of=('self',)).filter(
+            venue_id=get_venue_id(request.user),
+            pk__in=[item['id'] for item in items]
+        ).select_related('track').in_bulk()
+
+        results = []
+        updates = defaultdict(list)
+        seen = set()
+        for item in items:
+            track_request = track_requests.get(item['id'])
+            error = None
+            if item['id'] in seen:
+                error = "Запрос указан повторно"
+            elif track_request is None:
+                error = "Запрос не найден"
+            elif track_request.status != 'pending':
+                error = "Можно изменять только ожидающие запросы"
+            elif item['status'] == 'accepted' and not track_request.is_paid:
+                error = "Запрос должен быть оплачен перед принятием"
+            seen.add(item['id'])
+
+            if error:
+                results.append({'id': item['id'], 'status': item['status'], 'ok': False, 'error': error})
+                continue
+            track_request.status = item['status']
+            updates[item['status']].append(track_request)
+            results.append({'id': item['id'], 'status': item['status'], 'ok': True})
+
+        for new_status, changed in updates.items():
+            TrackRequest.objects.filter(pk__in=[r.pk for r in changed]).update(status=new_status)
+            analytics.record_events(changed, new_status)
+            for track_request in changed:
+                publish_request_event(track_request, new_status)
+
+        if updates['accepted']:
+            ledger.record_deposits(updates['accepted'])
+
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+
+class AnalyticsView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
 
-class TransactionListView(generics.ListAPIView):
+    def get(self, request):
+        venue_id = get_venue_id(request.user)
+        if venue_id is None:
+            raise Http404
+        serializer = AnalyticsQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return Response(analytics.venue_report(venue_id, **serializer.validated_data))
+
+
+class TransactionListView(ProjectionListMixin, generics.ListAPIView):
     serializer_class = TransactionSerializer
+    projection_fields = projections.TRANSACTION_FIELDS
+    project = staticmethod(projections.transaction)
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
         return Transaction.objects.filter(
-            venue=self.request.user.venue
+            venue_id=get_venue_id(self.request.user)
         ).order_by('-created_at')
 
 
-class WithdrawalListView(generics.ListAPIView):
+class WithdrawalListView(ProjectionListMixin, generics.ListAPIView):
     serializer_class = WithdrawalSerializer
+    projection_fields = projections.WITHDRAWAL_FIELDS
+    project = staticmethod(projections.withdrawal)
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
         return WithdrawalRequest.objects.filter(
-            venue=self.request.user.venue
+            venue_id=get_venue_id(self.request.user)
         ).order_by('-created_at')
 
 
+class LedgerExportView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    # Формат выбирается через ?format=csv|ndjson или заголовок Accept
+    renderer_classes = list(EXPORT_RENDERERS.values())
+    kind = None
+    # Обертка над кусками выгрузки; под ASGI - exports.astream (см. core/urls_asgi.py)
+    stream = None
+
+    def get(self, request):
+        params = {key: request.query_params.get(key) for key in ('date_from', 'date_to') if key in request.query_params}
+        if 'venue' in request.query_params:
+            params['venue'] = request.query_params.getlist('venue')
+        serializer = LedgerExportFilterSerializer(data=params)
+        serializer.is_valid(raise_exception=True)
+        filters = serializer.validated_data
+
+        # Персонал выгружает любые заведения, владелец - только свое
+        venue_ids = filters.get('venue')
+        if not request.user.is_staff:
+            venue_id = get_venue_id(request.user)
+            if venue_id is None:
+                raise Http404
+            venue_ids = [venue_id]
+
+        fmt = request.accepted_renderer.format
+        chunks = stream_export(
+            self.kind,
+            fmt,
+            venue_ids=venue_ids,
+            date_from=filters.get('date_from'),
+            date_to=filters.get('date_to')
+        )
+        if self.stream is not None:
+            chunks = self.stream(chunks)
+        response = StreamingHttpResponse(chunks, content_type=request.accepted_renderer.media_type)
+        response['Content-Disposition'] = f'attachment; filename="{self.kind}.{fmt}"'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
 class PaymentCreateView(generics.CreateAPIView):
     permission_classes = [permissions.AllowAny]
 
-    @db_transaction.atomic
+    @idempotent
     def post(self, request, *args, **kwargs):
-        track_request = get_object_or_404(
-            TrackRequest,
-            payment_token=kwargs['payment_token'],
-            track__venue=request.user.venue
-        )
+        call = enqueue_payment(request, kwargs['payment_token'])
+
+        # Ссылка на оплату нужна сразу, поэтому вызов выполняется здесь же, но уже после
+        # коммита; если ЮKassa не ответила, его повторит dispatch_provider_calls
+        if call.status != 'done':
+            claimed = outbox.claim(call)
+            if claimed is not None:
+                outbox.dispatch(claimed)
+                call = claimed
+        return payment_response(call)
+
 
-        payment = create_yookassa_payment(
-            amount=track_request.user_fee,
-            payment_token=track_request.payment_token,
-            description=f"Оплата трека {track_request.track.title}"
+def enqueue_payment(request, payment_token):
+    with db_transaction.atomic():
+        track_request = get_object_or_404(
+            TrackRequest.objects.select_for_update(),
+            payment_token=payment_token,
+            venue_id=get_venue_id(request.user)
         )
+        if track_request.status == 'expired':
+            raise ValidationError({"detail": "Срок оплаты запроса истек"})
+        return outbox.enqueue_payment(track_request)
 
-        track_request.payment_id = payment.id
-        track_request.save()
 
-        return Response({
-            'confirmation_url': payment.confirmation.confirmation_url
-        }, status=status.HTTP_201_CREATED)
+def payment_response(call):
+    if call.status != 'done':
+        return Response(
+            {"detail": "Платежная система не ответила, повторите запрос позже"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={'Retry-After': '5'}
+        )
+    return Response({
+        'confirmation_url': call.result['confirmation_url']
+    }, status=status.HTTP_201_CREATED)
 
 
 class PaymentWebhookView(APIView):
@@ -339,27 +602,16 @@ class PaymentWebhookView(APIView):
 
     @staticmethod
     def post(request):
-        payment = Payment.find_one(request.data['object']['id'])
-        if payment.status == 'succeeded':
-            with db_transaction.atomic():
-                track_request = TrackRequest.objects.select_for_update().get(
-                    payment_token=payment.metadata['payment_token']
-                )
-                if track_request.is_paid:
-                    return Response(status=status.HTTP_200_OK)
+        return enqueue_webhook('payment', request.data)
 
-                track_request.is_paid = True
-                track_request.transaction_id = payment.id
-                track_request.save()
 
-                venue = track_request.track.venue
-                Venue.objects.filter(pk=venue.pk).update(
-                    balance=F('balance') + track_request.user_fee
-                )
-                Transaction.objects.create(
-                    venue=venue,
-                    amount=track_request.user_fee,
-                    transaction_type='deposit',
-                    track_request=track_request
-                )
-        return Response(status=status.HTTP_200_OK)
+def enqueue_webhook(kind, data):
+    # Уведомление только сохраняется во входящую очередь, обработка идет в manage.py process_webhooks
+    try:
+        enqueue(kind, data)
+    except (KeyError, TypeError, AttributeError):
+        return Response(
+            {"detail": "Некорректное уведомление"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return Response(status=status.HTTP_200_OK)
@@ -0,0 +1,156 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, IntegrityError, transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import analytics, expiry, ledger
+from .events import publish_request_event
+from .models import TrackRequest, WebhookEvent, WithdrawalRequest
+from .services import find_payment, find_payout
+
+
+def enqueue(kind, payload):
+    object_id = str(payload['object']['id'])
+    event = str(payload.get('event', ''))
+    try:
+        with db_transaction.atomic():
+            return WebhookEvent.objects.create(kind=kind, object_id=object_id, event=event, payload=payload)
+    except IntegrityError:
+        pass
+
+    # Повтор уже известного уведомления ничего не добавляет, а новое событие
+    # по обработанному объекту (например, отмена выплаты) ставится в очередь заново
+    WebhookEvent.objects.filter(
+        kind=kind, object_id=object_id, status__in=['done', 'failed']
+    ).exclude(event=event).update(
+        event=event,
+        payload=payload,
+        status='pending',
+        attempts=0,
+        next_attempt_at=timezone.now(),
+        last_error=''
+    )
+    return None
+
+
+def process_payment(payment_id):
+    payment = find_payment(payment_id)
+    if payment.status != 'succeeded':
+        return
+    mark_paid(payment.metadata['payment_token'], payment.id)
+
+
+def mark_paid(payment_token, transaction_id):
+    with db_transaction.atomic():
+        track_request = TrackRequest.objects.select_for_update().filter(payment_token=payment_token).first()
+        if track_request is None:
+            track_request = expiry.restore(payment_token)
+        if track_request.is_paid:
+            return
+
+        # Гость оплатил после истечения срока: деньги списаны, запрос возвращается в очередь
+        if track_request.status == 'expired':
+            track_request.status = 'pending'
+        track_request.is_paid = True
+        track_request.transaction_id = transaction_id
+        track_request.save()
+
+        ledger.record(track_request.venue_id, track_request.user_fee, 'deposit', track_request=track_request)
+        analytics.record_event(track_request, 'paid')
+        publish_request_event(track_request, 'paid')
+
+
+def process_payout(payout_id):
+    payout = find_payout(payout_id)
+
+    with db_transaction.atomic():
+        withdrawal = WithdrawalRequest.objects.select_for_update().get(
+            yookassa_payout_id=payout.id
+        )
+        if withdrawal.status in ('succeeded', 'canceled'):
+            return
+
+        if payout.status == 'canceled':
+            ledger.record(withdrawal.venue_id, withdrawal.amount, 'refund')
+        withdrawal.status = payout.status
+        withdrawal.save()
+
+
+PROCESSORS = {
+    'payment': process_payment,
+    'payout': process_payout,
+}
+
+
+def claim_batch(batch_size, worker_id=None):
+    worker_id = worker_id or uuid.uuid4().hex
+    now = timezone.now()
+    visibility_timeout = getattr(settings, 'WEBHOOK_VISIBILITY_TIMEOUT', timedelta(minutes=5))
+
+    ids = list(
+        WebhookEvent.objects.filter(
+            Q(status='pending', next_attempt_at__lte=now)
+            | Q(status='processing', locked_at__lt=now - visibility_timeout)
+        ).order_by('next_attempt_at', 'id').values_list('id', flat=True)[:batch_size]
+    )
+    if not ids:
+        return []
+
+    # Строку забирает тот воркер, чей UPDATE прошел первым
+    WebhookEvent.objects.filter(
+        Q(status='pending') | Q(status='processing', locked_at__lt=now - visibility_timeout),
+        pk__in=ids
+    ).update(status='processing', locked_at=now, locked_by=worker_id)
+    return list(WebhookEvent.objects.filter(pk__in=ids, status='processing', locked_by=worker_id))
+
+
+def retry_delay(attempts):
+    base = getattr(settings, 'WEBHOOK_RETRY_BASE_DELAY', 5)
+    maximum = getattr(settings, 'WEBHOOK_RETRY_MAX_DELAY', 3600)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), maximum))
+
+
+def handle(webhook_event):
+    attempts = webhook_event.attempts + 1
+    try:
+        PROCESSORS[webhook_event.kind](webhook_event.object_id)
+    except Exception as exc:
+        max_attempts = getattr(settings, 'WEBHOOK_MAX_ATTEMPTS', 10)
+        WebhookEvent.objects.filter(pk=webhook_event.pk).update(
+            status='failed' if attempts >= max_attempts else 'pending',
+            attempts=attempts,
+            next_attempt_at=timezone.now() + retry_delay(attempts),
+            last_error=f'{type(exc).__name__}: {exc}'[:2000],
+            locked_at=None,
+            locked_by=''
+        )
+        return False
+
+    WebhookEvent.objects.filter(pk=webhook_event.pk).update(
+        status='done',
+        attempts=attempts,
+        processed_at=timezone.now(),
+        last_error='',
+        locked_at=None,
+        locked_by=''
+    )
+    return True
+
+
+def _handle_in_thread(webhook_event):
+    try:
+        return handle(webhook_event)
+    finally:
+        connection.close()
+
+
+def process_batch(batch_size=100, concurrency=4, worker_id=None):
+    events = claim_batch(batch_size, worker_id)
+    if concurrency <= 1 or len(events) <= 1:
+        return [handle(e) for e in events]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(_handle_in_thread, events))
@@ -3,5 +3,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+# Гостевые эндпоинты и webhook'и под ASGI обслуживают асинхронные представления (core.async_views)
+os.environ.setdefault('DJANGO_ROOT_URLCONF', 'server.urls_asgi')
 
 application = get_asgi_application()
@@ -0,0 +1,84 @@
+import os
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+PROFILES = ('sqlite', 'sqlite-wal', 'postgresql')
+
+
+def _env_bool(name, default):
+    return os.getenv(name, str(default)).lower() == 'true'
+
+
+def sqlite(name=None, wal=True):
+    """SQLite для одного сервера.
+
+    В WAL-режиме чтение не ждет запись, а запись не ждет чтение. Транзакции
+    начинаются с BEGIN IMMEDIATE: блокировка на запись берется сразу, и
+    конкурирующие транзакции ждут busy_timeout, а не падают с "database is
+    locked" при попытке повысить блокировку посреди транзакции.
+    """
+    config = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name or os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+    }
+    if not wal:
+        return config
+    config['OPTIONS'] = {
+        # Параметр timeout драйвера - это busy_timeout SQLite, в секундах
+        'timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', '20')),
+        'transaction_mode': 'IMMEDIATE',
+        # synchronous=NORMAL в WAL не теряет целостность, при сбое питания
+        # могут пропасть только последние зафиксированные транзакции
+        'init_command': (
+            'PRAGMA journal_mode=WAL;'
+            'PRAGMA synchronous=NORMAL;'
+            'PRAGMA temp_store=MEMORY;'
+            f"PRAGMA cache_size=-{int(os.getenv('SQLITE_CACHE_KB', '20000'))}"
+        ),
+    }
+    return config
+
+
+def postgresql():
+    """PostgreSQL для нескольких воркеров gunicorn.
+
+    По умолчанию соединение живет CONN_MAX_AGE секунд и проверяется перед
+    повторным использованием. DB_POOL=true включает пул psycopg 3 (нужен
+    пакет psycopg[pool]); с пулом постоянные соединения Django отключаются.
+    За PgBouncer в режиме транзакций нужен DB_PGBOUNCER=true: серверные
+    курсоры выгрузок там не работают.
+    """
+    config = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.getenv('DB_NAME', 'server'),
+        'USER': os.getenv('DB_USER', 'postgres'),
+        'PASSWORD': os.getenv('DB_PASSWORD', ''),
+        'HOST': os.getenv('DB_HOST', 'localhost'),
+        'PORT': os.getenv('DB_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
+        'DISABLE_SERVER_SIDE_CURSORS': _env_bool('DB_PGBOUNCER', False),
+        'OPTIONS': {
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5')),
+        },
+    }
+    if _env_bool('DB_POOL', False):
+        config['CONN_MAX_AGE'] = 0
+        config['OPTIONS']['pool'] = {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+            'timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+        }
+    return config
+
+
+def database(profile=None):
+    profile = profile or os.getenv('DB_PROFILE', 'sqlite-wal')
+    if profile == 'postgresql':
+        return postgresql()
+    if profile == 'sqlite-wal':
+        return sqlite()
+    if profile == 'sqlite':
+        return sqlite(wal=False)
+    raise ValueError(f'Неизвестный профиль базы {profile!r}, доступны: {", ".join(PROFILES)}')
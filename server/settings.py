@@ -2,6 +2,8 @@ import os
 from datetime import timedelta
 from pathlib import Path
 
+from . import databases
+
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -17,6 +19,16 @@ CSRF_TRUSTED_ORIGINS = [
 
 YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID', 'your_shop_id')
 YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY', 'your_secret_key')
+YOOKASSA_API_URL = os.getenv('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3')
+YOOKASSA_CONNECT_TIMEOUT = float(os.getenv('YOOKASSA_CONNECT_TIMEOUT', '3'))
+YOOKASSA_READ_TIMEOUT = float(os.getenv('YOOKASSA_READ_TIMEOUT', '10'))
+# Срок одного вызова вместе с повторами при 202 и ошибках соединения
+YOOKASSA_DEADLINE = float(os.getenv('YOOKASSA_DEADLINE', '15'))
+YOOKASSA_POOL_SIZE = int(os.getenv('YOOKASSA_POOL_SIZE', '10'))
+# Соединений асинхронного клиента (ASGI) на процесс: ожидание ответа не занимает поток
+YOOKASSA_ASYNC_POOL_SIZE = int(os.getenv('YOOKASSA_ASYNC_POOL_SIZE', '100'))
+YOOKASSA_BREAKER_THRESHOLD = 5
+YOOKASSA_BREAKER_RESET_TIMEOUT = 30
 
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -39,13 +51,15 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'core.middleware.AdmissionControlMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.middleware.QueryCountMiddleware',
 ]
 
-ROOT_URLCONF = 'server.urls'
+ROOT_URLCONF = os.getenv('DJANGO_ROOT_URLCONF', 'server.urls')
 
 TEMPLATES = [
     {
@@ -65,11 +79,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'server.wsgi.application'
 
+# DB_PROFILE: sqlite-wal (по умолчанию), sqlite или postgresql, см. server/databases.py
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': databases.database(),
 }
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -89,7 +101,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.VenueJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -97,9 +109,15 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': (
         'django_filters.rest_framework.DjangoFilterBackend',
         'rest_framework.filters.SearchFilter'
-    )
+    ),
+    # Доверенных прокси перед приложением: без них X-Forwarded-For задает клиент, и лимиты
+    # по IP считаются по REMOTE_ADDR. За балансировщиком или nginx укажите NUM_PROXIES=1
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', '0')),
 }
 
+# Сколько секунд кешируются флаги пользователя для проверки токена (core.authentication)
+AUTH_USER_STATE_TIMEOUT = 60
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=30),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=30),
@@ -113,6 +131,10 @@ USE_TZ = True
 
 DOMAIN = os.getenv('DOMAIN', 'http://localhost:8000')
 QR = os.getenv('QR', 'http://localhost:3000')
+QR_SIZES = (256, 512, 1024)
+QR_DEFAULT_SIZE = 512
+QR_CACHE_TIMEOUT = 86400
+QR_RENDER_ASYNC = os.getenv('QR_RENDER_ASYNC', 'true').lower() == 'true'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
@@ -122,3 +144,74 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+EVENTS_BROKER = os.getenv('EVENTS_BROKER', 'core.events.DatabaseBroker')
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', '1.0'))
+# Сколько секунд опрос перечитывает уже выданные id: транзакция с событием дольше этого не живет
+EVENTS_POLL_LOOKBACK = float(os.getenv('EVENTS_POLL_LOOKBACK', '5.0'))
+EVENTS_HEARTBEAT = 15
+EVENTS_RETENTION = timedelta(hours=6)
+
+# Версии каталога и жанров и блокировка перестроения каталога должны быть общими для всех
+# воркеров, поэтому кеш процесса (locmem) допустим только при DEBUG; иначе по умолчанию
+# кеш в базе (таблица создается командой createcachetable), проверяет manage.py check --deploy
+LOCAL_CACHE = str(DEBUG).lower() == 'true'
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', (
+            'django.core.cache.backends.locmem.LocMemCache' if LOCAL_CACHE
+            else 'django.core.cache.backends.db.DatabaseCache'
+        )),
+        'LOCATION': os.getenv('CACHE_LOCATION', '' if LOCAL_CACHE else 'cache_table'),
+    }
+}
+
+CATALOG_CACHE_TIMEOUT = 600
+CATALOG_CACHE_LOCK_TIMEOUT = 5
+
+WEBHOOK_MAX_ATTEMPTS = 10
+WEBHOOK_RETRY_BASE_DELAY = 5
+WEBHOOK_RETRY_MAX_DELAY = 3600
+WEBHOOK_VISIBILITY_TIMEOUT = timedelta(minutes=5)
+
+# Исходящие вызовы ЮKassa (core.outbox); паузы между попытками те же, что у webhook'ов
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_VISIBILITY_TIMEOUT = timedelta(minutes=5)
+
+# Сверка с ЮKassa (manage.py reconcile_payments): записи без webhook дольше RECONCILE_STALE_AFTER;
+# платежи старше RECONCILE_PAYMENT_MAX_AGE уже не проверяются; неудавшийся вызов выплаты повторяется
+# с тем же ключом, пока ЮKassa его помнит (RECONCILE_PAYOUT_REPLAY_WINDOW, ключ живет сутки)
+RECONCILE_STALE_AFTER = timedelta(minutes=15)
+RECONCILE_PAYMENT_MAX_AGE = timedelta(days=2)
+RECONCILE_PAYOUT_REPLAY_WINDOW = timedelta(hours=23)
+RECONCILE_CONCURRENCY = 8
+
+# Неоплаченный запрос истекает через TRACK_REQUEST_TTL и еще через TRACK_REQUEST_ARCHIVE_AFTER
+# переносится в архив (manage.py expire_track_requests)
+TRACK_REQUEST_TTL = timedelta(hours=2)
+TRACK_REQUEST_ARCHIVE_AFTER = timedelta(days=1)
+
+# Сколько хранится ответ на POST с заголовком Idempotency-Key
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+# Сколько ключ занят выполняющимся запросом; если процесс упал, повтор после этого срока выполнится заново
+IDEMPOTENCY_KEY_LEASE = timedelta(minutes=1)
+
+QUERY_COUNT_HEADERS = os.getenv('QUERY_COUNT_HEADERS', str(DEBUG)).lower() == 'true'
+QUERY_COUNT_WARNING = 50
+
+# Корзины токенов для публичных эндпоинтов (core.throttling): (емкость, пополнение в секунду)
+# 'client' - на клиента в заведении, 'venue' - на все заведение
+RATE_LIMITS = {
+    'catalog': {'client': (60, 2.0), 'venue': (1200, 100.0)},
+    'track_request': {'client': (5, 0.2), 'venue': (300, 10.0)},
+    'payment': {'client': (10, 0.5)},
+}
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'core.throttling.SQLiteBucketStore')
+RATE_LIMIT_SQLITE_PATH = os.getenv('RATE_LIMIT_SQLITE_PATH')
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0')
+
+# Одновременных запросов на один воркер по пулам view (admission_pool), сверх - сразу 503.
+# Счетчик в памяти процесса: общий предел на сервер - это лимит, умноженный на число воркеров
+ADMISSION_LIMITS_PER_WORKER = {
+    'guest': int(os.getenv('ADMISSION_GUEST_LIMIT_PER_WORKER', '16')),
+}
@@ -0,0 +1,9 @@
+from django.urls import path, include
+
+from .urls import urlpatterns as wsgi_urlpatterns
+
+# Асинхронные маршруты стоят первыми и перекрывают одноименные синхронные
+urlpatterns = [
+    path('api/', include('core.urls_asgi')),
+    *wsgi_urlpatterns,
+]